@@ -0,0 +1,43 @@
+import argparse
+import os
+
+from rana_logger import backfill_timestamps, get_videos_missing_timestamps, setup
+
+
+def main(arguments):
+    # Setup database tables
+    setup()
+
+    videos = get_videos_missing_timestamps()
+    if arguments["directory"]:
+        directory = os.path.normpath(arguments["directory"])
+        videos = [video for video in videos if os.path.normpath(video.directory) == directory]
+    if arguments["video"]:
+        videos = [video for video in videos if video.video == arguments["video"]]
+    print("[*] Filling in the timestamps of the log entries and visitors of {} videos...".format(len(videos)))
+
+    total_entries = 0
+    total_visitors = 0
+    for video in videos:
+        entries, visitors = backfill_timestamps(video)
+        if entries or visitors:
+            print("[*] Filled in the timestamps of {} log entries and the dates of {} visitors of {}.".format(
+                entries, visitors, os.path.join(video.directory, video.video)))
+        total_entries += entries
+        total_visitors += visitors
+
+    print("[*] Filled in the timestamps of {} log entries and the dates of {} visitors.".format(total_entries,
+                                                                                              total_visitors))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Fills in the timestamps of the log entries and the dates of the "
+                                             "discrete visitors recorded before the frame times of their videos "
+                                             "were processed. Only rows without a timestamp are updated.")
+    ap.add_argument("-d", "--directory", type=str, default=None,
+                    help="only fill in the timestamps of videos in this directory, as it was given to frame_times")
+    ap.add_argument("-v", "--video", type=str, default=None,
+                    help="only fill in the timestamps of videos with this file name")
+    args = vars(ap.parse_args())
+
+    main(args)
@@ -0,0 +1,48 @@
+import argparse
+import timeit
+
+import cv2
+import numpy as np
+
+from utils import match_digits, process_reference_digits
+
+
+def match_template(rois, digits):
+    """
+    Classifies digit ROIs with one cv2.matchTemplate call per ROI and
+    reference digit, as classify_digits did before match_digits.
+    """
+    labels = []
+    for roi in rois:
+        scores = [cv2.minMaxLoc(cv2.matchTemplate(roi, digit_roi, cv2.TM_CCOEFF))[1] for digit_roi in digits.values()]
+        labels.append(str(np.argmax(scores)))
+    return labels
+
+
+def main(arguments):
+    reference_digits = process_reference_digits()
+    rng = np.random.RandomState(arguments["seed"])
+    rois = [(rng.rand(88, 57, 3) * 255).astype(np.uint8) for _ in range(arguments["rois"])]
+
+    mismatches = sum(a != b for a, b in zip(match_template(rois, reference_digits.digits),
+                                            match_digits(rois, reference_digits.templates)))
+    print("[*] Classified {} digit ROIs, {} of which differ between the two methods.".format(len(rois), mismatches))
+
+    for name, classify in (("matchTemplate", lambda: match_template(rois, reference_digits.digits)),
+                           ("match_digits", lambda: match_digits(rois, reference_digits.templates))):
+        best = min(timeit.repeat(classify, number=1, repeat=arguments["repeat"]))
+        print("[*] {}: {:.2f} ms per call, {:.1f} us per ROI".format(name, best * 1000, best * 1e6 / len(rois)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Times the classification of digit ROIs by match_digits against one "
+                                             "cv2.matchTemplate call per ROI and reference digit.")
+    ap.add_argument("-n", "--rois", type=int, default=14,
+                    help="number of digit ROIs classified per call. A timestamp has 14 digits")
+    ap.add_argument("-r", "--repeat", type=int, default=200,
+                    help="number of timed calls, of which the fastest is reported")
+    ap.add_argument("--seed", type=int, default=0,
+                    help="seed of the random ROIs")
+    args = vars(ap.parse_args())
+
+    main(args)
@@ -0,0 +1,129 @@
+import argparse
+import os
+import time
+
+from rana_logger import setup, get_video_frame_counts, get_video_stats, populate_video_table, set_video_metadata
+from utils import fingerprint_video, get_video_list, probe_video
+
+
+def main(arguments):
+    # Setup database tables
+    setup()
+
+    video_list = get_video_list(arguments["video_path"], shuffle=False)
+    sync_catalog(video_list, force=arguments["force"])
+
+
+def sync_catalog(video_list, force=False):
+    """
+    Syncs the Video table with the videos found on disk and probes the
+    metadata and fingerprint of the new videos and of the videos whose
+    file changed since they were last probed. A file counts as changed when its size
+    or modification time differs from the recorded one, so unchanged
+    videos cost a single stat on later runs.
+    :param video_list: List of Video(directory, files) tuples from
+    get_video_list.
+    :param force: Whether to probe every video again.
+    :return: The number of probed videos.
+    """
+    populate_video_table(video_list)
+
+    print("[*] Probing new and changed videos...")
+    start = time.time()
+    stats = get_video_stats(video_list)
+    rows = []
+    total_size = 0
+    for vdir in video_list:
+        for video in vdir.files:
+            path = os.path.join(vdir.directory, video)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                print("[!] Unable to stat video {}: {}".format(path, e))
+                continue
+            total_size += stat.st_size
+
+            video_id, size, mtime, fingerprint = stats[(vdir.directory, video)]
+            if not force and fingerprint is not None and size == stat.st_size and mtime == stat.st_mtime:
+                continue
+
+            metadata = probe_video(path)
+            if metadata["codec"] is None:
+                print("[!] Unable to probe video {}.".format(path))
+            try:
+                fingerprint = fingerprint_video(path)
+            except (IOError, OSError) as e:
+                print("[!] Unable to fingerprint video {}: {}".format(path, e))
+                continue
+            metadata.update(id=video_id, size=stat.st_size, mtime=stat.st_mtime, fingerprint=fingerprint)
+            rows.append(metadata)
+
+    set_video_metadata(rows)
+
+    frame_counts = get_video_frame_counts()
+    total_frames = sum(frame_counts.get((vdir.directory, video), 0) for vdir in video_list for video in vdir.files)
+    video_count = sum(len(vdir.files) for vdir in video_list)
+    print("[*] Probed {} of {} videos in {:.1f}s. The videos hold {:.1f} GB and {} frames.".format(
+        len(rows), video_count, time.time() - start, total_size / (1024.0 ** 3), total_frames))
+    return len(rows)
+
+
+def order_longest_first(video_list):
+    """
+    Orders the videos by their total frame count, longest first, so
+    that the longest jobs are started first and don't hold up the end of
+    a run. Videos of the same length keep their order.
+    :param video_list: List of Video(directory, files) tuples.
+    :return: A list of (Video(directory, files), video) tuples.
+    """
+    frame_counts = get_video_frame_counts()
+    videos = [(vdir, video) for vdir in video_list for video in vdir.files]
+    return sorted(videos, key=lambda item: -frame_counts.get((item[0].directory, item[1]), 0))
+
+
+class CopyFilter(object):
+    """
+    Skips the copies of a video within a run. Of the listed videos that
+    share a fingerprint, e.g. the same clip in several sites'
+    directories, only the one added to the catalog first is let through,
+    whatever order the videos are processed in, so that frame_times,
+    motion and the classifier all process the same copy. Videos without
+    a fingerprint are never copies.
+    """
+
+    def __init__(self, video_list):
+        """
+        :param video_list: List of Video(directory, files) tuples of the
+        run.
+        """
+        self.fingerprints = {}
+        self.originals = {}
+        stats = get_video_stats(video_list)
+        for key, (video_id, _, _, fingerprint) in sorted(stats.items(), key=lambda item: item[1][0]):
+            self.fingerprints[key] = fingerprint
+            if fingerprint is not None:
+                self.originals.setdefault(fingerprint, key)
+
+    def is_copy(self, directory, video):
+        fingerprint = self.fingerprints.get((directory, video))
+        if fingerprint is None:
+            return False
+        original = self.originals[fingerprint]
+        if original != (directory, video):
+            print("[*] Video {} is a copy of {}. Skipping...".format(os.path.join(directory, video),
+                                                                     os.path.join(*original)))
+            return True
+        return False
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Catalogs the videos in a directory along with their size, codec, "
+                                             "frame rate, resolution and frame count. Only new and changed videos "
+                                             "are probed.")
+    ap.add_argument("-v", "--video-path", type=str, required=True,
+                    help="path to directory containing video files")
+    ap.add_argument("-f", "--force", action="store_true",
+                    help="probe every video again, even if its file hasn't changed")
+    args = vars(ap.parse_args())
+
+    main(args)
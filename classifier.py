@@ -1,137 +1,139 @@
+import argparse
 import cv2
 import os
-import time
 
-import numpy as np
-from imutils.video import FileVideoStream
-
-from rana_logger import add_log_entry, get_last_frame, setup, populate_video_table, \
-    get_processed_videos, add_processed_video
+from catalog import CopyFilter, sync_catalog
+from frame_reader import FrameReader
+from image_writer import ImageWriter, CODEC_PARAMS
+from rana_logger import add_log_entry, backfill_timestamps, get_last_frame, setup, \
+    get_processed_videos, add_processed_video, get_motion_intervals, get_video, set_log_entry_image, DatabaseWriter
 from utils import get_video_list, manual_selection, get_filename, get_path_input, \
-    pollinator_setup, handle_pollinator, determine_site_preference
+    pollinator_setup, handle_pollinator, determine_site_preference, FrameHistory
 
 
-def handle_previous_frames(frame, previous_frames):
+def get_frame_ranges(vdir, video, start_frame, motion=False):
     """
-    Maintains and returns a list of up to the previous 200 frames
-    which also includes the most recent/current frame.
-    :param frame: Current frame.
-    :param previous_frames: The current list of previous frames.
-    :return: A list of at most 200 previous frames including the most
-    recent/current frame.
+    Determines the ranges of frames of a video shown to the user.
+    :param start_frame: Number of frames already analyzed, or None.
+    :param motion: Whether to only show the motion intervals of the
+    video found by motion.py, along with the frames sampled from the
+    stretches without motion. Every frame is shown when the motion of
+    the video hasn't been processed.
+    :return: A list of (start_frame, end_frame) tuples in the form
+    taken by FrameReader.
     """
-    if len(previous_frames) >= 200:
-        # Remove the oldest frame
-        previous_frames.pop()
+    intervals = get_motion_intervals(get_video(vdir.directory, video)) if motion else None
+    if intervals is None:
+        if motion:
+            print("[!] Motion of {} hasn't been processed. Showing every frame...".format(video))
+        return [(start_frame, None)]
 
-    # Add the current frame
-    previous_frames.insert(0, frame)
-    return previous_frames
+    start_frame = start_frame or 0
+    ranges = [(max(interval.start_frame - 1, start_frame), interval.end_frame) for interval in intervals
+              if interval.end_frame > start_frame]
+    print("[*] Showing {} frames in {} intervals with motion or sampled without motion.".format(
+        sum(end - start for start, end in ranges), len(ranges)))
+    return ranges
 
 
-def calculate_frame_number(labeled_frame, previous_frames, f_num):
+def read_frames(path, ranges):
     """
-    Calculates the frame number the user labeled.
-    :param labeled_frame: The frame labeled by the user.
-    :param previous_frames: The list of at most the 200 previous
-    frames including the most recent/current frame.
-    :param f_num: The current frame number from the video stream.
-    :return calc_fnum: An integer value indicating the frame number
-    that was labeled by the user.
+    Yields the (frame_number, frame) tuples of the given ranges of
+    frames of a video. All ranges are read by one FrameReader, which
+    grabs through short gaps between ranges and seeks over long ones
+    rather than decoding the frames in between.
     """
-    # Reverse the order of previous frames so recent frames are
-    # located at the beginning of the list, allowing for list indexes
-    # to be used to calculate the labeled frame number as an offset
-    # of the current frame number.
-    frame_idx = [np.array_equal(labeled_frame, frame) for frame in previous_frames].index(True)
-    fnum_calc = f_num - frame_idx
-    return fnum_calc
+    reader = FrameReader(path, ranges=ranges)
+    reader.start()
+    try:
+        while True:
+            # Blocks until the next frame is decoded
+            item = reader.read()
+            if item is None:
+                break
+            yield item
+    finally:
+        reader.stop()
+    print("[*] {}".format(reader.summary()))
 
 
 def process_video(arguments, vdir, video, site, plant):
     print("[*] Analyzing video {} from site {}, plant number {}.".format(video, site, plant))
-    last_log = get_last_frame(video)
-
-    vs = FileVideoStream(os.path.join(vdir.directory, video)).start()
-
-    # The current frame number and pollinator count
-    f_num = 0
+    # The previous video's log entries are read back when resuming
+    db_writer = arguments["db_writer"]
+    db_writer.flush()
+    last_log = get_last_frame(vdir.directory, video)
+
+    # When resuming, the frames that have already been analyzed are seeked past before decoding starts
+    ranges = get_frame_ranges(vdir, video, last_log.frame if last_log is not None else None,
+                              motion=arguments["motion"])
+    # The pollinator count
     count = 0
+    image_writer = arguments["image_writer"]
 
-    # Allow the buffer some time to fill
-    time.sleep(2.0)
-
-    # Keep a list of previous frames
-    previous_frames = []
-
-    while vs.more():
-        frame = vs.read()
-
-        # If the frame is None, the video is done being processed and we can move to the next one
-        if frame is None:
-            break
-        else:
-            f_num += 1
-            if last_log is not None and f_num <= last_log.frame:
-                print("[*] Frame number {} has already been analyzed. Waiting for frame number {}..."
-                      .format(f_num, last_log.frame + 1))
-                # Continue to the next frame if the logs indicate we have analyzed frames later than this
-                # one
-                time.sleep(0.01)  # Sleep here so we don't overtake the buffer
-                continue
+    # Keep the previous frames so the user can rewind
+    history = FrameHistory(depth=arguments["history_depth"], memory_mb=arguments["history_memory_mb"])
 
+    # Once there are no frames left, the video is done being processed and we can move to the next one
+    for f_num, frame in read_frames(os.path.join(vdir.directory, video), ranges):
         """
         Because previous frames are passed to manual selection,
         the pollinator selection may not have occurred on the
         current frame. Therefore, the frame number used for
-        file names and logging will need to be calculated.
+        file names and logging is returned along with the
+        labeled frame.
         """
-        previous_frames = handle_previous_frames(frame, previous_frames)
-        pollinator, box, labeled_frame = manual_selection(f_num, previous_frames, site, plant, video)
+        history.add(frame, f_num)
+        pollinator, box, labeled_frame, fnum_calc = manual_selection(history, site, plant, video)
         if pollinator is None and box is None and labeled_frame is None:
             continue
 
-        fnum_calc = calculate_frame_number(labeled_frame, previous_frames, f_num)
         frame_fname = get_filename(fnum_calc, count, video, frame=True)
         if pollinator is not False and pollinator is not None:
             # Save the whole frame as a pollinator
             print("[*] Saving frame as an example of Pollinator.")
-            cv2.imwrite(os.path.join(arguments["write_path"], "Frames", "Pollinator", frame_fname),
-                        labeled_frame)
+            image_writer.write(os.path.join(arguments["write_path"], "Frames", "Pollinator", frame_fname),
+                               labeled_frame)
 
             # And save the pollinator
             pol_fname = get_filename(fnum_calc, count, video)
             count = handle_pollinator(arguments, pol_fname, vdir, count, fnum_calc, pollinator, box, video,
                                       labeled_frame)
+            # Keep the annotated frame so the selection is shown when rewinding to it
+            history.pin(fnum_calc, labeled_frame)
 
         elif pollinator is False and box is None:
             # Save the whole frame as an example of no pollinator
             print("[*] Saving frame as an example of Not_Pollinator.")
             img_path = os.path.join(arguments["write_path"], "Frames", "Not_Pollinator", frame_fname)
-            cv2.imwrite(img_path, labeled_frame)
             w, h, _ = frame.shape
             size = w * h
             print("[*] Logging this frame as Not_Pollinator.")
-            add_log_entry(directory=vdir.directory,
-                          video=video,
-                          time=None,
-                          classification="Not_Pollinator",
-                          pollinator_id=None,
-                          proba=None,
-                          genus=None,
-                          species=None,
-                          behavior=None,
-                          size=size,
-                          bbox="Whole",  # Entire frame
-                          size_class=None,
-                          frame_number=fnum_calc,
-                          manual=True,
-                          img_path=img_path,
-                          )
-
-    # Video is done being processed
-    add_processed_video(video, pollinator=True)
-    vs.stop()
+            entry = db_writer.submit(add_log_entry,
+                                     directory=vdir.directory,
+                                     video=video,
+                                     time=None,
+                                     classification="Not_Pollinator",
+                                     pollinator_id=None,
+                                     proba=None,
+                                     genus=None,
+                                     species=None,
+                                     behavior=None,
+                                     size=size,
+                                     bbox="Whole",  # Entire frame
+                                     size_class=None,
+                                     frame_number=fnum_calc,
+                                     manual=True,
+                                     )
+            # The path of the image is recorded once the image is written
+            image_writer.write(img_path, labeled_frame,
+                               callback=lambda path, entry=entry: db_writer.submit(set_log_entry_image, entry, path))
+
+    # Video is done being processed once its images are written
+    image_writer.flush()
+    db_writer.submit(add_processed_video, vdir.directory, video, pollinator=True)
+    # Fill in the timestamps of the log entries of the video whose frame times are already processed
+    db_writer.submit(backfill_timestamps, get_video(vdir.directory, video))
 
 
 cv2.destroyAllWindows()
@@ -145,9 +147,12 @@ def main(arguments):
         print("[!] No videos found in path: {}".format(arguments["video_path"]))
 
     site_pref = determine_site_preference(video_list)
-    populate_video_table(video_list)
+    sync_catalog(video_list)
 
     processed_videos = get_processed_videos(pollinator=True)
+    # The copies are picked among the videos of the site the user is working on
+    copies = CopyFilter([vdir for vdir in video_list
+                         if not site_pref or vdir.directory.split(os.path.sep)[-2:][0] == site_pref])
 
     for vdir in video_list:
         split = vdir.directory.split(os.path.sep)[-2:]  # Extract site and plant info from directory path
@@ -159,16 +164,50 @@ def main(arguments):
             continue
         plant = split[1]
         for video in vdir.files:
-            if video in processed_videos:
+            if (vdir.directory, video) in processed_videos:
                 print("[*] Video has been fully processed. Skipping...")
                 continue
+            elif copies.is_copy(vdir.directory, video):
+                continue
             else:
                 process_video(arguments, vdir, video, site, plant)
 
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--history-depth", type=int, default=2000,
+                    help="maximum number of previous frames kept to rewind through")
+    ap.add_argument("-m", "--history-memory-mb", type=int, default=512,
+                    help="maximum memory in MB taken up by the previous frames. The oldest frames are dropped "
+                         "first when there are too many to fit")
+    ap.add_argument("--motion", action="store_true",
+                    help="only show the frames with motion found by motion.py, along with the frames it sampled "
+                         "from the stretches without motion")
+    ap.add_argument("--image-codec", type=str, default=".png", choices=sorted(CODEC_PARAMS),
+                    help="format the images are saved in")
+    ap.add_argument("--image-level", type=int, default=None,
+                    help="compression level of PNG images (0-9) or quality of JPEG and WebP images (0-100)")
+    ap.add_argument("--image-threads", type=int, default=2,
+                    help="number of threads saving images in the background")
+    options = vars(ap.parse_args())
+
     # Setup the database file
     setup()
     # Create a dictionary to store video and image path info
     args = get_path_input()
-    main(args)
+    args.update(options)
+
+    # Images are saved in the background. Those still queued are saved before exiting, including when the user
+    # quits with `q`.
+    args["image_writer"] = ImageWriter(threads=options["image_threads"], codec=options["image_codec"],
+                                       level=options["image_level"]).start()
+    # Log entries and visitors are written to the database in the background as well
+    args["db_writer"] = DatabaseWriter().start()
+    try:
+        main(args)
+    finally:
+        # The image writer records the paths of the images it writes through the database writer
+        args["image_writer"].close()
+        args["db_writer"].close()
+        print("[*] {}".format(args["image_writer"].summary()))
+        print("[*] {}".format(args["db_writer"].summary()))
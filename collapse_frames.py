@@ -0,0 +1,38 @@
+import argparse
+
+from rana_logger import collapse_frames, get_frame_videos, setup, vacuum
+
+
+def main(arguments):
+    # Setup database tables
+    setup()
+
+    videos = get_frame_videos()
+    print("[*] Collapsing the Frame rows of {} videos into timestamp segments...".format(len(videos)))
+
+    total_frames = 0
+    total_segments = 0
+    for directory, video in videos:
+        frames, segments = collapse_frames(directory, video, delete=arguments["delete"])
+        print("[*] Collapsed {} frames of {} into {} segments.".format(frames, video, segments))
+        total_frames += frames
+        total_segments += segments
+
+    print("[*] Collapsed {} frames into {} segments ({:.1f} frames per segment).".format(
+        total_frames, total_segments, total_frames / max(total_segments, 1)))
+
+    if arguments["delete"] and arguments["vacuum"]:
+        print("[*] Reclaiming the space of the deleted frames...")
+        vacuum()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Collapses the per-frame rows of the Frame table into the "
+                                             "TimestampSegment table.")
+    ap.add_argument("-d", "--delete", action="store_true",
+                    help="delete the Frame rows of each video once its segments are written")
+    ap.add_argument("--vacuum", action="store_true",
+                    help="rebuild the database file after deleting frames to reclaim their space")
+    args = vars(ap.parse_args())
+
+    main(args)
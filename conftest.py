@@ -0,0 +1,26 @@
+import pytest
+
+from rana_logger import DB_TIMEOUT, close_connection, db, get_db_pragmas, setup
+
+
+@pytest.fixture
+def empty_database(tmp_path):
+    """
+    Points the database at an empty file for the duration of a test.
+    """
+    original = db.database
+    close_connection()
+    db.init(str(tmp_path / "log.db"), pragmas=get_db_pragmas(), timeout=DB_TIMEOUT)
+    yield db
+    close_connection()
+    db.init(original, pragmas=get_db_pragmas(), timeout=DB_TIMEOUT)
+
+
+@pytest.fixture
+def database(empty_database):
+    """
+    Points the database at an empty file for the duration of a test,
+    with the tables created by setup().
+    """
+    setup()
+    return empty_database
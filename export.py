@@ -0,0 +1,252 @@
+import argparse
+import csv
+import gzip
+import os
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+from peewee import fn
+
+from rana_logger import DiscreteVisitor, Frame, LogEntry, TimestampSegment, Video, db, setup
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Only needed to export Parquet files
+    pa = None
+    pq = None
+
+TABLES = ["log_entries", "visitors", "frame_times", "visit_summary"]
+
+
+def main(arguments):
+    if arguments["format"] == "parquet" and pa is None:
+        print("[!] Exporting Parquet files requires pyarrow. Install it with `pip install pyarrow`, or export CSV "
+              "files instead.")
+        return
+
+    # Setup database tables
+    setup()
+
+    if not os.path.exists(arguments["output_path"]):
+        os.makedirs(arguments["output_path"])
+
+    filters = {"site": arguments["site"],
+               "plant": arguments["plant"],
+               "start_date": arguments["start_date"],
+               "end_date": arguments["end_date"]}
+    for table in arguments["tables"] or TABLES:
+        columns, queries = EXPORTS[table](**filters)
+        extension = ".parquet" if arguments["format"] == "parquet" else ".csv.gz" if arguments["compress"] else ".csv"
+        path = os.path.join(arguments["output_path"], table + extension)
+
+        print("[*] Exporting {} to {}...".format(table, path))
+        start = time.time()
+        if arguments["format"] == "parquet":
+            rows = (row for query in queries for row in query.tuples().iterator())
+            count = write_parquet(path, columns, rows, arguments["chunk_rows"])
+        else:
+            # The rows are streamed from the cursor as they are stored, skipping the conversion of each value
+            # to a Python type, since they are written as text anyway
+            rows = (row for query in queries for row in db.execute(query))
+            count = write_csv(path, columns, rows, arguments["chunk_rows"], compress=arguments["compress"])
+        print("[*] Exported {} rows of {} in {:.1f}s.".format(count, table, time.time() - start))
+
+
+def filter_videos(query, site=None, plant=None):
+    if site is not None:
+        query = query.where(Video.site == site)
+    if plant is not None:
+        query = query.where(Video.plant == plant)
+    return query
+
+
+def filter_dates(query, column, start_date=None, end_date=None):
+    """
+    Limits a query to the rows whose date or time column falls within
+    a range of days. Rows without a date are left out when a range is
+    given.
+    :param column: The DateField or DateTimeField to filter on.
+    :param start_date: Optional first day of the range.
+    :param end_date: Optional last day of the range, inclusive.
+    """
+    if start_date is not None:
+        query = query.where(column >= start_date)
+    if end_date is not None:
+        # The times of the last day are later than the day itself
+        query = query.where(column < end_date + timedelta(days=1))
+    return query
+
+
+def export_log_entries(site=None, plant=None, start_date=None, end_date=None):
+    """
+    Returns the columns and query of the log entries along with the
+    site and plant of their video.
+    """
+    columns = [("site", "str"), ("plant", "str"), ("directory", "str"), ("video", "str"), ("frame", "int"),
+               ("timestamp", "datetime"), ("classification", "str"), ("pol_id", "str"), ("genus", "str"),
+               ("species", "str"), ("behavior", "str"), ("size", "float"), ("size_class", "str"), ("bbox", "str"),
+               ("probability", "float"), ("manual", "bool"), ("img_path", "str")]
+    query = (LogEntry
+             .select(Video.site, Video.plant, LogEntry.directory, LogEntry.video, LogEntry.frame, LogEntry.timestamp,
+                     LogEntry.classification, LogEntry.pol_id, LogEntry.genus, LogEntry.species, LogEntry.behavior,
+                     LogEntry.size, LogEntry.size_class, LogEntry.bbox, LogEntry.probability, LogEntry.manual,
+                     LogEntry.img_path)
+             .join(Video, on=((LogEntry.directory == Video.directory) & (LogEntry.video == Video.video)))
+             .order_by(LogEntry.id))
+    query = filter_dates(filter_videos(query, site, plant), LogEntry.timestamp, start_date, end_date)
+    return columns, [query]
+
+
+def export_visitors(site=None, plant=None, start_date=None, end_date=None):
+    """
+    Returns the columns and query of the discrete visitors along with
+    the site, plant and file of their video.
+    """
+    columns = [("site", "str"), ("plant", "str"), ("directory", "str"), ("video", "str"), ("date", "date"),
+               ("pol_id", "str"), ("behavior", "str"), ("size", "str"), ("num_visits", "int"),
+               ("recent_frame", "int"), ("ppt_slide", "int"), ("notes", "str")]
+    query = (DiscreteVisitor
+             .select(Video.site, Video.plant, Video.directory, Video.video, DiscreteVisitor.date,
+                     DiscreteVisitor.pol_id, DiscreteVisitor.behavior, DiscreteVisitor.size,
+                     DiscreteVisitor.num_visits, DiscreteVisitor.recent_frame, DiscreteVisitor.ppt_slide,
+                     DiscreteVisitor.notes)
+             .join(Video)
+             .order_by(DiscreteVisitor.id))
+    query = filter_dates(filter_videos(query, site, plant), DiscreteVisitor.date, start_date, end_date)
+    return columns, [query]
+
+
+def export_frame_times(site=None, plant=None, start_date=None, end_date=None):
+    """
+    Returns the columns and queries of the frame times, one row per
+    run of frames showing the same time. The per-frame rows of videos
+    processed before segments were introduced are exported as runs of a
+    single frame.
+    """
+    columns = [("site", "str"), ("plant", "str"), ("directory", "str"), ("video", "str"), ("start_frame", "int"),
+               ("end_frame", "int"), ("timestamp", "datetime")]
+    segments = (TimestampSegment
+                .select(Video.site, Video.plant, Video.directory, Video.video, TimestampSegment.start_frame,
+                        TimestampSegment.end_frame, TimestampSegment.timestamp)
+                .join(Video)
+                .order_by(TimestampSegment.id))
+    frames = (Frame
+              .select(Video.site, Video.plant, Frame.directory, Frame.video, Frame.frame, Frame.frame,
+                      Frame.timestamp)
+              .join(Video, on=((Frame.directory == Video.directory) & (Frame.video == Video.video)))
+              .order_by(Frame.id))
+    queries = [filter_dates(filter_videos(query, site, plant), column, start_date, end_date)
+               for query, column in ((segments, TimestampSegment.timestamp), (frames, Frame.timestamp))]
+    return columns, queries
+
+
+def export_visit_summary(site=None, plant=None, start_date=None, end_date=None):
+    """
+    Returns the columns and query of the number of visits of each
+    pollinator per site, plant and day, along with the number of videos
+    they were seen in.
+    """
+    columns = [("site", "str"), ("plant", "str"), ("date", "date"), ("pol_id", "str"), ("visits", "int"),
+               ("videos", "int")]
+    query = (DiscreteVisitor
+             .select(Video.site, Video.plant, DiscreteVisitor.date, DiscreteVisitor.pol_id,
+                     fn.SUM(DiscreteVisitor.num_visits), fn.COUNT(fn.DISTINCT(Video.id)))
+             .join(Video)
+             .group_by(Video.site, Video.plant, DiscreteVisitor.date, DiscreteVisitor.pol_id)
+             .order_by(Video.site, Video.plant, DiscreteVisitor.date, DiscreteVisitor.pol_id))
+    query = filter_dates(filter_videos(query, site, plant), DiscreteVisitor.date, start_date, end_date)
+    return columns, [query]
+
+
+EXPORTS = {"log_entries": export_log_entries,
+           "visitors": export_visitors,
+           "frame_times": export_frame_times,
+           "visit_summary": export_visit_summary}
+
+
+def chunked_rows(rows, chunk_rows):
+    """
+    Groups rows into lists of up to `chunk_rows` rows, so that only a
+    single chunk is held in memory at a time.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_csv(path, columns, rows, chunk_rows=10000, compress=False):
+    """
+    Writes rows to a CSV file with a header row, one chunk at a time.
+    Missing values are written as empty fields, and booleans as 0 or 1.
+    :param columns: A list of (name, type) tuples.
+    :param compress: Whether to compress the file with gzip.
+    :return: The number of rows written.
+    """
+    count = 0
+    with (gzip.open(path, "wt", newline="") if compress else open(path, "w", newline="")) as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        for chunk in chunked_rows(rows, chunk_rows):
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
+
+
+def write_parquet(path, columns, rows, chunk_rows=10000):
+    """
+    Writes rows to a Parquet file, one row group per chunk.
+    :param columns: A list of (name, type) tuples.
+    :return: The number of rows written.
+    """
+    types = {"str": pa.string(),
+             "int": pa.int64(),
+             "float": pa.float64(),
+             "bool": pa.bool_(),
+             "date": pa.date32(),
+             "datetime": pa.timestamp("s")}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunked_rows(rows, chunk_rows):
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Exports the log entries, discrete visitors and frame times, along "
+                                             "with a summary of the visits per site, plant and day, to CSV or "
+                                             "Parquet files for analysis in R or pandas.")
+    ap.add_argument("-o", "--output-path", type=str, required=True,
+                    help="path to directory the files are written to")
+    ap.add_argument("-f", "--format", type=str, default="csv", choices=["csv", "parquet"],
+                    help="format of the files. Parquet files require pyarrow")
+    ap.add_argument("-z", "--compress", action="store_true",
+                    help="compress CSV files with gzip")
+    ap.add_argument("-t", "--tables", type=str, nargs="+", choices=TABLES,
+                    help="only export these tables")
+    ap.add_argument("-s", "--site", type=str, default=None,
+                    help="only export the data of this site")
+    ap.add_argument("-p", "--plant", type=str, default=None,
+                    help="only export the data of this plant")
+    ap.add_argument("--start-date", type=parse_date, default=None,
+                    help="only export the data from this day on (YYYY-MM-DD)")
+    ap.add_argument("--end-date", type=parse_date, default=None,
+                    help="only export the data up to and including this day (YYYY-MM-DD)")
+    ap.add_argument("-c", "--chunk-rows", type=int, default=10000,
+                    help="number of rows held in memory and written at a time")
+    args = vars(ap.parse_args())
+
+    main(args)
@@ -0,0 +1,249 @@
+import time
+from collections import deque
+from threading import Condition, Thread
+
+import cv2
+
+# Gaps of up to this many frames between the ranges read by a FrameReader are grabbed through rather than seeked
+# over. A seek decodes from the keyframe before the frame it lands on anyway, and keyframes are commonly up to 250
+# frames apart.
+SEEK_MIN_FRAMES = 250
+
+
+class FrameReader(object):
+    """
+    Decodes the frames of a video on a background thread into a queue
+    bounded by the memory the queued frames take up rather than by a
+    number of frames, so that many readers can run side by side without
+    swapping whatever the resolution of their videos.
+
+    Reads block until the next frame is decoded, and decoding blocks
+    while the queue is full, without any polling or sleeping. Each item
+    read is a (frame_number, frame) tuple with the absolute frame
+    number of the frame within the video, and None is read once the
+    video or the requested range of frames has ended.
+
+    Consumers that only need part of each frame can pass a region of
+    interest, in which case only copies of that region are queued.
+    Frames that aren't needed are skipped with grab(), which doesn't
+    convert them to BGR images.
+
+    Several ranges of frames of a video can be read in one go, in which
+    case the frames of each range follow those of the previous range in
+    the queue, and the frames in between are grabbed through or seeked
+    over, whichever is faster.
+    """
+
+    def __init__(self, path, memory_mb=64, stride=1, start_frame=None, end_frame=None, roi=None, ranges=None):
+        """
+        :param path: Path to the video file.
+        :param memory_mb: Maximum size in MB of the queued frames. A
+        single frame larger than this is still queued on its own.
+        :param stride: Only frames 1, 1 + stride, 1 + 2 * stride, ...
+        are decoded, counting from the first frame of the video so the
+        same frames are picked when reading is resumed.
+        :param start_frame: Optional number of frames to skip before
+        reading. See seek_to_frame.
+        :param end_frame: Optional last frame to read.
+        :param roi: Optional (y0, y1, x0, x1) region of each frame to
+        deliver instead of the whole frame.
+        :param ranges: Optional list of (start_frame, end_frame) tuples
+        of the ranges of frames to read, in the order they appear in the
+        video, instead of start_frame and end_frame.
+        """
+        self.capture = cv2.VideoCapture(path)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                           int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.stride = max(stride, 1)
+        # The ranges left to read, the first of which is being read
+        self.ranges = deque(ranges if ranges is not None else [(start_frame, end_frame)])
+        # No ranges at all means nothing is read
+        start_frame, self.end_frame = self.ranges[0] if self.ranges else (0, 0)
+        self.roi = roi
+
+        # Number of the last frame grabbed from the video
+        self.frame_number = seek_to_frame(self.capture, start_frame)
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.condition = Condition()
+        self.finished = False
+        self.stopped = False
+        self.thread = Thread(target=self.update)
+        self.thread.daemon = True
+
+        # Metrics
+        self.frames_read = 0
+        self.max_depth = 0
+        self.max_queued_bytes = 0
+        self.decoder_stalls = 0
+        self.decoder_wait = 0.0
+        self.reader_stalls = 0
+        self.reader_wait = 0.0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def update(self):
+        try:
+            while not self.stopped:
+                if self.at_end():
+                    if not self.next_range():
+                        break
+                    continue
+
+                # Skip to the next frame to decode
+                grabbed = True
+                while grabbed and self.frame_number % self.stride != 0 and not self.at_end():
+                    grabbed = self.capture.grab()
+                    self.frame_number += grabbed
+
+                if not grabbed:
+                    break
+                if self.at_end():
+                    continue
+
+                (grabbed, frame) = self.capture.read()
+                if not grabbed:
+                    break
+                self.frame_number += 1
+
+                if self.roi is not None:
+                    (y0, y1, x0, x1) = self.roi
+                    frame = frame[y0:y1, x0:x1].copy()
+                self.put(self.frame_number, frame)
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            self.capture.release()
+
+    def at_end(self):
+        return self.end_frame is not None and self.frame_number >= self.end_frame
+
+    def next_range(self):
+        """
+        Moves on to the next range of frames to read, skipping the frames
+        before it. Ranges that start before the current frame carry on
+        from it.
+        :return: False if there are no ranges left or the video ended
+        before the next range.
+        """
+        if self.ranges:
+            self.ranges.popleft()
+        if not self.ranges:
+            return False
+        start_frame, self.end_frame = self.ranges[0]
+        gap = (start_frame or 0) - self.frame_number
+        if gap > SEEK_MIN_FRAMES:
+            self.frame_number = seek_to_frame(self.capture, start_frame)
+            return self.frame_number == start_frame
+        while gap > 0:
+            if not self.capture.grab():
+                return False
+            self.frame_number += 1
+            gap -= 1
+        return True
+
+    def put(self, frame_number, frame):
+        with self.condition:
+            if self.is_full(frame):
+                self.decoder_stalls += 1
+                start = time.time()
+                while self.is_full(frame) and not self.stopped:
+                    self.condition.wait()
+                self.decoder_wait += time.time() - start
+
+            if self.stopped:
+                return
+            self.frames.append((frame_number, frame))
+            self.queued_bytes += frame.nbytes
+            self.max_depth = max(self.max_depth, len(self.frames))
+            self.max_queued_bytes = max(self.max_queued_bytes, self.queued_bytes)
+            self.condition.notify_all()
+
+    def is_full(self, frame):
+        return len(self.frames) > 0 and self.queued_bytes + frame.nbytes > self.memory_limit
+
+    def read(self):
+        """
+        Returns the next (frame_number, frame) tuple, blocking until it
+        is decoded, or None once there are no frames left.
+        """
+        with self.condition:
+            if not self.frames and not self.finished:
+                self.reader_stalls += 1
+                start = time.time()
+                while not self.frames and not self.finished:
+                    self.condition.wait()
+                self.reader_wait += time.time() - start
+
+            if not self.frames:
+                return None
+            frame_number, frame = self.frames.popleft()
+            self.queued_bytes -= frame.nbytes
+            self.frames_read += 1
+            self.condition.notify_all()
+            return frame_number, frame
+
+    def depth(self):
+        """
+        Returns the number of frames currently queued.
+        """
+        with self.condition:
+            return len(self.frames)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def summary(self):
+        return ("Read {} frames. The queue held up to {} frames ({:.1f} MB). Decoding waited {} times ({:.1f}s) "
+                "for room in the queue and reading waited {} times ({:.1f}s) for frames.").format(
+            self.frames_read, self.max_depth, self.max_queued_bytes / (1024.0 * 1024.0), self.decoder_stalls,
+            self.decoder_wait, self.reader_stalls, self.reader_wait)
+
+
+def seek_to_frame(capture, frame_number):
+    """
+    Positions a cv2.VideoCapture so that the next frame read is the
+    frame following `frame_number`, i.e. as if `frame_number` frames
+    had already been read from the start of the video.
+
+    The capture is first seeked directly with CAP_PROP_POS_FRAMES and
+    the reported position is checked afterwards. When the backend
+    lands before the requested frame (e.g. on the preceding keyframe),
+    the remaining frames are skipped with grab(), which advances the
+    stream without converting frames to BGR images. When the seek
+    fails or overshoots, the capture is rewound and every frame up to
+    the requested one is grabbed instead.
+    :param capture: An opened cv2.VideoCapture.
+    :param frame_number: The number of frames to skip.
+    :return: The number of frames actually skipped. This is less than
+    `frame_number` only if the video ended first.
+    """
+    if not frame_number or frame_number <= 0:
+        return 0
+
+    position = -1
+    if capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number):
+        position = int(capture.get(cv2.CAP_PROP_POS_FRAMES))
+
+    if position < 0 or position > frame_number:
+        print("[!] Unable to seek to frame {}. Skipping frames from the start of the video instead..."
+              .format(frame_number))
+        capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        position = 0
+
+    while position < frame_number:
+        if not capture.grab():
+            break
+        position += 1
+
+    print("[*] Resuming video at frame {}.".format(position + 1))
+    return position
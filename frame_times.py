@@ -1,95 +1,510 @@
 import argparse
+import heapq
 import os
+import signal
 import time
+from multiprocessing import Event, Pool, Queue as ProcessQueue
+from queue import Queue
+from threading import BoundedSemaphore, Thread
 
-from imutils.video import FileVideoStream
+import cv2
 
-from rana_logger import add_frame, get_last_processed_frame, setup, get_analyzed_videos, get_processed_videos, \
-    add_processed_video
-from utils import compute_frame_time, get_video_list, process_reference_digits
+from catalog import CopyFilter, order_longest_first, sync_catalog
+from rana_logger import SegmentWriter, get_last_processed_frame, setup, get_analyzed_videos, get_processed_videos, \
+    add_processed_video, add_frame_chunks, complete_frame_chunk, get_frame_chunks, get_video, set_video_fps, \
+    set_video_stride, close_connection, get_video_frame_counts, backfill_timestamps, get_video_copies, DatabaseWriter
+from frame_reader import FrameReader
+from utils import compute_frame_time, get_video_list, process_reference_digits, get_frame_count, get_timestamp_roi, \
+    get_native_timestamp_area, process_timestamp_area, TimestampTracker
+
+# Number of consecutive frames handed to an OCR thread at a time. Each thread keeps its own TimestampTracker,
+# so a block should span a few timestamp changes for the previous timestamp to be reused within it.
+OCR_BLOCK_FRAMES = 120
+
+# State of each worker process when videos are processed in parallel. It is set up once per process by
+# init_worker so the reference digits aren't recomputed for every video.
+worker_reference_digits = None
+worker_settings = None
+worker_stop_event = None
+worker_write_queue = None
 
 
 def main(arguments):
     # Setup database tables
     setup()
 
-    # The reference digits are computed based on a supplied reference photo
-    # We assume the reference photo contains all the digits 0-9 from left to right
-    reference_digits = process_reference_digits()
-
     # Is the timestamp in this video parsable yet?
     time_parsable = True
     ts_box = (1168, 246, 314, 73)
 
+    video_list = get_video_list(arguments["video_path"], shuffle=False)
+    sync_catalog(video_list)
+    frame_counts = get_video_frame_counts()
+
     analyzed_videos = get_analyzed_videos()
     processed_videos = get_processed_videos()
 
-    for vdir in get_video_list(arguments["video_path"]):
-        for video in vdir.files:
-            if video in processed_videos:
-                print("[*] Video has been fully processed. Skipping...")
-                continue
-            else:
-                process_video(analyzed_videos, reference_digits, time_parsable, ts_box, vdir, video)
+    # Each job is a whole video, or a chunk of frames of a long video. The longest videos are queued first.
+    jobs = []
+    copies = CopyFilter(video_list)
+    for vdir, video in order_longest_first(video_list):
+        if (vdir.directory, video) in processed_videos:
+            print("[*] Video has been fully processed. Skipping...")
+            continue
+        elif copies.is_copy(vdir.directory, video):
+            continue
+        else:
+            for chunk in plan_video_chunks(analyzed_videos, vdir, video, arguments["chunk_frames"],
+                                           frame_count=frame_counts.get((vdir.directory, video), 0)):
+                jobs.append((vdir, video, chunk))
 
+    settings = {"analyzed_videos": analyzed_videos,
+                "time_parsable": time_parsable,
+                "ts_box": ts_box,
+                "batch_size": arguments["batch_size"],
+                "flush_interval": arguments["flush_interval"],
+                "incremental": not arguments["full_ocr"],
+                "stride": arguments["stride"],
+                "ocr_threads": arguments["ocr_threads"],
+                "memory_mb": arguments["memory_mb"]}
 
-def process_video(analyzed_videos, reference_digits, time_parsable, ts_box, vdir, video):
-    print("[*] Processing video {} from {}".format(video, vdir.directory))
-    if video in analyzed_videos:
-        print("[*] Video has been processed. Checking if processing is complete...")
-        last_processed_frame = get_last_processed_frame(video)
-        print("[*] Last processed frame for this video is: ", last_processed_frame)
+    if arguments["workers"] > 1:
+        process_videos_in_parallel(jobs, arguments["workers"], settings)
     else:
-        last_processed_frame = None
+        # The reference digits are computed based on a supplied reference photo
+        # We assume the reference photo contains all the digits 0-9 from left to right
+        reference_digits = process_reference_digits()
 
-    vs = FileVideoStream(os.path.join(vdir.directory, video)).start()
+        for vdir, video, chunk in jobs:
+            process_video(settings["analyzed_videos"], reference_digits, time_parsable, ts_box, vdir, video,
+                          batch_size=settings["batch_size"], flush_interval=settings["flush_interval"], chunk=chunk,
+                          incremental=settings["incremental"], stride=settings["stride"],
+                          ocr_threads=settings["ocr_threads"], memory_mb=settings["memory_mb"])
 
-    # Reset frame number
-    f_num = 0
 
-    # Allow the buffer some time to fill
-    time.sleep(2.0)
+def init_worker(settings, stop_event, write_queue):
+    """
+    Prepares a worker process of the parallel processing pool. Each
+    worker computes its own reference digits and collapses its frames
+    into segments with its own batched SegmentWriter. Its writes are
+    sent over `write_queue` to the parent process, which commits the
+    writes of all workers from a single DatabaseWriter, so the workers
+    never wait on each other for the SQLite write lock.
 
-    while vs.more():
-        frame = vs.read()
+    Ctrl-C is ignored by the workers. The parent process sets
+    `stop_event` instead, which makes each worker flush its buffered
+    frames and stop at the next frame.
+    """
+    global worker_reference_digits, worker_settings, worker_stop_event, worker_write_queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Parallelism comes from the pool itself, so keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+    worker_reference_digits = process_reference_digits()
+    worker_settings = settings
+    worker_stop_event = stop_event
+    worker_write_queue = write_queue
 
-        f_num += 1
-        if (last_processed_frame is not None) and (f_num <= last_processed_frame):
-            print("[*] Current frame is {}. Waiting for {}...".format(f_num, last_processed_frame + 1))
-            # Give video buffer time to fill so we don't overtake it
-            time.sleep(0.01)
-            continue
+
+def submit_to_parent(func, *args):
+    """
+    Sends a write to the DatabaseWriter of the parent process. See
+    init_worker.
+    """
+    worker_write_queue.put((func, args))
+
+
+def write_now(func, *args):
+    """
+    Runs a database write right away. See process_video.
+    """
+    func(*args)
+
+
+def relay_writes(write_queue, db_writer):
+    """
+    Submits the writes the worker processes send over `write_queue` to
+    `db_writer` in the order they arrive, until None is received.
+    """
+    for func, args in iter(write_queue.get, None):
+        db_writer.submit(func, *args)
+
+
+def plan_video_chunks(analyzed_videos, vdir, video, chunk_frames, frame_count=0):
+    """
+    Determines the pieces of work needed to finish processing a video.
+    Videos that were already split into chunks resume only their
+    incomplete chunks. Videos that haven't been processed at all and
+    are longer than `chunk_frames` frames are split into chunks of
+    `chunk_frames` frames, where the last chunk runs until the end of
+    the video since the container's frame count may be inaccurate.
+    :param chunk_frames: Number of frames per chunk. Chunking is
+    disabled when this is 0 or None.
+    :param frame_count: The frame count of the video from the catalog.
+    The video is opened to count its frames when this is 0.
+    :return: A list of (chunk_id, start_frame, end_frame) tuples, or
+    [None] if the video is to be processed as a whole.
+    """
+    chunks = get_frame_chunks(vdir.directory, video)
+    if not chunks and chunk_frames and (vdir.directory, video) not in analyzed_videos:
+        frame_count = frame_count or get_frame_count(os.path.join(vdir.directory, video))
+        if frame_count > chunk_frames:
+            starts = range(1, frame_count + 1, chunk_frames)
+            ranges = [(start, start + chunk_frames - 1) for start in starts[:-1]] + [(starts[-1], None)]
+            print("[*] Splitting {} ({} frames) into {} chunks.".format(video, frame_count, len(ranges)))
+            chunks = add_frame_chunks(vdir.directory, video, ranges)
+
+    if not chunks:
+        return [None]
+
+    return [(chunk.id, chunk.start_frame, chunk.end_frame) for chunk in chunks if not chunk.completed]
+
+
+def process_video_job(job):
+    vdir, video, chunk = job
+    settings = worker_settings
+    frames = process_video(settings["analyzed_videos"], worker_reference_digits, settings["time_parsable"],
+                           settings["ts_box"], vdir, video, batch_size=settings["batch_size"],
+                           flush_interval=settings["flush_interval"], stop_event=worker_stop_event, chunk=chunk,
+                           incremental=settings["incremental"], stride=settings["stride"],
+                           ocr_threads=settings["ocr_threads"], memory_mb=settings["memory_mb"],
+                           submit=submit_to_parent)
+    return video, frames
+
+
+def process_videos_in_parallel(jobs, workers, settings):
+    """
+    Spreads the given jobs over a pool of worker processes and reports
+    the overall progress as jobs are completed.
+    :param jobs: List of (vdir, video, chunk) tuples for
+    process_video_job.
+    :param workers: Number of worker processes.
+    :param settings: Dictionary of processing settings shared by all
+    jobs.
+    """
+    print("[*] Processing {} jobs with {} worker processes...".format(len(jobs), workers))
+    stop_event = Event()
+    write_queue = ProcessQueue()
+    # The workers open their own database connections for reading
+    close_connection()
+    pool = Pool(processes=workers, initializer=init_worker, initargs=(settings, stop_event, write_queue))
+    # Every write of the workers is committed by this process
+    db_writer = DatabaseWriter().start()
+    relay = Thread(target=relay_writes, args=(write_queue, db_writer))
+    relay.start()
+    start = time.time()
+    completed = 0
+    total_frames = 0
+    try:
+        for video, frames in pool.imap_unordered(process_video_job, jobs):
+            completed += 1
+            total_frames += frames
+            elapsed = time.time() - start
+            print("[*] Finished a job of {}. Progress: {}/{} jobs, {} frames in {:.0f}s ({:.1f} frames/s)."
+                  .format(video, completed, len(jobs), total_frames, elapsed, total_frames / max(elapsed, 1e-6)))
+        pool.close()
+    except KeyboardInterrupt:
+        print("[!] Interrupted! Waiting for workers to save their buffered frames...")
+        stop_event.set()
+        pool.close()
+    finally:
+        pool.join()
+        # The workers are done, so the writes they sent are all queued
+        write_queue.put(None)
+        relay.join()
+        db_writer.close()
+        print("[*] {}".format(db_writer.summary()))
+
+
+def process_video(analyzed_videos, reference_digits, time_parsable, ts_box, vdir, video, batch_size=1000,
+                  flush_interval=10.0, stop_event=None, chunk=None, incremental=True, stride=1, ocr_threads=2,
+                  memory_mb=64, submit=None):
+    """
+    Extracts the timestamp of every frame in a video and stores them in
+    the TimestampSegment table, resuming after the last processed frame.
+
+    Frames flow through a pipeline of stages joined by bounded queues:
+    a FrameReader decodes the timestamp area of each frame, this thread
+    resizes them into blocks of consecutive frames, a pool of OCR
+    threads reads the times of the blocks, and a single writer thread
+    puts the blocks back in frame order and writes them to the
+    database. A stage that falls behind blocks the stages before it.
+    :param stop_event: Optional event that, when set, stops processing
+    after the current frame without marking the video as processed.
+    :param chunk: Optional (chunk_id, start_frame, end_frame) tuple
+    limiting processing to a range of frames. The video is marked as
+    processed once all of its chunks are completed.
+    :param incremental: Whether frames whose timestamp area hasn't
+    changed reuse the previous timestamp instead of being read again.
+    :param stride: Only frames 1, 1 + stride, 1 + 2 * stride, ... are
+    read and stored. The times of the frames in between are
+    interpolated when they are looked up. See get_time_of_frame.
+    :param ocr_threads: Number of threads reading timestamps.
+    :param memory_mb: Memory budget in MB of the decoded frames queued
+    by the FrameReader.
+    :param submit: Optional function the database writes are handed
+    to, along with their arguments, instead of being run right away.
+    See submit_to_parent.
+    :return: The number of frames processed in this call.
+    """
+    submit = submit or write_now
+
+    if chunk is not None:
+        chunk_id, first_frame, end_frame = chunk
+        print("[*] Processing frames {} to {} of video {} from {}".format(first_frame, end_frame or "the end",
+                                                                         video, vdir.directory))
+        last_processed_frame = get_last_processed_frame(vdir.directory, video, first_frame, end_frame)
+        print("[*] Last processed frame for this chunk is: ", last_processed_frame)
+        last_processed_frame = max(last_processed_frame or 0, first_frame - 1)
+    else:
+        end_frame = None
+        print("[*] Processing video {} from {}".format(video, vdir.directory))
+        if (vdir.directory, video) in analyzed_videos:
+            print("[*] Video has been processed. Checking if processing is complete...")
+            last_processed_frame = get_last_processed_frame(vdir.directory, video)
+            print("[*] Last processed frame for this video is: ", last_processed_frame)
         else:
+            last_processed_frame = None
+
+    # Seek past the frames that have already been processed before the reader starts decoding. The frame
+    # number picks up from wherever the seek landed.
+    reader = FrameReader(os.path.join(vdir.directory, video), memory_mb=memory_mb, stride=stride,
+                         start_frame=last_processed_frame, end_frame=end_frame)
+    f_num = reader.frame_number
+    start_frame = f_num
+    fps = reader.fps
+    submit(set_video_fps, vdir.directory, video, fps)
+    submit(set_video_stride, vdir.directory, video, stride)
+
+    # The timestamp area mapped to native frame coordinates. When the frame size is known up front, the reader
+    # only queues the timestamp area of each frame.
+    ts_roi = None
+    if time_parsable and all(reader.frame_size):
+        ts_roi = get_timestamp_roi(reader.frame_size, ts_box)
+        reader.roi = ts_roi.native
+    reader.start()
+
+    # Each OCR thread learns the positions of the timestamp digits so later frames can skip finding contours,
+    # and reuses the previous timestamp while the timestamp area doesn't change
+    trackers = [TimestampTracker(incremental=incremental, fps=fps) for _ in range(ocr_threads)]
+    ocr_queue = Queue(maxsize=ocr_threads)
+    result_queue = Queue()
+    # Limits the blocks that have been cropped but not yet written, including blocks waiting for an earlier
+    # block to be written
+    pending_blocks = BoundedSemaphore(4 * ocr_threads)
+    errors = []
+
+    try:
+        # Frames are collapsed into segments that are committed in batches. The writer is flushed when the
+        # `with` block exits, including on errors and Ctrl-C, so an interruption loses at most one batch of frames.
+        with SegmentWriter(get_video(vdir.directory, video), batch_size=batch_size, flush_interval=flush_interval,
+                           submit=submit) as writer:
+            threads = [Thread(target=read_frame_times, args=(reference_digits, tracker, ocr_queue, result_queue))
+                       for tracker in trackers]
+            threads.append(Thread(target=write_frame_times,
+                                  args=(writer, result_queue, ocr_threads, pending_blocks, errors)))
+            for thread in threads:
+                thread.start()
+
             try:
-                # Process the timestamp area in the video
-                frame_time, ts_box = compute_frame_time(frame, reference_digits, time_parsable, ts_box)
-            except AttributeError:
-                if frame is None:
-                    print("[!] Frame was none.")
-                    break
-                else:
+                f_num, stopped = dispatch_frame_blocks(reader, reference_digits, time_parsable, ts_box, ts_roi,
+                                                       video, f_num, ocr_queue, pending_blocks, stop_event, errors)
+            finally:
+                # Let the OCR threads finish the blocks they were given, and the writer write them
+                for _ in range(ocr_threads):
+                    ocr_queue.put(None)
+                for thread in threads:
+                    thread.join()
+
+        if errors:
+            raise errors[0]
+        submit(finish_video, vdir.directory, video, f_num, chunk_id if chunk is not None else None, stopped)
+    finally:
+        reader.stop()
+        print("[*] {}".format(reader.summary()))
+        for i, tracker in enumerate(trackers):
+            print("[*] OCR thread {}: {}".format(i + 1, tracker.summary()))
+
+    return f_num - start_frame
+
+
+def dispatch_frame_blocks(reader, reference_digits, time_parsable, ts_box, ts_roi, video, f_num, ocr_queue,
+                          pending_blocks, stop_event, errors):
+    """
+    Crop stage of process_video. Reads frames from the reader until the
+    end of the video or chunk, resizes their timestamp areas, and hands
+    them to the OCR threads in numbered blocks of consecutive frames.
+    :param ts_roi: The TimestampROI the reader crops frames to, or None
+    if the reader delivers whole frames.
+    :return: A tuple of the last frame processed and whether processing
+    was stopped early.
+    """
+    cropped = ts_roi is not None
+    block = []
+    index = 0
+    stopped = False
+    try:
+        while True:
+            if (stop_event is not None and stop_event.is_set()) or errors:
+                print("[!] Stopping {} at frame {}.".format(video, f_num))
+                stopped = True
+                break
+
+            # Blocks until the next frame is decoded
+            item = reader.read()
+            if item is None:
+                # Reached the end of the video or chunk. Count the frames skipped after the last frame that was
+                # read.
+                f_num = reader.frame_number
+                break
+
+            f_num, frame = item
+            if ts_roi is None:
+                if not time_parsable:
+                    # Ask the user where the timestamp is
+                    _, ts_box = compute_frame_time(frame, reference_digits, time_parsable, ts_box)
+                ts_roi = get_timestamp_roi(frame.shape, ts_box)
+
+            block.append((f_num, get_native_timestamp_area(frame, ts_roi, cropped=cropped)))
+            if len(block) == OCR_BLOCK_FRAMES:
+                pending_blocks.acquire()
+                ocr_queue.put((index, block))
+                index += 1
+                block = []
+    finally:
+        if block:
+            pending_blocks.acquire()
+            ocr_queue.put((index, block))
+
+    return f_num, stopped
+
+
+def finish_video(directory, video, last_frame, chunk_id=None, stopped=False):
+    """
+    Records the end of a run over a video or a chunk of it. The video is
+    marked as processed once all of its frames are, and the timestamps
+    of the frames that were labeled before their frame times were
+    processed are filled in, including those labeled in the copies of
+    the video.
+    :param last_frame: The last frame that was processed.
+    :param chunk_id: The id of the FrameChunk that was processed, if
+    only a chunk was.
+    :param stopped: Whether the run was stopped before the end of the
+    video or chunk.
+    """
+    if not stopped:
+        if chunk_id is None:
+            # Video done being processed
+            add_processed_video(directory, video, total_frames=last_frame)
+        elif complete_frame_chunk(chunk_id, directory, video, last_frame):
+            print("[*] All chunks of {} have been processed.".format(video))
+            add_processed_video(directory, video,
+                                total_frames=max(c.end_frame for c in get_frame_chunks(directory, video)))
+
+    entries = visitors = 0
+    for copy in get_video_copies(get_video(directory, video)):
+        filled = backfill_timestamps(copy)
+        entries += filled[0]
+        visitors += filled[1]
+    if entries or visitors:
+        print("[*] Filled in the timestamps of {} log entries and the dates of {} visitors.".format(entries,
+                                                                                                  visitors))
+
+
+def read_frame_times(reference_digits, tracker, ocr_queue, result_queue):
+    """
+    OCR stage of process_video. Reads the time of each frame of the
+    blocks taken from `ocr_queue` and puts the numbered results on
+    `result_queue` until a None block is taken. The blocks a thread
+    takes are in frame order, so its tracker sees the frames in order.
+    The result of a block that raised an error is the exception.
+    """
+    while True:
+        block = ocr_queue.get()
+        if block is None:
+            break
+
+        index, frames = block
+        try:
+            results = []
+            for f_num, timestamp_area in frames:
+                try:
+                    frame_time = process_timestamp_area(reference_digits, timestamp_area, tracker, f_num)
+                except AttributeError:
                     print("[!] Something went wrong. Skipping frame...")
                     continue
-            except ValueError as e:
-                print("[!] Error encountered while attempting to extract timestamp from frame:\n", e)
-                print("[!] Setting frame time to None and continuing...")
-                frame_time = None
+                except ValueError as e:
+                    print("[!] Error encountered while attempting to extract timestamp from frame:\n", e)
+                    print("[!] Setting frame time to None and continuing...")
+                    frame_time = None
+                results.append((f_num, frame_time))
+        except Exception as e:
+            results = e
+        result_queue.put((index, results))
 
-            # Add the frame information to the logging database
-            add_frame(directory=vdir,
-                      video=video,
-                      time=frame_time,
-                      frame_number=f_num)
+    result_queue.put(None)
+
+
+def write_frame_times(writer, result_queue, ocr_threads, pending_blocks, errors):
+    """
+    DB stage of process_video. Puts the blocks taken from
+    `result_queue` back in order and adds their frames to the
+    SegmentWriter, until all OCR threads have finished. Once a block
+    fails, the blocks after it aren't written, so the frames stored
+    never have gaps and processing resumes at the failed block.
+    :param errors: List the first error is appended to.
+    """
+    # Blocks that finished before an earlier block, ordered by block number
+    waiting = []
+    next_index = 0
+    finished = 0
+    try:
+        while finished < ocr_threads:
+            item = result_queue.get()
+            if item is None:
+                finished += 1
+                continue
 
-    # Video done being processed
-    add_processed_video(video=video, total_frames=f_num)
-    vs.stop()
+            heapq.heappush(waiting, item)
+            while waiting and waiting[0][0] == next_index:
+                _, results = heapq.heappop(waiting)
+                if isinstance(results, Exception) and not errors:
+                    errors.append(results)
+                if not errors:
+                    try:
+                        for f_num, frame_time in results:
+                            writer.add(time=frame_time, frame_number=f_num)
+                    except Exception as e:
+                        errors.append(e)
+                next_index += 1
+                pending_blocks.release()
+    finally:
+        # The segments written from this thread opened a connection of its own
+        close_connection()
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("-v", "--video-path", type=str, required=True,
                     help="path to directory containing video files")
+    ap.add_argument("-b", "--batch-size", type=int, default=1000,
+                    help="number of frames buffered before they are written to the database")
+    ap.add_argument("-f", "--flush-interval", type=float, default=10.0,
+                    help="maximum number of seconds buffered frames wait before being written to the database")
+    ap.add_argument("-w", "--workers", type=int, default=1,
+                    help="number of videos to process in parallel worker processes")
+    ap.add_argument("-c", "--chunk-frames", type=int, default=0,
+                    help="split unprocessed videos longer than this many frames into chunks that are processed "
+                         "independently (0 disables chunking)")
+    ap.add_argument("-t", "--ocr-threads", type=int, default=2,
+                    help="number of threads reading timestamps within each video")
+    ap.add_argument("-m", "--memory-mb", type=int, default=64,
+                    help="maximum memory in MB taken up by decoded frames waiting to be processed in each video")
+    ap.add_argument("-s", "--stride", type=int, default=1,
+                    help="only read and store the timestamp of every Nth frame. The times of the frames in between "
+                         "are interpolated from the stored frames and the frame rate")
+    ap.add_argument("--full-ocr", action="store_true",
+                    help="read the timestamp of every frame instead of reusing the previous timestamp for frames "
+                         "whose timestamp area hasn't changed")
     args = vars(ap.parse_args())
 
     main(args)
@@ -0,0 +1,197 @@
+import os
+import time
+from queue import Queue
+from threading import Lock, Thread, get_ident
+
+import cv2
+
+# Encoder parameter set by the compression level of each codec
+CODEC_PARAMS = {".png": cv2.IMWRITE_PNG_COMPRESSION,  # 0-9, higher is smaller and slower
+                ".jpg": cv2.IMWRITE_JPEG_QUALITY,  # 0-100, higher is larger and better
+                ".webp": cv2.IMWRITE_WEBP_QUALITY}  # 1-100, above 100 is lossless
+
+
+class ImageWriter(object):
+    """
+    Encodes and writes images on a pool of background threads, so that
+    saving a frame doesn't hold up the user, e.g. on a network-mounted
+    write path.
+
+    Images are queued in a bounded queue. Queuing an image blocks while
+    the queue is full, which bounds the memory taken up by the images
+    waiting to be written. Each image is written to a temporary file
+    that is synced to disk and then renamed over the destination, so
+    a destination file is either missing or complete. Writes that fail
+    with an OSError are retried with an increasing delay.
+
+    Once an image is written, the callback given with it is called on
+    the writer thread with the final path of the image, e.g. to record
+    the path in the database. Images that couldn't be written are
+    reported and their callback isn't called.
+    """
+
+    def __init__(self, threads=2, queue_size=8, codec=".png", level=None, retries=3, retry_delay=0.5):
+        """
+        :param threads: Number of writer threads.
+        :param queue_size: Maximum number of images waiting to be
+        written.
+        :param codec: File extension of the format images are written
+        in, one of CODEC_PARAMS. The extension of each path is replaced
+        with it.
+        :param level: Optional compression level or quality of the
+        codec. See CODEC_PARAMS.
+        :param retries: Number of times a failed write is retried.
+        :param retry_delay: Seconds waited before the first retry, which
+        doubles with each further retry.
+        """
+        codec = codec if codec.startswith(".") else "." + codec
+        if codec not in CODEC_PARAMS:
+            raise ValueError("Unsupported image codec {}. Choose one of {}.".format(codec, ", ".join(CODEC_PARAMS)))
+        self.codec = codec
+        self.params = [CODEC_PARAMS[codec], level] if level is not None else []
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.queue = Queue(maxsize=max(queue_size, 1))
+        self.threads = [Thread(target=self.update) for _ in range(max(threads, 1))]
+        for thread in self.threads:
+            thread.daemon = True
+        self.stopped = False
+
+        # Metrics
+        self.lock = Lock()
+        self.images_written = 0
+        self.bytes_written = 0
+        self.failures = 0
+        self.retried = 0
+        self.queue_stalls = 0
+        self.queue_wait = 0.0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def write(self, path, image, callback=None):
+        """
+        Queues an image to be written, blocking while the queue is full.
+        The image is copied, so it can be changed or reused right away.
+        :param path: Destination of the image. Its extension is replaced
+        with the extension of the codec.
+        :param image: The image to write.
+        :param callback: Optional function called with the final path
+        once the image is written.
+        :return: The final path of the image.
+        """
+        if self.stopped:
+            raise RuntimeError("Can't write {} since the image writer is closed.".format(path))
+        path = os.path.splitext(path)[0] + self.codec
+
+        item = (path, image.copy(), callback)
+        if self.queue.full():
+            start = time.time()
+            self.queue.put(item)
+            with self.lock:
+                self.queue_stalls += 1
+                self.queue_wait += time.time() - start
+        else:
+            self.queue.put(item)
+        return path
+
+    def update(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write_image(*item)
+            finally:
+                self.queue.task_done()
+
+    def write_image(self, path, image, callback):
+        encoded, buf = cv2.imencode(self.codec, image, self.params)
+        if not encoded:
+            print("[!] Unable to encode image {}.".format(path))
+            with self.lock:
+                self.failures += 1
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                write_durably(path, buf.tobytes())
+                break
+            except OSError as e:
+                if attempt == self.retries:
+                    print("[!] Unable to write image {} after {} attempts: {}".format(path, attempt + 1, e))
+                    with self.lock:
+                        self.failures += 1
+                    return
+                with self.lock:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        with self.lock:
+            self.images_written += 1
+            self.bytes_written += buf.nbytes
+
+        if callback is not None:
+            try:
+                callback(path)
+            except Exception as e:
+                print("[!] Unable to record image {}: {}".format(path, e))
+
+    def flush(self):
+        """
+        Blocks until every queued image is written and its callback has
+        returned.
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Writes the queued images and stops the writer threads.
+        """
+        if self.stopped:
+            return
+        self.flush()
+        self.stopped = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
+
+    def summary(self):
+        return ("Wrote {} images ({:.1f} MB) with {} retries and {} failures. Queuing waited {} times ({:.1f}s) "
+                "for room in the queue.").format(self.images_written, self.bytes_written / (1024.0 * 1024.0),
+                                                 self.retried, self.failures, self.queue_stalls, self.queue_wait)
+
+
+def write_durably(path, data):
+    """
+    Writes data to a file through a temporary file in the same
+    directory that is synced to disk and then renamed over the file, so
+    the file is never left partially written.
+    """
+    tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), get_ident())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if hasattr(os, "O_DIRECTORY"):
+        # Sync the directory so the rename itself survives a crash. Not every file system supports this.
+        try:
+            fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
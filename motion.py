@@ -0,0 +1,218 @@
+import argparse
+import os
+import random
+
+import cv2
+import numpy as np
+
+from frame_reader import FrameReader
+from catalog import CopyFilter, order_longest_first, sync_catalog
+from rana_logger import DEFAULT_FPS, setup, get_processed_videos, get_video, set_motion_intervals, set_video_fps
+from utils import get_video_list, get_timestamp_roi
+
+# Width frames are downscaled to before they are compared, which is plenty to see a pollinator move
+MOTION_WIDTH = 320
+
+
+class MotionDetector(object):
+    """
+    Scores the motion in each frame of a video by comparing the frame
+    to a running average of the previous frames, which adapts to slow
+    changes in lighting. The score is the fraction of pixels that
+    differ from the average by more than `pixel_threshold`.
+
+    Frames are downscaled, converted to grayscale and blurred before
+    they are compared to suppress sensor noise, and the timestamp area
+    is left out since it changes every second.
+    """
+
+    def __init__(self, frame_size, ts_roi=None, pixel_threshold=25, alpha=0.1):
+        """
+        :param frame_size: (height, width) of the frames of the video.
+        :param ts_roi: Optional TimestampROI of the timestamp area.
+        :param pixel_threshold: Minimum difference in gray level for a
+        pixel to count as changed.
+        :param alpha: Weight of each new frame in the running average.
+        """
+        (h, w) = frame_size
+        self.scale = MOTION_WIDTH / float(w)
+        self.size = (MOTION_WIDTH, max(int(h * self.scale), 1))
+        self.pixel_threshold = pixel_threshold
+        self.alpha = alpha
+        self.background = None
+
+        self.mask = np.full((self.size[1], self.size[0]), 255, dtype=np.uint8)
+        if ts_roi is not None:
+            (y0, y1, x0, x1) = [int(v * self.scale) for v in ts_roi.native]
+            self.mask[y0:y1 + 1, x0:x1 + 1] = 0
+        self.pixels = max(cv2.countNonZero(self.mask), 1)
+
+    def score(self, frame):
+        gray = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        if self.background is None:
+            self.background = gray.astype("float")
+            return 0.0
+
+        delta = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+        _, changed = cv2.threshold(delta, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        return cv2.countNonZero(cv2.bitwise_and(changed, self.mask)) / float(self.pixels)
+
+
+def main(arguments):
+    # Setup database tables
+    setup()
+
+    # The timestamp area, which is left out of the motion score. See frame_times.py.
+    ts_box = (1168, 246, 314, 73)
+
+    video_list = get_video_list(arguments["video_path"], shuffle=False)
+    sync_catalog(video_list)
+
+    processed_videos = get_processed_videos(motion=True)
+
+    copies = CopyFilter(video_list)
+    for vdir, video in order_longest_first(video_list):
+        if (vdir.directory, video) in processed_videos:
+            print("[*] Motion of video has been processed. Skipping...")
+            continue
+        if copies.is_copy(vdir.directory, video):
+            continue
+        process_video(vdir, video, ts_box, threshold=arguments["threshold"],
+                      pixel_threshold=arguments["pixel_threshold"], padding=arguments["padding"],
+                      stride=arguments["stride"], still_samples=arguments["still_samples"],
+                      seed=arguments["seed"], memory_mb=arguments["memory_mb"])
+
+
+def add_motion_frame(intervals, frame_number, score, padding):
+    """
+    Adds a frame with motion to a list of [start_frame, end_frame,
+    score] intervals ordered by frame. The frame is padded on both
+    sides and merged into the last interval when they overlap or touch.
+    """
+    start = max(frame_number - padding, 1)
+    end = frame_number + padding
+    if intervals and start <= intervals[-1][1] + 1:
+        intervals[-1][1] = end
+        intervals[-1][2] = max(intervals[-1][2], score)
+    else:
+        intervals.append([start, end, score])
+
+
+def sample_still_frames(intervals, last_frame, samples, seed):
+    """
+    Picks frames at random from the stretches of a video without motion,
+    so that Not_Pollinator examples aren't only drawn from frames with
+    motion. The same frames are picked for the same intervals and seed.
+    :param intervals: The (start_frame, end_frame, score) intervals of
+    the video ordered by frame.
+    :param last_frame: The last frame of the video.
+    :param samples: Number of frames to pick.
+    :param seed: Seed of the random number generator.
+    :return: A sorted list of frame numbers.
+    """
+    gaps = []
+    next_frame = 1
+    for start, end, _ in intervals:
+        if start > next_frame:
+            gaps.append((next_frame, start - 1))
+        next_frame = end + 1
+    if next_frame <= last_frame:
+        gaps.append((next_frame, last_frame))
+
+    still_count = sum(end - start + 1 for start, end in gaps)
+    picks = sorted(random.Random(seed).sample(range(still_count), min(samples, still_count)))
+
+    frames = []
+    offset = 0
+    for start, end in gaps:
+        while picks and picks[0] - offset <= end - start:
+            frames.append(start + picks.pop(0) - offset)
+        offset += end - start + 1
+    return frames
+
+
+def process_video(vdir, video_fname, ts_box, threshold=0.0005, pixel_threshold=25, padding=1.0, stride=1,
+                  still_samples=10, seed=0, memory_mb=64):
+    """
+    Scores the motion in the frames of a video and stores the intervals
+    of frames with motion, along with a few frames sampled from the
+    stretches without motion, in the MotionInterval table.
+    :param threshold: Minimum motion score, the fraction of changed
+    pixels, of a frame with motion.
+    :param pixel_threshold: See MotionDetector.
+    :param padding: Number of seconds of frames added to both sides of
+    each frame with motion.
+    :param stride: Only score every Nth frame. The padding is widened
+    to at least the stride so the frames in between are covered.
+    :param still_samples: Number of frames to sample from the stretches
+    without motion.
+    :param seed: Seed of the sampling, which is combined with the name
+    of the video.
+    :param memory_mb: See FrameReader.
+    """
+    print("[*] Detecting motion in video {}...".format(video_fname))
+    video = get_video(vdir.directory, video_fname)
+    reader = FrameReader(os.path.join(vdir.directory, video_fname), memory_mb=memory_mb, stride=stride)
+    set_video_fps(vdir.directory, video_fname, reader.fps)
+    fps = reader.fps if reader.fps > 0 else DEFAULT_FPS
+    padding = max(int(round(padding * fps)), stride)
+
+    ts_roi = get_timestamp_roi(reader.frame_size, ts_box) if ts_box else None
+    detector = MotionDetector(reader.frame_size, ts_roi, pixel_threshold=pixel_threshold)
+
+    intervals = []
+    last_frame = 0
+    reader.start()
+    try:
+        while True:
+            item = reader.read()
+            if item is None:
+                break
+            f_num, frame = item
+            score = detector.score(frame)
+            if score >= threshold:
+                add_motion_frame(intervals, f_num, score, padding)
+            last_frame = f_num
+    finally:
+        reader.stop()
+
+    # The padding of the last interval may run past the end of the video
+    if intervals:
+        intervals[-1][1] = min(intervals[-1][1], last_frame)
+
+    still = sample_still_frames(intervals, last_frame, still_samples, "{}-{}".format(seed, video_fname))
+    rows = [(start, end, score, False) for start, end, score in intervals] + \
+           [(frame, frame, None, True) for frame in still]
+    set_motion_intervals(video, sorted(rows))
+
+    motion_frames = sum(end - start + 1 for start, end, _ in intervals)
+    print("[*] Found {} intervals with motion in {} covering {} of {} frames ({:.1f}%), and sampled {} frames "
+          "without motion.".format(len(intervals), video_fname, motion_frames, last_frame,
+                                   100.0 * motion_frames / max(last_frame, 1), len(still)))
+    return intervals
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Finds the intervals of frames with motion in each video, which the "
+                                             "classifier can show instead of every frame.")
+    ap.add_argument("-v", "--video-path", type=str, required=True,
+                    help="path to directory containing video files")
+    ap.add_argument("-t", "--threshold", type=float, default=0.0005,
+                    help="minimum fraction of changed pixels of a frame with motion")
+    ap.add_argument("-p", "--pixel-threshold", type=int, default=25,
+                    help="minimum change in gray level for a pixel to count as changed")
+    ap.add_argument("-a", "--padding", type=float, default=1.0,
+                    help="number of seconds of frames kept on both sides of each frame with motion")
+    ap.add_argument("-s", "--stride", type=int, default=1,
+                    help="only score the motion of every Nth frame")
+    ap.add_argument("-n", "--still-samples", type=int, default=10,
+                    help="number of frames without motion sampled from each video as Not_Pollinator candidates")
+    ap.add_argument("--seed", type=int, default=0,
+                    help="seed of the sampling of frames without motion")
+    ap.add_argument("-m", "--memory-mb", type=int, default=64,
+                    help="maximum memory in MB taken up by decoded frames waiting to be scored")
+    args = vars(ap.parse_args())
+
+    main(args)
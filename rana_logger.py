@@ -1,23 +1,114 @@
+import ast
 import os
-from datetime import date
+import re
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from functools import wraps
+from queue import Queue
+from contextlib import contextmanager
+from threading import Condition, Thread, local
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 from platform_utils import get_system_paths
 
 
-def get_db_connection():
+# Pragmas applied to every connection. In WAL mode readers and writers don't block each other, so the
+# frame_times workers and the classifier can share the database, and synchronous=NORMAL only syncs the
+# log at checkpoints. Note that WAL mode needs a database on a local file system.
+DB_PRAGMAS = (("journal_mode", "wal"),
+              ("synchronous", "normal"),
+              ("cache_size", -32 * 1024),  # In KiB
+              ("mmap_size", 256 * 1024 * 1024))
+
+# Environment variable of comma-separated name=value pairs overriding DB_PRAGMAS, e.g.
+# "journal_mode=delete,synchronous=full" for a database on a network drive. See get_db_pragmas.
+DB_PRAGMAS_VARIABLE = "POLLINATOR_COUNTER_DB_PRAGMAS"
+
+# Seconds a connection waits for another connection's write lock before giving up
+DB_TIMEOUT = 30
+
+
+def get_db_pragmas(setting=None):
+    """
+    Returns the pragmas applied to every connection: DB_PRAGMAS, with
+    the pragmas of a setting overriding them or added to them.
+    :param setting: Comma-separated name=value pairs. Defaults to the
+    value of the DB_PRAGMAS_VARIABLE environment variable.
+    :return: A tuple of (name, value) tuples.
+    """
+    if setting is None:
+        setting = os.environ.get(DB_PRAGMAS_VARIABLE, "")
+    pragmas = dict(DB_PRAGMAS)
+    for item in setting.split(","):
+        if not item.strip():
+            continue
+        name, _, value = (part.strip() for part in item.partition("="))
+        if not name or not value:
+            raise ValueError("Invalid database pragma '{}' in {}. Pragmas are given as name=value pairs."
+                             .format(item.strip(), DB_PRAGMAS_VARIABLE))
+        pragmas[name.lower()] = int(value) if value.lstrip("-").isdigit() else value
+    return tuple(pragmas.items())
+
+
+def get_db_connection(pragmas=None, timeout=DB_TIMEOUT):
     system_paths = get_system_paths()
     db_loc = os.path.join(system_paths['home'], 'Pollinator_Counter')
     if not os.path.exists(db_loc):
         os.makedirs(db_loc)
 
-    db = SqliteDatabase(os.path.join(db_loc, 'log.db'))
+    db = SqliteDatabase(os.path.join(db_loc, 'log.db'), pragmas=pragmas or get_db_pragmas(), timeout=timeout)
     return db
 
 
 db = get_db_connection()
 
+# Frame rate assumed for videos whose frame rate isn't known
+DEFAULT_FPS = 30.0
+
+# Older versions stored the repr of the whole Video(directory, files) tuple as the directory of each frame.
+# See normalize_frame_directories.
+LEGACY_DIRECTORY_PREFIX = "Video(directory="
+LEGACY_DIRECTORY_RE = re.compile(r"Video\(directory=('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"), files=")
+
+
+def with_connection(func):
+    """
+    Runs a function with the database connection of the current thread.
+    The connection is opened on first use and then kept open, so queries
+    don't each pay for opening a connection and applying its pragmas.
+    Threads that end before the process does close their connection
+    with close_connection() once their work is done.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if db.is_closed():
+            db.connect()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def write_transaction():
+    """
+    Returns a transaction that takes the write lock when it begins
+    rather than at its first write. A transaction that reads before it
+    writes can otherwise fail with "database is locked" without waiting,
+    when another connection is writing at the same time. Nested
+    transactions are savepoints of the outer transaction.
+    """
+    return db.atomic("IMMEDIATE")
+
+
+def close_connection():
+    """
+    Closes the database connection of the current thread, e.g. before
+    forking worker processes, which mustn't share a connection.
+    """
+    if not db.is_closed():
+        db.close()
+
 
 class Frame(Model):
     id = PrimaryKeyField()
@@ -28,6 +119,9 @@ class Frame(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (("directory", "video", "frame"), False),
+        )
 
 
 class LogEntry(Model):
@@ -51,6 +145,9 @@ class LogEntry(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (("directory", "video", "frame"), False),
+        )
 
 
 class Video(Model):
@@ -63,11 +160,28 @@ class Video(Model):
     site = CharField()
     plant = CharField()
     total_frames = IntegerField()
+    fps = FloatField(null=True)
+    # Largest stride frame_times has read the video with. See get_time_of_frame.
+    stride = IntegerField(null=True)
     frame_times_processed = BooleanField()
     pollinators_processed = BooleanField()
+    motion_processed = BooleanField(default=False)
+    # Probed from the file by the catalog. See catalog.py.
+    size = BigIntegerField(null=True)
+    mtime = FloatField(null=True)
+    codec = CharField(null=True)
+    width = IntegerField(null=True)
+    height = IntegerField(null=True)
+    # Identifies the content of the file, so copies of a video in other directories are only processed once.
+    # See utils.fingerprint_video.
+    fingerprint = CharField(null=True)
 
     class Meta:
         database = db
+        indexes = (
+            (("directory", "video"), True),
+            (("fingerprint",), False),
+        )
 
 
 class DiscreteVisitor(Model):
@@ -87,32 +201,215 @@ class DiscreteVisitor(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (("video", "recent_frame"), False),
+        )
 
 
-@db.connection_context()
-def get_date_from_frame(video, frame_number):
-    try:
-        frame = Frame.get(Frame.video == video, Frame.frame == frame_number)
-        ts = frame.timestamp
-        return date(year=ts.year, month=ts.month, day=ts.day)
-    except Frame.DoesNotExist:
+class FrameChunk(Model):
+    """
+    A range of frames of a long video whose frame times are processed
+    independently of the rest of the video. Frame numbers are absolute
+    frame numbers within the video.
+    """
+    id = PrimaryKeyField()
+    directory = CharField()
+    video = CharField()
+    start_frame = IntegerField()
+    end_frame = IntegerField(null=True)  # Null entries indicate the chunk runs until the end of the video
+    completed = BooleanField(default=False)
+
+    class Meta:
+        database = db
+        indexes = (
+            (("directory", "video", "start_frame"), True),
+        )
+
+
+class TimestampSegment(Model):
+    """
+    A run of consecutive frames of a video that show the same time.
+    Frames are absolute frame numbers within the video and both ends
+    are inclusive. Frames between two segments, e.g. those skipped by
+    a strided run of frame_times, weren't read.
+    """
+    id = PrimaryKeyField()
+    video = ForeignKeyField(Video, backref="timestamp_segments")
+    start_frame = IntegerField()
+    end_frame = IntegerField()
+    timestamp = DateTimeField(null=True)  # Null entries indicate frame time can't be processed
+
+    class Meta:
+        database = db
+        indexes = (
+            (("video", "start_frame"), True),
+        )
+
+
+class MotionInterval(Model):
+    """
+    A run of frames of a video in which motion was detected, padded on
+    both sides, or a single frame sampled from the stretches without
+    motion. Frames are absolute frame numbers within the video and both
+    ends are inclusive.
+    """
+    id = PrimaryKeyField()
+    video = ForeignKeyField(Video, backref="motion_intervals")
+    start_frame = IntegerField()
+    end_frame = IntegerField()
+    score = FloatField(null=True)  # Highest motion score within the interval, null for still frames
+    still = BooleanField(default=False)  # Sampled from a stretch without motion
+
+    class Meta:
+        database = db
+        indexes = (
+            (("video", "start_frame"), True),
+        )
+
+
+@with_connection
+def get_date_from_frame(directory, video, frame_number):
+    ts = get_time_of_frame(directory, video, frame_number)
+    if ts is None:
         print("[!] Frame with time does not exist in the database. Attempting to retrieve time from current frame...")
         return None
+    return ts.date()
+
+
+@with_connection
+def get_time_of_frame(directory, video, frame_number):
+    """
+    Returns the time of a frame of a video. The time is looked up in
+    the TimestampSegment table, through the copy of the video that was
+    processed in its place if it has no segments itself, falling back
+    to the Frame table for videos processed before segments were
+    introduced. Frames without a
+    stored time, such as the frames between the keyframes of a strided
+    run of frame_times, are interpolated from the nearest frames with a
+    time using the frame rate of the video. See
+    get_interpolation_window for how far a time is carried.
+    :return: The time of the frame truncated to the second, or None if
+    no frame near it has a time.
+    """
+    entry = Video.get_or_none((Video.directory == directory) & (Video.video == video))
+    timed = get_timed_copy(entry) if entry is not None else None
+    before, after = get_segment_times(timed, frame_number) if timed is not None else (None, None)
+    if before is None and after is None:
+        before, after = get_frame_times(directory, video, frame_number)
+    if before is not None and before[0] == frame_number:
+        return before[1]
+
+    fps = (timed and timed.fps) or (entry and entry.fps) or DEFAULT_FPS
+    window = get_interpolation_window(timed or entry, fps)
+    # A stored time is the start of the second a frame was shown in, so counting frames forward from the
+    # previous frame or back from the next frame both give an earliest possible time. The later of the two
+    # is the closer one.
+    estimates = []
+    if before is not None and frame_number - before[0] <= window:
+        estimates.append(before[1] + timedelta(seconds=(frame_number - before[0]) / fps))
+    if after is not None and after[0] - frame_number <= window:
+        estimates.append(after[1] - timedelta(seconds=(after[0] - frame_number) / fps))
+    if not estimates:
+        return None
+
+    ts = max(estimates)
+    if after is not None:
+        # Don't run past the next frame with a time when the frame rate is off
+        ts = min(ts, after[1])
+    return ts.replace(microsecond=0)
+
+
+def get_interpolation_window(video, fps=None):
+    """
+    Returns the number of frames the time of a frame is carried to the
+    frames around it that weren't read: the stride of the video or a
+    second of frames, whichever is larger. Frames further from a frame
+    with a time, e.g. those of chunks that haven't been processed yet,
+    are given no time rather than one that was made up.
+    :param video: The Video entry, or None.
+    :param fps: The frame rate to use, instead of the frame rate of the
+    video.
+    """
+    stride = video.stride if video is not None else None
+    fps = fps or (video.fps if video is not None else None) or DEFAULT_FPS
+    return max(stride or 1, fps)
 
 
-@db.connection_context()
-def get_last_processed_frame(video):
-    video_frames = Frame.select().where(Frame.video == video)
-    f_nums = [vf.frame for vf in video_frames]
-    last_frame = max(f_nums)
-    return last_frame
+def get_frame_times(directory, video, frame_number):
+    """
+    Finds the nearest frames with a time in the Frame table at or
+    before, and after, a frame. Both lookups are served by the
+    (directory, video, frame) index.
+    :return: A tuple of two (frame_number, timestamp) tuples, either of
+    which is None if there is no such frame.
+    """
+    timed = Frame.select(Frame.frame, Frame.timestamp).where((Frame.video == video) & (Frame.directory == directory) &
+                                                             Frame.timestamp.is_null(False)).tuples()
+    before = timed.where(Frame.frame <= frame_number).order_by(Frame.frame.desc()).first()
+    after = timed.where(Frame.frame > frame_number).order_by(Frame.frame).first()
+    return before, after
+
+
+def get_segment_times(video, frame_number):
+    """
+    Finds the nearest segments with a time at or before, and after, a
+    frame. Both lookups are range probes of the (video, start_frame)
+    index.
+    :param video: The Video entry whose segments are looked up.
+    :return: A tuple of two (frame_number, timestamp) tuples: the frame
+    itself, or the last frame of the segment before it, and the first
+    frame of the segment after it. Either is None if there is no such
+    segment.
+    """
+    timed = (TimestampSegment
+             .select(TimestampSegment.start_frame, TimestampSegment.end_frame, TimestampSegment.timestamp)
+             .where((TimestampSegment.video == video) & TimestampSegment.timestamp.is_null(False))
+             .tuples())
+    before = timed.where(TimestampSegment.start_frame <= frame_number) \
+        .order_by(TimestampSegment.start_frame.desc()).first()
+    after = timed.where(TimestampSegment.start_frame > frame_number).order_by(TimestampSegment.start_frame).first()
+
+    if before is not None:
+        start_frame, end_frame, ts = before
+        before = (min(end_frame, frame_number), ts)
+    if after is not None:
+        after = (after[0], after[2])
+    return before, after
+
 
+@with_connection
+def get_last_processed_frame(directory, video, start_frame=None, end_frame=None):
+    """
+    Returns the highest frame number stored in the TimestampSegment or
+    Frame tables for the given video, or None if no frames have been
+    stored. The lookups are served by the (video, start_frame) and
+    (directory, video, frame) indexes.
+    :param start_frame: Optional first frame number of the range to
+    look in.
+    :param end_frame: Optional last frame number of the range to look
+    in.
+    """
+    query = Frame.select(fn.MAX(Frame.frame)).where((Frame.video == video) & (Frame.directory == directory))
+    segments = TimestampSegment.select(fn.MAX(TimestampSegment.end_frame)).join(Video) \
+        .where((Video.directory == directory) & (Video.video == video))
+    if start_frame is not None:
+        query = query.where(Frame.frame >= start_frame)
+        segments = segments.where(TimestampSegment.start_frame >= start_frame)
+    if end_frame is not None:
+        query = query.where(Frame.frame <= end_frame)
+        segments = segments.where(TimestampSegment.start_frame <= end_frame)
+
+    frames = [frame for frame in (query.scalar(), segments.scalar()) if frame is not None]
+    if not frames:
+        return None
+    return max(frames) if end_frame is None else min(max(frames), end_frame)
 
-@db.connection_context()
+
+@with_connection
 def add_or_update_discrete_visitor(directory, video_fname, pol_id, behavior, size, recent_frame, ppt_slide=None,
                                    notes=None):
     video = get_video(directory, video_fname)
-    dt = get_date_from_frame(video_fname, recent_frame)
+    dt = get_date_from_frame(directory, video_fname, recent_frame)
 
     visitor, created = DiscreteVisitor.get_or_create(
         video=video,
@@ -143,16 +440,300 @@ def add_or_update_discrete_visitor(directory, video_fname, pol_id, behavior, siz
     visitor.save()
 
 
-@db.connection_context()
-def add_frame(directory, video, time, frame_number):
-    frame_info = Frame(directory=directory,
-                       video=video,
-                       timestamp=time,
-                       frame=frame_number)
-    frame_info.save()
+class SegmentWriter(object):
+    """
+    Collapses the frames of a video into TimestampSegment rows, one
+    for each run of consecutive frames that show the same time, and
+    writes them to the database with `insert_many` inside a single
+    transaction. A frame that shows the same time as the previous frame
+    that was added extends the current segment over any frames skipped
+    in between, since the time only moves forward.
+
+    The segments are written every `batch_size` frames or every
+    `flush_interval` seconds, whichever comes first, and when used as a
+    context manager also on exit, including when an exception or
+    KeyboardInterrupt is raised, so at most one batch is lost on a
+    crash. The segment that is still being extended is written as well
+    and replaced when it is written again.
+    """
+
+    def __init__(self, video, batch_size=1000, flush_interval=10.0, submit=None):
+        """
+        :param video: The Video row the frames belong to.
+        :param submit: Optional function the writes are handed to, along
+        with their arguments, instead of being run right away, e.g. to
+        queue them for a single writer.
+        """
+        self.video = video
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submit = submit
+        self.rows = []
+        self.segment = None
+        self.frames = 0
+        self.last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, time, frame_number):
+        if self.segment is not None and self.segment["timestamp"] == time:
+            self.segment["end_frame"] = frame_number
+        else:
+            if self.segment is not None:
+                self.rows.append(self.segment)
+            self.segment = {"video": self.video.id,
+                            "start_frame": frame_number,
+                            "end_frame": frame_number,
+                            "timestamp": time}
+
+        self.frames += 1
+        if self.frames >= self.batch_size or self.flush_due():
+            self.flush()
+
+    def flush(self):
+        rows = self.rows + ([dict(self.segment)] if self.segment is not None else [])
+        if rows:
+            if self.submit is not None:
+                self.submit(add_segments, rows)
+            else:
+                add_segments(rows)
+            self.rows = []
+        self.frames = 0
+        self.last_flush = time.time()
+
+    def flush_due(self):
+        return time.time() - self.last_flush >= self.flush_interval
+
+
+@with_connection
+def add_segments(rows):
+    """
+    Writes TimestampSegment rows in a single transaction, replacing the
+    segments that start at the same frame. See SegmentWriter.
+    :param rows: A list of dictionaries of the video id, start_frame,
+    end_frame and timestamp of each segment.
+    """
+    with write_transaction():
+        # SQLite limits the number of bound variables in a single query, so large batches are split into
+        # several inserts
+        for batch in chunked(rows, 200):
+            TimestampSegment.insert_many(batch).on_conflict_replace().execute()
+
+
+class DatabaseWriter(object):
+    """
+    Runs database writes on a single background thread, so that the
+    user doesn't wait on the database, e.g. for each label in the
+    classifier.
+
+    Writes are functions of this module, such as add_log_entry, that
+    are submitted along with their arguments and run in the order they
+    were submitted. Whatever is waiting when the thread gets to it is
+    written in a single transaction, and each write runs in its own
+    savepoint so a failing write doesn't undo the others. Writes are
+    committed as soon as the thread catches up, so little is lost on a
+    crash, and all of them are committed by flush() and close(). Writes
+    that belong together, e.g. a log entry and its visitor tally, can
+    be grouped so they are always committed together.
+
+    Since writes are queued, reads that depend on them, e.g. resuming
+    from get_last_frame, must call flush() first.
+    """
+
+    def __init__(self, batch_size=100):
+        """
+        :param batch_size: Maximum number of writes committed in a
+        single transaction.
+        """
+        self.batch_size = batch_size
+        self.queue = Queue()
+        # Writes submitted within a group by the current thread
+        self.grouped = local()
+        self.thread = Thread(target=self.update)
+        self.thread.daemon = True
+        self.condition = Condition()
+        self.submitted = 0
+        self.committed = 0
+        self.stopped = False
+
+        # Metrics
+        self.transactions = 0
+        self.failures = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a write. Arguments may be the futures of earlier writes,
+        which are replaced by their results.
+        :return: A Future of the result of the write.
+        """
+        if self.stopped:
+            raise RuntimeError("Can't submit {} since the database writer is closed.".format(func.__name__))
+        future = Future()
+        write = (future, func, args, kwargs)
+        if getattr(self.grouped, "writes", None) is not None:
+            self.grouped.writes.append(write)
+        else:
+            self.put([write])
+        return future
+
+    @contextmanager
+    def group(self):
+        """
+        Collects the writes submitted by the current thread within a
+        with block and queues them on exit as a unit that is committed
+        in a single transaction.
+        """
+        self.grouped.writes = []
+        try:
+            yield self
+        finally:
+            writes, self.grouped.writes = self.grouped.writes, None
+            if writes:
+                self.put(writes)
+
+    def put(self, writes):
+        with self.condition:
+            self.submitted += len(writes)
+        self.queue.put(writes)
+
+    def update(self):
+        try:
+            while True:
+                units = [self.queue.get()]
+                while len(units) < self.batch_size and not self.queue.empty():
+                    units.append(self.queue.get())
+
+                stop = None in units
+                writes = [write for unit in units if unit is not None for write in unit]
+                if writes:
+                    self.write(writes)
+                    with self.condition:
+                        self.committed += len(writes)
+                        self.condition.notify_all()
+                if stop:
+                    return
+        finally:
+            close_connection()
+
+    @with_connection
+    def write(self, writes):
+        # Results are only handed out once the transaction is committed
+        results = {}
+
+        def resolve(arg):
+            if not isinstance(arg, Future):
+                return arg
+            if id(arg) in results:
+                result, error = results[id(arg)]
+                if error is not None:
+                    raise error
+                return result
+            return arg.result()
+
+        try:
+            with write_transaction():
+                for future, func, args, kwargs in writes:
+                    try:
+                        args = [resolve(arg) for arg in args]
+                        kwargs = {key: resolve(arg) for key, arg in kwargs.items()}
+                        with db.atomic():
+                            results[id(future)] = (func(*args, **kwargs), None)
+                    except Exception as e:
+                        print("[!] Unable to write {} to the database: {}".format(func.__name__, e))
+                        results[id(future)] = (None, e)
+            self.transactions += 1
+        except Exception as e:
+            print("[!] Unable to commit {} writes to the database: {}".format(len(writes), e))
+            results = {id(future): (None, e) for future, _, _, _ in writes}
+
+        for future, _, _, _ in writes:
+            result, error = results[id(future)]
+            if error is None:
+                future.set_result(result)
+            else:
+                self.failures += 1
+                future.set_exception(error)
+
+    def flush(self):
+        """
+        Blocks until every write submitted so far is committed.
+        """
+        with self.condition:
+            target = self.submitted
+            while self.committed < target:
+                self.condition.wait()
+
+    def close(self):
+        """
+        Commits the queued writes and stops the writer thread.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.queue.put(None)
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def summary(self):
+        return "Committed {} database writes in {} transactions with {} failures.".format(
+            self.committed, self.transactions, self.failures)
+
+
+@with_connection
+def add_frame_chunks(directory, video, ranges):
+    """
+    Records the frame ranges a video has been split into.
+    :param ranges: List of (start_frame, end_frame) tuples.
+    :return: The list of created FrameChunk rows ordered by start
+    frame.
+    """
+    with write_transaction():
+        FrameChunk.insert_many([{"directory": directory,
+                                 "video": video,
+                                 "start_frame": start,
+                                 "end_frame": end} for start, end in ranges]).execute()
+    return get_frame_chunks(directory, video)
+
+
+@with_connection
+def complete_frame_chunk(chunk_id, directory, video, last_frame):
+    """
+    Marks a chunk as completed.
+    :param last_frame: The last frame of the chunk. It is recorded as
+    the end of the chunk, since the last chunk runs until the end of
+    the video and strided runs don't store every frame.
+    :return: True if every chunk of the video is now completed.
+    """
+    with write_transaction():
+        FrameChunk.update(completed=True, end_frame=last_frame).where(FrameChunk.id == chunk_id).execute()
+        remaining = FrameChunk.select().where((FrameChunk.directory == directory) & (FrameChunk.video == video) &
+                                              (FrameChunk.completed == 0)).count()
+    return remaining == 0
+
+
+@with_connection
+def get_frame_chunks(directory, video, completed=None):
+    """
+    Returns the chunks a video has been split into ordered by start
+    frame, or an empty list if the video isn't processed in chunks.
+    :param completed: Optionally only return chunks whose completion
+    matches this value.
+    """
+    query = FrameChunk.select().where((FrameChunk.directory == directory) & (FrameChunk.video == video))
+    if completed is not None:
+        query = query.where(FrameChunk.completed == completed)
+    return list(query.order_by(FrameChunk.start_frame))
 
 
-@db.connection_context()
+@with_connection
 def add_log_entry(directory, video, time, classification, size, bbox, frame_number, name=None, pollinator_id=None,
                   proba=None, genus=None, species=None, behavior=None, size_class=None, manual=False, img_path=None):
     entry = LogEntry(directory=directory,
@@ -173,12 +754,22 @@ def add_log_entry(directory, video, time, classification, size, bbox, frame_numb
                      img_path=img_path
                      )
     entry.save()
+    return entry.id
+
 
+@with_connection
+def set_log_entry_image(entry_id, img_path):
+    """
+    Records the path of the image of a log entry, once the image has
+    been written.
+    """
+    LogEntry.update(img_path=img_path).where(LogEntry.id == entry_id).execute()
 
-@db.connection_context()
-def add_processed_video(video, total_frames=None, pollinator=False):
+
+@with_connection
+def add_processed_video(directory, video, total_frames=None, pollinator=False):
     print("[*] Saving processing completion of {} to database...".format(video))
-    entry = Video.get(Video.video == video)
+    entry = get_video(directory, video)
 
     if pollinator:
         entry.pollinators_processed = True
@@ -190,27 +781,29 @@ def add_processed_video(video, total_frames=None, pollinator=False):
     entry.save()
 
 
-@db.connection_context()
+@with_connection
 def get_analyzed_videos():
     """
-    Returns a list of all videos that are referenced in the Frame table.
+    Returns all videos that are referenced in the Frame or
+    TimestampSegment tables.
     Note that this list could contain videos that were only partially
     processed.
-    :return: list of videos in Frame table.
+    :return: A set of the (directory, video) pairs of the videos in the
+    Frame and TimestampSegment tables.
     """
     try:
-        print("[*] Getting list of videos referenced inside the Frame database table...")
-        frames = Frame.select()
-        videos = set([f.video for f in frames])
-        return videos
+        print("[*] Getting list of videos referenced inside the Frame and TimestampSegment database tables...")
+        segments = TimestampSegment.select().where(TimestampSegment.video == Video.id)
+        videos = Video.select(Video.directory, Video.video).where(fn.EXISTS(segments)).tuples()
+        return set(get_frame_videos()) | set(videos)
     except DoesNotExist:
         print("[*] No analyzed videos found.")
 
 
-@db.connection_context()
-def get_last_frame(video):
+@with_connection
+def get_last_frame(directory, video):
     try:
-        video_id = Video.select(Video.id).where(Video.video == video).get()
+        video_id = get_video(directory, video)
         last = DiscreteVisitor.select().where(DiscreteVisitor.video == video_id) \
             .order_by(DiscreteVisitor.recent_frame.desc()).get()
 
@@ -219,29 +812,254 @@ def get_last_frame(video):
         print("[*] No existing log entry for {}.".format(video))
 
 
-@db.connection_context()
-def get_processed_videos(pollinator=False):
+@with_connection
+def get_processed_videos(pollinator=False, motion=False):
     """
-    Returns a list of videos that have had their frame times
-    fully processed.
-    :return: A list of videos that have had their frame times
-    processed.
+    Returns the videos that have had their frame times fully processed,
+    along with the copies of those videos in other directories, which
+    share their fingerprint.
+    :param pollinator: Return the videos whose pollinators have been
+    processed instead.
+    :param motion: Return the videos whose motion intervals have been
+    processed instead.
+    :return: A set of the (directory, video) pairs of the videos that
+    have had their frame times processed.
     """
     try:
         print("[*] Retrieving list of videos whose frame times have been fully processed...")
         if pollinator:
-            videos = Video.select().where(Video.pollinators_processed == 1)
+            processed = Video.pollinators_processed == 1
+        elif motion:
+            processed = Video.motion_processed == 1
         else:
-            videos = Video.select().where(Video.frame_times_processed == 1)
+            processed = Video.frame_times_processed == 1
 
-        videos = set([vid.video for vid in videos])
-        return videos
+        fingerprints = Video.select(Video.fingerprint).where(processed & Video.fingerprint.is_null(False))
+        videos = Video.select(Video.directory, Video.video).where(processed | Video.fingerprint.in_(fingerprints))
+        return set(videos.tuples())
 
     except DoesNotExist:
         print("[*] No processed videos found.")
 
 
-@db.connection_context()
+def get_video_copies(video):
+    """
+    Returns a query of the entry of a video along with the entries of
+    its copies in other directories, which share its fingerprint. The
+    video itself comes first, then its copies in the order they were
+    added.
+    :param video: The Video entry.
+    """
+    copies = Video.id == video.id
+    if video.fingerprint is not None:
+        copies |= Video.fingerprint == video.fingerprint
+    return Video.select().where(copies).order_by(Video.id != video.id, Video.id)
+
+
+@with_connection
+def get_processed_copy(video, processed):
+    """
+    Returns the entry of a video, or else of the first of its copies,
+    for which a condition holds. Only one copy of a video is processed,
+    so the frame times and motion of the other copies are looked up
+    through it.
+    :param video: The Video entry.
+    :param processed: An expression on the Video table, e.g.
+    Video.motion_processed == 1.
+    :return: The Video entry, or None if the condition holds for no
+    copy of the video.
+    """
+    return get_video_copies(video).where(processed).first()
+
+
+def get_timed_copy(video):
+    """
+    Returns the entry of a video, or of one of its copies, that has
+    segments with a time, or None if no copy of the video has. See
+    get_processed_copy.
+    """
+    segments = TimestampSegment.select().where((TimestampSegment.video == Video.id) &
+                                               TimestampSegment.timestamp.is_null(False))
+    return get_processed_copy(video, fn.EXISTS(segments))
+
+
+@with_connection
+def collapse_frames(directory, video_fname, delete=False):
+    """
+    Collapses the Frame rows of a video into TimestampSegment rows. The
+    frames are streamed in frame order, so the whole video is never held
+    in memory. Collapsing a video again replaces its segments with the
+    same rows.
+    :param delete: Whether to delete the Frame rows once the segments
+    are written.
+    :return: A tuple of the number of frames and segments.
+    """
+    split = directory.split(os.path.sep)[-2:]
+    video, _ = Video.get_or_create(directory=directory,
+                                   video=video_fname,
+                                   defaults={"site": split[0],
+                                             "plant": split[-1],
+                                             "total_frames": 0,
+                                             "frame_times_processed": False,
+                                             "pollinators_processed": False})
+    frames = (Frame.select(Frame.frame, Frame.timestamp)
+              .where((Frame.directory == directory) & (Frame.video == video_fname))
+              .order_by(Frame.frame)
+              .tuples())
+
+    # The segments are only written once all frames are read, in a single transaction
+    writer = SegmentWriter(video, batch_size=float("inf"), flush_interval=float("inf"))
+    count = 0
+    for frame_number, timestamp in frames.iterator():
+        writer.add(time=timestamp, frame_number=frame_number)
+        count += 1
+    segments = len(writer.rows) + (writer.segment is not None)
+    writer.flush()
+
+    if delete:
+        with write_transaction():
+            Frame.delete().where((Frame.directory == directory) & (Frame.video == video_fname)).execute()
+    return count, segments
+
+
+# The distinct (directory, video) pairs of the Frame table, in order. Each pair is found from the previous one
+# with two probes of the (directory, video, frame) index, for the next video of the same directory and else the
+# first video of the next directory, so only one index entry is read per video rather than every frame.
+FRAME_VIDEOS_SQL = """WITH RECURSIVE pairs(directory, video) AS (
+    SELECT * FROM (SELECT directory, video FROM frame ORDER BY directory, video LIMIT 1)
+    UNION ALL
+    SELECT n.directory, n.video FROM pairs AS p, frame AS n WHERE n.id = COALESCE(
+        (SELECT f.id FROM frame AS f WHERE f.directory = p.directory AND f.video > p.video ORDER BY f.video LIMIT 1),
+        (SELECT f.id FROM frame AS f WHERE f.directory > p.directory ORDER BY f.directory LIMIT 1))
+)
+SELECT directory, video FROM pairs"""
+
+
+@with_connection
+def get_frame_videos():
+    """
+    Returns the (directory, video) pairs referenced in the Frame table.
+    See FRAME_VIDEOS_SQL.
+    """
+    return [tuple(row) for row in db.execute_sql(FRAME_VIDEOS_SQL).fetchall()]
+
+
+# The time of a frame of a video as a Julian day, computed in SQL the same way as get_time_of_frame from the
+# nearest segments with a time at or before, and after, the frame. Each lookup is a probe of the
+# (video, start_frame) index. The frame is the {frame} column of the row being updated. Frames further than
+# :window frames from both segments get NULL. See get_interpolation_window.
+SEGMENT_BEFORE_SQL = ('(SELECT {column} FROM timestampsegment AS s WHERE s.video_id = :timed_id AND '
+                      's.timestamp IS NOT NULL AND s.start_frame <= {frame} ORDER BY s.start_frame DESC LIMIT 1)')
+SEGMENT_AFTER_SQL = ('(SELECT {column} FROM timestampsegment AS s WHERE s.video_id = :timed_id AND '
+                     's.timestamp IS NOT NULL AND s.start_frame > {frame} ORDER BY s.start_frame LIMIT 1)')
+# The same lookups in the Frame table, for videos processed before segments were introduced. Each is a probe of
+# the (directory, video, frame) index.
+FRAME_BEFORE_SQL = ('(SELECT {column} FROM frame AS f WHERE f.directory = :directory AND f.video = :video AND '
+                    'f.timestamp IS NOT NULL AND f.frame <= {frame} ORDER BY f.frame DESC LIMIT 1)')
+FRAME_AFTER_SQL = ('(SELECT {column} FROM frame AS f WHERE f.directory = :directory AND f.video = :video AND '
+                   'f.timestamp IS NOT NULL AND f.frame > {frame} ORDER BY f.frame LIMIT 1)')
+FRAME_TIME_SQL = """CASE
+    WHEN {before_end} >= {frame} THEN {before_time}
+    WHEN {after_start} IS NULL OR {after_start} - {frame} > :window THEN
+        CASE WHEN {frame} - {before_end} <= :window THEN
+            COALESCE(MIN({before_time} + ({frame} - {before_end}) / :fps / 86400.0, {after_time}),
+                     {before_time} + ({frame} - {before_end}) / :fps / 86400.0)
+        END
+    WHEN {before_end} IS NULL OR {frame} - {before_end} > :window THEN
+        {after_time} - ({after_start} - {frame}) / :fps / 86400.0
+    ELSE MIN(MAX({before_time} + ({frame} - {before_end}) / :fps / 86400.0,
+                 {after_time} - ({after_start} - {frame}) / :fps / 86400.0), {after_time})
+END"""
+
+
+def get_frame_time_sql(frame, frames=False):
+    """
+    Returns the SQL expression of the time of a frame as a Julian day.
+    See FRAME_TIME_SQL.
+    :param frame: The column holding the frame number.
+    :param frames: Whether to look the time up in the Frame table
+    rather than the TimestampSegment table.
+    """
+    if frames:
+        before, after, time, before_end, after_start = (FRAME_BEFORE_SQL, FRAME_AFTER_SQL, "julianday(f.timestamp)",
+                                                        "f.frame", "f.frame")
+    else:
+        before, after, time, before_end, after_start = (SEGMENT_BEFORE_SQL, SEGMENT_AFTER_SQL,
+                                                        "julianday(s.timestamp)", "s.end_frame", "s.start_frame")
+    return FRAME_TIME_SQL.format(
+        frame=frame,
+        before_time=before.format(column=time, frame=frame),
+        before_end=before.format(column=before_end, frame=frame),
+        after_time=after.format(column=time, frame=frame),
+        after_start=after.format(column=after_start, frame=frame))
+
+
+@with_connection
+def backfill_timestamps(video):
+    """
+    Fills in the timestamps of the log entries and the dates of the
+    discrete visitors of a video that were recorded before the frame
+    times of their frames were known. Each table is filled with a single
+    UPDATE of the rows that are still NULL, so this can be run again
+    whenever more frame times have been processed.
+
+    Times are looked up in the TimestampSegment table, through the copy
+    of the video that was processed in its place if need be, or in the
+    Frame table for videos processed before segments were introduced,
+    and interpolated exactly like get_time_of_frame. Frames past the
+    last frame with a time are only filled in once the frame times of
+    the whole video are processed, since get_time_of_frame may give
+    them a closer time until then.
+    :param video: The Video entry.
+    :return: A tuple of the number of filled log entries and visitors.
+    """
+    # The segments are those of the copy of the video that was processed in its place, if it has none itself.
+    # The Frame table is only used when no copy of the video has segments with a time, as in get_time_of_frame.
+    timed_copy = get_timed_copy(video)
+    frames = timed_copy is None
+    timed_copy = timed_copy or video
+    params = {"video_id": video.id,
+              "timed_id": timed_copy.id,
+              "directory": video.directory,
+              "video": video.video,
+              "fps": timed_copy.fps or video.fps or DEFAULT_FPS,
+              "window": get_interpolation_window(timed_copy, timed_copy.fps or video.fps),
+              "processed": timed_copy.frame_times_processed}
+    if frames:
+        last_frame = ("(SELECT MAX(f.frame) FROM frame AS f WHERE f.directory = :directory AND f.video = :video AND "
+                      "f.timestamp IS NOT NULL)")
+    else:
+        last_frame = ("(SELECT MAX(s.end_frame) FROM timestampsegment AS s WHERE s.video_id = :timed_id AND "
+                      "s.timestamp IS NOT NULL)")
+    # Rows whose frame can be given a time
+    timed = "({frame} <= " + last_frame + " OR :processed)"
+
+    with write_transaction():
+        entries = db.execute_sql(
+            "UPDATE logentry SET timestamp = datetime({0}) WHERE directory = :directory AND video = :video AND "
+            "timestamp IS NULL AND {1} AND {0} IS NOT NULL".format(get_frame_time_sql("logentry.frame", frames),
+                                                                   timed.format(frame="logentry.frame")),
+            params).rowcount
+        visitors = db.execute_sql(
+            "UPDATE discretevisitor SET date = date({0}) WHERE video_id = :video_id AND date IS NULL AND {1} AND "
+            "{0} IS NOT NULL".format(get_frame_time_sql("discretevisitor.recent_frame", frames),
+                                     timed.format(frame="discretevisitor.recent_frame")), params).rowcount
+    return entries, visitors
+
+
+@with_connection
+def get_videos_missing_timestamps():
+    """
+    Returns the videos with log entries without a timestamp or discrete
+    visitors without a date.
+    """
+    entries = LogEntry.select().where((LogEntry.directory == Video.directory) & (LogEntry.video == Video.video) &
+                                      LogEntry.timestamp.is_null())
+    visitors = DiscreteVisitor.select().where((DiscreteVisitor.video == Video.id) & DiscreteVisitor.date.is_null())
+    return list(Video.select().where(fn.EXISTS(entries) | fn.EXISTS(visitors)).order_by(Video.directory, Video.video))
+
+
+@with_connection
 def get_video(directory, video_fname):
     video = Video.get(
         (Video.directory == directory) &
@@ -249,25 +1067,319 @@ def get_video(directory, video_fname):
     return video
 
 
-@db.connection_context()
+@with_connection
+def set_video_fps(directory, video, fps):
+    """
+    Records the frame rate of a video, which is used to interpolate the
+    time of frames that weren't read. See get_time_of_frame.
+    """
+    if fps and fps > 0:
+        Video.update(fps=fps).where((Video.directory == directory) & (Video.video == video)).execute()
+
+
+@with_connection
+def set_video_stride(directory, video, stride):
+    """
+    Records the stride a video is read with, unless it was already read
+    with a larger one, which is used to interpolate the time of frames
+    that weren't read. See get_interpolation_window.
+    """
+    Video.update(stride=fn.MAX(fn.COALESCE(Video.stride, 1), stride)) \
+        .where((Video.directory == directory) & (Video.video == video)).execute()
+
+
+@with_connection
+def set_motion_intervals(video, intervals):
+    """
+    Replaces the motion intervals of a video and marks its motion as
+    processed, in a single transaction.
+    :param video: The Video entry.
+    :param intervals: A list of (start_frame, end_frame, score, still)
+    tuples.
+    """
+    rows = [{"video": video, "start_frame": start, "end_frame": end, "score": score, "still": still}
+            for (start, end, score, still) in intervals]
+    with write_transaction():
+        MotionInterval.delete().where(MotionInterval.video == video).execute()
+        for batch in chunked(rows, 100):
+            MotionInterval.insert_many(batch).execute()
+        Video.update(motion_processed=True).where(Video.id == video.id).execute()
+
+
+@with_connection
+def get_motion_intervals(video):
+    """
+    Returns the motion intervals of a video ordered by frame, or None if
+    its motion hasn't been processed. The intervals of a copy of the
+    video are returned if the copy was processed in its place.
+    :param video: The Video entry.
+    """
+    processed = get_processed_copy(video, Video.motion_processed == 1)
+    if processed is None:
+        return None
+    return list(MotionInterval.select().where(MotionInterval.video == processed)
+                .order_by(MotionInterval.start_frame))
+
+
+@with_connection
 def populate_video_table(video_list):
+    """
+    Syncs the Video table with the videos found on disk. The scanned
+    videos are compared with the known videos in a single query, and
+    the new ones are inserted in bulk in a single transaction. Videos
+    that have vanished from disk are only reported, since their rows
+    may be referenced by log entries.
+    :param video_list: List of Video(directory, files) tuples from
+    get_video_list.
+    :return: A tuple of the number of added, unchanged and vanished
+    videos.
+    """
     print("[*] Populating Video database table...")
+    if not video_list:
+        return 0, 0, 0
+
+    scanned = {}
     for vdir in video_list:
         split = vdir.directory.split(os.path.sep)[-2:]
-        site = split[0]
-        plant = split[1]
         for video in vdir.files:
-            entry, created = Video.get_or_create(directory=vdir.directory,
-                                                 video=video,
-                                                 site=site,
-                                                 plant=plant,
-                                                 defaults={"total_frames": 0,
-                                                           "frame_times_processed": False,
-                                                           "pollinators_processed": False})
-            if created:
-                entry.save()
-
-
-@db.connection_context()
+            scanned[(vdir.directory, video)] = {"directory": vdir.directory,
+                                                "video": video,
+                                                "site": split[0],
+                                                "plant": split[1],
+                                                "total_frames": 0,
+                                                "frame_times_processed": False,
+                                                "pollinators_processed": False}
+
+    # Only known videos under the scanned directory can have vanished. The directory that was walked is the
+    # common path of the scanned directories, since os.walk lists it as well.
+    root = os.path.commonpath([vdir.directory for vdir in video_list])
+    prefix = root.rstrip(os.path.sep) + os.path.sep
+    known = set(Video.select(Video.directory, Video.video)
+                .where((Video.directory == root) | (fn.substr(Video.directory, 1, len(prefix)) == prefix))
+                .tuples())
+
+    rows = [row for key, row in scanned.items() if key not in known]
+    with write_transaction():
+        for batch in chunked(rows, 100):
+            Video.insert_many(batch).on_conflict_ignore().execute()
+
+    added = len(rows)
+    unchanged = len(scanned) - added
+    vanished = len(known - set(scanned))
+    print("[*] Added {} videos to the Video table. {} videos were already known and {} known videos weren't found "
+          "on disk.".format(added, unchanged, vanished))
+    return added, unchanged, vanished
+
+
+@with_connection
+def get_video_stats(video_list):
+    """
+    Returns the file size and modification time last recorded for each
+    of the given videos, in a single query per batch of directories.
+    :param video_list: List of Video(directory, files) tuples.
+    :return: A dictionary of (directory, video) to (id, size, mtime,
+    fingerprint) tuples. The size, mtime and fingerprint are None until
+    the video is probed.
+    """
+    directories = [vdir.directory for vdir in video_list]
+    stats = {}
+    for batch in chunked(directories, 100):
+        query = (Video.select(Video.directory, Video.video, Video.id, Video.size, Video.mtime, Video.fingerprint)
+                 .where(Video.directory.in_(batch))
+                 .tuples())
+        for directory, video, video_id, size, mtime, fingerprint in query:
+            stats[(directory, video)] = (video_id, size, mtime, fingerprint)
+    return stats
+
+
+@with_connection
+def set_video_metadata(rows):
+    """
+    Records the probed metadata of videos in a single transaction. The
+    total frame count is only set on videos whose frames haven't been
+    counted yet, since the count of the container may be an estimate.
+    :param rows: A list of dictionaries of the id, size, mtime,
+    fingerprint, codec, fps, width, height and total_frames of each
+    video.
+    """
+    with write_transaction():
+        for row in rows:
+            Video.update(size=row["size"], mtime=row["mtime"], fingerprint=row["fingerprint"], codec=row["codec"],
+                         fps=row["fps"], width=row["width"], height=row["height"]) \
+                .where(Video.id == row["id"]).execute()
+            if row["total_frames"]:
+                Video.update(total_frames=row["total_frames"]) \
+                    .where((Video.id == row["id"]) & (Video.total_frames == 0)).execute()
+
+
+@with_connection
+def get_video_frame_counts():
+    """
+    Returns the total frame count of each video, which is 0 for videos
+    that haven't been probed or counted.
+    :return: A dictionary of (directory, video) to total frames.
+    """
+    return {(directory, video): total_frames for directory, video, total_frames
+            in Video.select(Video.directory, Video.video, Video.total_frames).tuples()}
+
+
+def add_missing_columns(models):
+    """
+    Adds the columns declared on the models that are missing from
+    tables created by an older version. The new fields must be nullable
+    or have a default. Tables that don't exist yet are skipped.
+    """
+    migrator = SqliteMigrator(db)
+    operations = []
+    tables = set(db.get_tables())
+    for model in models:
+        table = model._meta.table_name
+        if table not in tables:
+            continue
+        columns = set(column.name for column in db.get_columns(table))
+        for field in model._meta.sorted_fields:
+            if field.column_name not in columns:
+                print("[*] Adding column {} to database table {}...".format(field.column_name, table))
+                operations.append(migrator.add_column(table, field.column_name, field))
+    if operations:
+        with write_transaction():
+            migrate(*operations)
+
+
+@with_connection
+def vacuum():
+    """
+    Rebuilds the database file, returning the space of deleted rows to
+    the file system.
+    """
+    db.execute_sql("VACUUM")
+
+
+def merge_duplicate_videos():
+    """
+    Merges the entries of a video that older versions added more than
+    once into the first of them, since the (directory, video) index of
+    the Video table can't be built while they exist. The discrete
+    visitors of the other entries are moved over, and the remaining
+    entry is marked processed if any of the entries was. Databases that
+    already have the index are left as they are.
+    """
+    tables = set(db.get_tables())
+    if "video" not in tables or any(index.unique and index.columns == ["directory", "video"]
+                                    for index in db.get_indexes("video")):
+        return
+
+    duplicates = (Video
+                  .select(fn.MIN(Video.id), fn.MAX(Video.total_frames), fn.MAX(Video.frame_times_processed),
+                          fn.MAX(Video.pollinators_processed), fn.MAX(Video.motion_processed))
+                  .group_by(Video.directory, Video.video)
+                  .having(fn.COUNT(Video.id) > 1)
+                  .tuples())
+    with write_transaction():
+        for kept, total_frames, frame_times, pollinators, motion in duplicates:
+            entry = Video.get_by_id(kept)
+            print("[*] Merging the duplicate database entries of {}...".format(entry.video))
+            others = Video.select(Video.id).where((Video.directory == entry.directory) & (Video.video == entry.video) &
+                                                  (Video.id != kept))
+            DiscreteVisitor.update(video=kept).where(DiscreteVisitor.video.in_(others)).execute()
+            Video.delete().where(Video.id.in_(others)).execute()
+            Video.update(total_frames=total_frames, frame_times_processed=frame_times, pollinators_processed=pollinators,
+                         motion_processed=motion).where(Video.id == kept).execute()
+
+
+def parse_legacy_directory(directory):
+    """
+    Returns the directory held by the repr of a Video(directory, files)
+    tuple, as stored by older versions, or the directory itself when it
+    isn't such a repr.
+    """
+    match = LEGACY_DIRECTORY_RE.match(directory)
+    if match is None:
+        return directory
+    return ast.literal_eval(match.group(1))
+
+
+def normalize_frame_directories():
+    """
+    Replaces the directories of the frames stored by older versions,
+    which hold the repr of the whole Video(directory, files) tuple, with
+    the directory itself, so that the frames are found by the directory
+    of their video again. Each chunk of directories is rewritten in a
+    single pass over the table.
+    """
+    legacy = (Frame
+              .select(Frame.directory)
+              .where(fn.substr(Frame.directory, 1, len(LEGACY_DIRECTORY_PREFIX)) == LEGACY_DIRECTORY_PREFIX)
+              .distinct()
+              .tuples())
+    directories = [directory for (directory,) in legacy]
+    if not directories:
+        return
+    print("[*] Normalizing {} frame directories stored by an older version...".format(len(directories)))
+    for batch in chunked(directories, 100):
+        Frame.update(directory=Case(Frame.directory, [(directory, parse_legacy_directory(directory))
+                                                      for directory in batch])) \
+            .where(Frame.directory.in_(batch)).execute()
+
+
+def merge_legacy_videos():
+    """
+    Merges the videos that collapse_frames added under the repr of a
+    Video(directory, files) tuple, before the directories of the frames
+    were normalized, into the video of the directory the repr holds.
+    Their segments are moved over unless the video already has
+    segments, and a video that doesn't exist yet takes over the row.
+    """
+    legacy = Video.select().where(fn.substr(Video.directory, 1, len(LEGACY_DIRECTORY_PREFIX)) ==
+                                  LEGACY_DIRECTORY_PREFIX)
+    for video in legacy:
+        directory = parse_legacy_directory(video.directory)
+        existing = Video.get_or_none((Video.directory == directory) & (Video.video == video.video))
+        if existing is None:
+            split = directory.split(os.path.sep)[-2:]
+            Video.update(directory=directory, site=split[0], plant=split[-1]).where(Video.id == video.id).execute()
+            continue
+
+        print("[*] Merging the duplicate database entry of {} into the entry of its directory...".format(video.video))
+        if TimestampSegment.select().where(TimestampSegment.video == existing).exists():
+            TimestampSegment.delete().where(TimestampSegment.video == video).execute()
+        else:
+            TimestampSegment.update(video=existing).where(TimestampSegment.video == video).execute()
+        DiscreteVisitor.update(video=existing).where(DiscreteVisitor.video == video).execute()
+        Video.delete().where(Video.id == video.id).execute()
+
+
+# Rewrites of the data stored by older versions, in the order they were introduced. See migrate_data.
+DATA_MIGRATIONS = [normalize_frame_directories, merge_legacy_videos]
+
+
+def migrate_data():
+    """
+    Runs the data migrations that haven't been run on the database yet.
+    The number of migrations that have been run is kept in the
+    user_version of the database, which is updated in the same
+    transaction as each migration.
+    """
+    version = db.execute_sql("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(DATA_MIGRATIONS[version:], version + 1):
+        with write_transaction():
+            migration()
+            db.execute_sql("PRAGMA user_version = {:d}".format(number))
+
+
+@with_connection
 def setup():
-    db.create_tables([DiscreteVisitor, Frame, LogEntry, Video])
+    """
+    Creates the database tables along with the indexes declared on
+    each model. Both are created with IF NOT EXISTS, so indexes added
+    to the models are also built on existing databases. Columns added
+    to the models are first added to existing tables, since the new
+    indexes may cover them, and duplicate videos are merged, since the
+    new unique index of the Video table rejects them. The data stored by
+    older versions is then migrated.
+    """
+    models = [DiscreteVisitor, Frame, FrameChunk, LogEntry, MotionInterval, TimestampSegment, Video]
+    add_missing_columns(models)
+    merge_duplicate_videos()
+    db.create_tables(models)
+    migrate_data()
@@ -0,0 +1,88 @@
+"""
+Checks that CopyFilter lets through the same copy of each video
+whatever order the videos are listed and processed in.
+"""
+import os
+import random
+
+import pytest
+
+from catalog import CopyFilter, sync_catalog
+from rana_logger import Video
+from utils import get_video_list
+
+# The content of each video file by its path under the video directory. Files with the same content are copies.
+FILES = {
+    ("SiteA", "Plant1", "MOVI0001.avi"): b"clip a",
+    ("SiteA", "Plant1", "MOVI0002.avi"): b"clip b",
+    ("SiteB", "Plant1", "MOVI0007.avi"): b"clip a",
+    ("SiteB", "Plant1", "MOVI0002.avi"): b"clip b",
+    ("SiteB", "Plant3", "MOVI0001.avi"): b"clip a",
+    ("SiteC", "Plant2", "MOVI0001.avi"): b"clip a",
+    ("SiteC", "Plant2", "MOVI0003.avi"): b"clip c",
+    ("SiteC", "Plant2", "MOVI0004.avi"): b"clip d",
+}
+
+
+@pytest.fixture
+def video_path(database, tmp_path):
+    root = tmp_path / "videos"
+    for (site, plant, video), content in FILES.items():
+        directory = root / site / plant
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / video).write_bytes(content * 1000)
+
+    # Cataloged in a shuffled order, so the first copy of a video isn't the first in any particular order
+    random.seed(0)
+    sync_catalog(get_video_list(str(root)))
+    # A video that hasn't been fingerprinted yet
+    Video.update(fingerprint=None).where(Video.video == "MOVI0004.avi").execute()
+    return str(root)
+
+
+def get_kept(video_path):
+    """
+    Lists the videos of a run in the order get_video_list shuffles them
+    into and returns the videos that CopyFilter lets through, in the
+    order they are processed.
+    """
+    video_list = get_video_list(video_path)
+    copies = CopyFilter(video_list)
+    return [(vdir.directory, video) for vdir in video_list for video in vdir.files
+            if not copies.is_copy(vdir.directory, video)]
+
+
+def test_same_copies_kept_in_any_order(video_path):
+    random.seed(1)
+    kept = get_kept(video_path)
+    # One copy of each clip, and the video without a fingerprint
+    assert len(kept) == 4
+    assert sorted(FILES[tuple(directory.split(os.path.sep)[-2:]) + (video,)] for directory, video in kept) == [
+        b"clip a", b"clip b", b"clip c", b"clip d"]
+
+    # The first copy added to the catalog is kept
+    first = {}
+    for video in Video.select().order_by(Video.id):
+        if video.fingerprint is not None:
+            first.setdefault(video.fingerprint, (video.directory, video.video))
+    assert set(first.values()) <= set(kept)
+
+    for seed in range(2, 30):
+        random.seed(seed)
+        assert sorted(get_kept(video_path)) == sorted(kept)
+
+
+def test_copies_within_part_of_run(video_path):
+    """
+    The classifier only lists the videos of the preferred sites, in
+    which case the first copy among the listed videos is kept.
+    """
+    random.seed(1)
+    video_list = [vdir for vdir in get_video_list(video_path) if os.path.basename(os.path.dirname(vdir.directory))
+                  in ("SiteB", "SiteC")]
+    copies = CopyFilter(video_list)
+    ids = dict(((video.directory, video.video), video.id) for video in Video.select())
+    clip_a = [(vdir.directory, video) for vdir in video_list for video in vdir.files
+              if FILES[tuple(vdir.directory.split(os.path.sep)[-2:]) + (video,)] == b"clip a"]
+    kept = [key for key in clip_a if not copies.is_copy(*key)]
+    assert kept == [min(clip_a, key=ids.get)]
@@ -0,0 +1,150 @@
+import csv
+import gzip
+import os
+from datetime import date, datetime
+
+import pytest
+
+import export
+from rana_logger import DiscreteVisitor, Frame, LogEntry, TimestampSegment, Video
+
+
+def add_video(directory, video):
+    split = directory.split(os.path.sep)[-2:]
+    return Video.create(directory=directory, video=video, site=split[0], plant=split[1], total_frames=0,
+                        frame_times_processed=False, pollinators_processed=False)
+
+
+def add_entry(video, frame, timestamp):
+    return LogEntry.create(directory=video.directory, video=video.video, timestamp=timestamp, classification="Pollinator",
+                           pol_id="Bombus", size=1.5, bbox="(1, 2, 3, 4)", frame=frame)
+
+
+def add_visitor(video, pol_id, behavior, day, num_visits):
+    return DiscreteVisitor.create(video=video, pol_id=pol_id, behavior=behavior, size="m", date=day,
+                                  num_visits=num_visits, recent_frame=10)
+
+
+@pytest.fixture
+def videos(database):
+    first = add_video(os.path.join("videos", "SiteA", "Plant1"), "MOVI0001.avi")
+    second = add_video(os.path.join("videos", "SiteB", "Plant2"), "MOVI0002.avi")
+    # Processed before segments were introduced, so its frame times are Frame rows
+    legacy = add_video(os.path.join("videos", "SiteA", "Plant1"), "MOVI0003.avi")
+
+    add_entry(first, 10, datetime(2019, 6, 12, 13, 0, 0))
+    add_entry(first, 20, datetime(2019, 6, 13, 9, 30, 0))
+    add_entry(second, 5, None)
+    add_visitor(first, "Bombus", "Foraging", date(2019, 6, 12), 2)
+    add_visitor(first, "Bombus", "Resting", date(2019, 6, 12), 1)
+    add_visitor(first, "Osmia", "Foraging", date(2019, 6, 13), 1)
+    add_visitor(second, "Bombus", "Foraging", date(2019, 6, 14), 3)
+
+    TimestampSegment.create(video=first, start_frame=1, end_frame=30, timestamp=datetime(2019, 6, 12, 13, 0, 0))
+    TimestampSegment.create(video=first, start_frame=31, end_frame=60, timestamp=datetime(2019, 6, 12, 13, 0, 1))
+    Frame.create(directory=legacy.directory, video=legacy.video, frame=1, timestamp=datetime(2019, 6, 12, 14, 0, 0))
+    Frame.create(directory=legacy.directory, video=legacy.video, frame=2, timestamp=datetime(2019, 6, 12, 14, 0, 0))
+    return first, second, legacy
+
+
+def run_export(output_path, **options):
+    arguments = {"output_path": str(output_path), "format": "csv", "compress": False, "tables": None,
+                 "site": None, "plant": None, "start_date": None, "end_date": None, "chunk_rows": 2}
+    arguments.update(options)
+    export.main(arguments)
+
+
+def read_csv(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_export_csv(videos, tmp_path):
+    run_export(tmp_path)
+
+    entries = read_csv(str(tmp_path / "log_entries.csv"))
+    assert [(row["site"], row["plant"], row["video"], row["frame"], row["timestamp"]) for row in entries] == [
+        ("SiteA", "Plant1", "MOVI0001.avi", "10", "2019-06-12 13:00:00"),
+        ("SiteA", "Plant1", "MOVI0001.avi", "20", "2019-06-13 09:30:00"),
+        ("SiteB", "Plant2", "MOVI0002.avi", "5", "")]
+    assert entries[0]["manual"] == "0"
+    assert entries[0]["bbox"] == "(1, 2, 3, 4)"
+
+    visitors = read_csv(str(tmp_path / "visitors.csv"))
+    assert [(row["video"], row["date"], row["pol_id"], row["num_visits"]) for row in visitors] == [
+        ("MOVI0001.avi", "2019-06-12", "Bombus", "2"),
+        ("MOVI0001.avi", "2019-06-12", "Bombus", "1"),
+        ("MOVI0001.avi", "2019-06-13", "Osmia", "1"),
+        ("MOVI0002.avi", "2019-06-14", "Bombus", "3")]
+
+    # Segments come first, then the frames of videos processed before segments were introduced
+    frame_times = read_csv(str(tmp_path / "frame_times.csv"))
+    assert [(row["video"], row["start_frame"], row["end_frame"], row["timestamp"]) for row in frame_times] == [
+        ("MOVI0001.avi", "1", "30", "2019-06-12 13:00:00"),
+        ("MOVI0001.avi", "31", "60", "2019-06-12 13:00:01"),
+        ("MOVI0003.avi", "1", "1", "2019-06-12 14:00:00"),
+        ("MOVI0003.avi", "2", "2", "2019-06-12 14:00:00")]
+
+
+def test_export_visit_summary(videos, tmp_path):
+    run_export(tmp_path, tables=["visit_summary"])
+
+    assert not os.path.exists(str(tmp_path / "log_entries.csv"))
+    summary = read_csv(str(tmp_path / "visit_summary.csv"))
+    assert [(row["site"], row["plant"], row["date"], row["pol_id"], row["visits"], row["videos"])
+            for row in summary] == [
+        ("SiteA", "Plant1", "2019-06-12", "Bombus", "3", "1"),
+        ("SiteA", "Plant1", "2019-06-13", "Osmia", "1", "1"),
+        ("SiteB", "Plant2", "2019-06-14", "Bombus", "3", "1")]
+
+
+def test_export_compressed_csv(videos, tmp_path):
+    run_export(tmp_path / "plain")
+    run_export(tmp_path / "compressed", compress=True)
+
+    for table in export.TABLES:
+        compressed = str(tmp_path / "compressed" / (table + ".csv.gz"))
+        with open(compressed, "rb") as f:
+            assert f.read(2) == b"\x1f\x8b"
+        assert read_csv(compressed) == read_csv(str(tmp_path / "plain" / (table + ".csv")))
+
+
+def test_export_filters(videos, tmp_path):
+    run_export(tmp_path / "site", site="SiteA", plant="Plant1")
+    entries = read_csv(str(tmp_path / "site" / "log_entries.csv"))
+    assert [row["frame"] for row in entries] == ["10", "20"]
+    frame_times = read_csv(str(tmp_path / "site" / "frame_times.csv"))
+    assert set(row["video"] for row in frame_times) == {"MOVI0001.avi", "MOVI0003.avi"}
+
+    run_export(tmp_path / "plant", plant="Plant2")
+    assert [row["video"] for row in read_csv(str(tmp_path / "plant" / "visitors.csv"))] == ["MOVI0002.avi"]
+
+    # The end date is inclusive, and rows without a date are left out of a range
+    run_export(tmp_path / "dates", start_date=date(2019, 6, 13), end_date=date(2019, 6, 13))
+    entries = read_csv(str(tmp_path / "dates" / "log_entries.csv"))
+    assert [row["timestamp"] for row in entries] == ["2019-06-13 09:30:00"]
+    summary = read_csv(str(tmp_path / "dates" / "visit_summary.csv"))
+    assert [(row["date"], row["pol_id"]) for row in summary] == [("2019-06-13", "Osmia")]
+    assert read_csv(str(tmp_path / "dates" / "frame_times.csv")) == []
+
+
+def test_export_parquet(videos, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    run_export(tmp_path / "csv")
+    run_export(tmp_path / "parquet", format="parquet")
+
+    for table in export.TABLES:
+        parquet = pq.read_table(str(tmp_path / "parquet" / (table + ".parquet")))
+        columns, _ = export.EXPORTS[table]()
+        assert parquet.schema.names == [name for name, _ in columns]
+
+        rows = read_csv(str(tmp_path / "csv" / (table + ".csv")))
+        assert parquet.num_rows == len(rows)
+        for row, expected in zip(parquet.to_pylist(), rows):
+            for name, value in row.items():
+                if value is None:
+                    value = ""
+                elif isinstance(value, bool):
+                    value = str(int(value))
+                assert str(value) == expected[name], (table, name)
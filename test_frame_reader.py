@@ -0,0 +1,157 @@
+"""
+Checks which frames FrameReader delivers for combinations of stride
+and frame ranges, and how its queue behaves when it is full.
+"""
+import time
+from threading import Thread
+
+import cv2
+import numpy as np
+import pytest
+
+import frame_reader
+from frame_reader import FrameReader
+
+FRAME_COUNT = 60
+WIDTH, HEIGHT = 64, 48
+FRAME_BYTES = WIDTH * HEIGHT * 3
+
+
+def get_level(frame_number):
+    return (frame_number * 4) % 256
+
+
+@pytest.fixture(scope="module")
+def video(tmp_path_factory):
+    """
+    Writes a video whose frames are each filled with a gray level from
+    their frame number, with a white square in the top left corner.
+    """
+    path = str(tmp_path_factory.mktemp("videos") / "MOVI0001.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30.0, (WIDTH, HEIGHT))
+    assert writer.isOpened()
+    for frame_number in range(1, FRAME_COUNT + 1):
+        frame = np.full((HEIGHT, WIDTH, 3), get_level(frame_number), np.uint8)
+        frame[:16, :16] = 255
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def read_all(reader):
+    items = []
+    item = reader.read()
+    while item is not None:
+        items.append(item)
+        item = reader.read()
+    return items
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def get_expected(stride, start_frame, end_frame):
+    last = min(end_frame or FRAME_COUNT, FRAME_COUNT)
+    return [frame_number for frame_number in range((start_frame or 0) + 1, last + 1)
+            if (frame_number - 1) % stride == 0]
+
+
+@pytest.mark.parametrize("stride", [1, 2, 3, 7])
+@pytest.mark.parametrize("start_frame, end_frame", [(None, None), (10, None), (11, None), (None, 25), (9, 30),
+                                                    (13, 13), (20, 14), (50, 100), (59, None), (60, None)])
+def test_stride_and_range(video, stride, start_frame, end_frame):
+    reader = FrameReader(video, stride=stride, start_frame=start_frame, end_frame=end_frame).start()
+    items = read_all(reader)
+    reader.stop()
+
+    # Frames 1, 1 + stride, ... within the range, whatever frame reading starts from
+    expected = get_expected(stride, start_frame, end_frame)
+    assert [frame_number for frame_number, _ in items] == expected
+    for frame_number, frame in items:
+        assert frame.shape == (HEIGHT, WIDTH, 3)
+        assert abs(frame[24:, 32:].mean() - get_level(frame_number)) < 2, frame_number
+    assert reader.frames_read == len(expected)
+
+
+@pytest.mark.parametrize("seek_min_frames", [0, frame_reader.SEEK_MIN_FRAMES])
+@pytest.mark.parametrize("stride", [1, 3])
+@pytest.mark.parametrize("ranges", [[(0, 5), (5, 12), (30, 34)], [(2, 8), (40, None)], [(10, 20), (15, 25), (18, 22)],
+                                    [(13, 13), (20, 21), (58, 70), (65, 80)], [(None, 3), (59, 60)], []])
+def test_ranges(video, monkeypatch, seek_min_frames, stride, ranges):
+    # Gaps between ranges are either all seeked over or all grabbed through
+    monkeypatch.setattr(frame_reader, "SEEK_MIN_FRAMES", seek_min_frames)
+    reader = FrameReader(video, stride=stride, ranges=ranges).start()
+    items = read_all(reader)
+    reader.stop()
+
+    # The frames of each range in turn, without reading frames twice where ranges overlap
+    expected = []
+    for start_frame, end_frame in ranges:
+        expected.extend(frame_number for frame_number in get_expected(stride, start_frame, end_frame)
+                        if not expected or frame_number > expected[-1])
+    assert [frame_number for frame_number, _ in items] == expected
+    for frame_number, frame in items:
+        assert abs(frame[24:, 32:].mean() - get_level(frame_number)) < 2, frame_number
+
+
+def test_roi_only(video):
+    roi = (4, 20, 8, 40)
+    reader = FrameReader(video, stride=5, start_frame=3, roi=roi).start()
+    items = read_all(reader)
+    reader.stop()
+    full = FrameReader(video, stride=5, start_frame=3).start()
+    full_items = read_all(full)
+    full.stop()
+
+    assert [frame_number for frame_number, _ in items] == [frame_number for frame_number, _ in full_items]
+    (y0, y1, x0, x1) = roi
+    for (_, frame), (_, full_frame) in zip(items, full_items):
+        assert frame.shape == (16, 32, 3)
+        assert frame.flags["C_CONTIGUOUS"]
+        assert np.array_equal(frame, full_frame[y0:y1, x0:x1])
+
+
+def test_memory_budget(video):
+    # Room for two frames
+    reader = FrameReader(video, memory_mb=2.5 * FRAME_BYTES / (1024.0 * 1024.0)).start()
+    wait_for(lambda: reader.decoder_stalls > 0)
+    assert reader.depth() == 2
+    assert reader.queued_bytes == 2 * FRAME_BYTES
+
+    items = read_all(reader)
+    reader.stop()
+    assert [frame_number for frame_number, _ in items] == list(range(1, FRAME_COUNT + 1))
+    assert reader.max_depth == 2
+    assert reader.max_queued_bytes == 2 * FRAME_BYTES
+    assert reader.queued_bytes == 0
+    assert reader.summary().startswith("Read {} frames. The queue held up to 2 frames".format(FRAME_COUNT))
+
+
+def test_frame_larger_than_budget(video):
+    reader = FrameReader(video, memory_mb=0.001).start()
+    wait_for(lambda: reader.decoder_stalls > 0)
+    # A frame larger than the budget is still queued on its own
+    assert reader.depth() == 1
+    assert len(read_all(reader)) == FRAME_COUNT
+    reader.stop()
+    assert reader.max_depth == 1
+
+
+def test_stop_while_decoder_blocked(video):
+    reader = FrameReader(video, memory_mb=0.001).start()
+    wait_for(lambda: reader.decoder_stalls > 0)
+
+    stopping = Thread(target=reader.stop)
+    stopping.start()
+    stopping.join(timeout=10)
+    assert not stopping.is_alive()
+    assert not reader.thread.is_alive()
+
+    # The frame that was queued is still read, and then reading ends rather than blocking
+    items = read_all(reader)
+    assert [frame_number for frame_number, _ in items] == [1]
+    assert reader.read() is None
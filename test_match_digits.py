@@ -0,0 +1,62 @@
+"""
+Checks that match_digits classifies digit ROIs as the reference digit
+with the highest cv2.matchTemplate(TM_CCOEFF) score, as classify_digits
+did with one call per ROI and reference digit.
+"""
+import cv2
+import numpy as np
+import pytest
+
+from utils import match_digits, process_reference_digits
+
+# Number of ROIs checked per kind
+ROI_COUNT = 200
+
+
+@pytest.fixture(scope="module")
+def reference_digits():
+    return process_reference_digits()
+
+
+def match_template(roi, digits):
+    return [cv2.minMaxLoc(cv2.matchTemplate(roi, digit_roi, cv2.TM_CCOEFF))[1] for digit_roi in digits.values()]
+
+
+def get_random_rois(rng, digits):
+    return [(rng.rand(88, 57, 3) * 255).astype(np.uint8) for _ in range(ROI_COUNT)]
+
+
+def get_noisy_rois(rng, digits):
+    # Reference digits shifted in brightness, with noise, as digits read from frames are
+    rois = []
+    for i in range(ROI_COUNT):
+        digit = digits[i % len(digits)].astype(np.float64)
+        noisy = digit * rng.uniform(0.5, 1.2) + rng.uniform(-40, 40) + rng.normal(0, rng.uniform(5, 80), digit.shape)
+        rois.append(np.clip(noisy, 0, 255).astype(np.uint8))
+    return rois
+
+
+@pytest.mark.parametrize("get_rois", [get_random_rois, get_noisy_rois])
+def test_match_digits_matches_template_matching(reference_digits, get_rois):
+    rng = np.random.RandomState(0)
+    rois = get_rois(rng, reference_digits.digits)
+
+    labels = match_digits(rois, reference_digits.templates)
+    assert len(labels) == len(rois)
+    for roi, label in zip(rois, labels):
+        scores = match_template(roi, reference_digits.digits)
+        best = int(np.argmax(scores))
+        if int(label) != best:
+            # matchTemplate sums in single precision, so only a near tie may be broken the other way
+            assert scores[int(label)] == pytest.approx(scores[best], rel=1e-5)
+
+
+def test_noisy_digits_are_read(reference_digits):
+    rng = np.random.RandomState(1)
+    rois = get_noisy_rois(rng, reference_digits.digits)
+    labels = match_digits(rois, reference_digits.templates)
+    assert labels == [str(i % len(reference_digits.digits)) for i in range(ROI_COUNT)]
+
+
+def test_match_digits_without_rois(reference_digits):
+    assert match_digits([], reference_digits.templates) == []
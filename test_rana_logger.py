@@ -0,0 +1,510 @@
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import BoundedSemaphore, Event, Thread
+
+import pytest
+from peewee import fn
+
+import rana_logger
+from frame_times import write_frame_times
+from rana_logger import DatabaseWriter, DiscreteVisitor, Frame, LogEntry, SegmentWriter, TimestampSegment, Video, \
+    add_segments, backfill_timestamps, close_connection, collapse_frames, get_db_pragmas, get_frame_times, \
+    get_frame_videos, get_segment_times, get_time_of_frame
+
+
+def get_plan(query):
+    sql, params = query.sql() if hasattr(query, "sql") else (query, ())
+    return [row[3] for row in rana_logger.db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def test_frame_videos_match_distinct(database):
+    rng = random.Random(0)
+    rows = [{"directory": "videos/Site{}/Plant{}".format(rng.randint(0, 3), rng.randint(0, 3)),
+             "video": "MOVI{:04d}.avi".format(rng.randint(0, 20)),
+             "frame": rng.randint(1, 1000),
+             "timestamp": datetime(2019, 6, 12)} for _ in range(2000)]
+    Frame.insert_many(rows).execute()
+
+    distinct = Frame.select(Frame.directory, Frame.video).distinct().order_by(Frame.directory, Frame.video).tuples()
+    assert get_frame_videos() == list(distinct)
+
+
+def test_frame_videos_empty(database):
+    assert get_frame_videos() == []
+
+
+def test_frame_lookups_use_index(database):
+    index = "USING COVERING INDEX frame_directory_video_frame"
+    last = Frame.select(fn.MAX(Frame.frame)).where((Frame.video == "a.avi") & (Frame.directory == "videos"))
+    assert get_plan(last) == ["SEARCH t1 {} (directory=? AND video=?)".format(index)]
+
+    timed = Frame.select(Frame.frame, Frame.timestamp).where((Frame.video == "a.avi") & (Frame.directory == "videos") &
+                                                             Frame.timestamp.is_null(False))
+    before = timed.where(Frame.frame <= 10).order_by(Frame.frame.desc()).limit(1)
+    assert get_plan(before) == ["SEARCH t1 USING INDEX frame_directory_video_frame (directory=? AND video=? AND "
+                                "frame<?)"]
+
+    # Each video of the Frame table is found with probes of the index rather than a scan of the table
+    plan = get_plan(rana_logger.FRAME_VIDEOS_SQL)
+    assert "SEARCH f {} (directory=? AND video>?)".format(index) in plan
+    assert "SEARCH f {} (directory>?)".format(index) in plan
+    assert not any(step.startswith("USE TEMP B-TREE") for step in plan)
+
+
+# The tables of the Video and DiscreteVisitor models before any index was declared on them
+BASELINE_SCHEMA = """
+CREATE TABLE "video" ("id" INTEGER NOT NULL PRIMARY KEY, "directory" VARCHAR(255) NOT NULL,
+    "video" VARCHAR(255) NOT NULL, "site" VARCHAR(255) NOT NULL, "plant" VARCHAR(255) NOT NULL,
+    "total_frames" INTEGER NOT NULL, "frame_times_processed" INTEGER NOT NULL, "pollinators_processed" INTEGER NOT NULL);
+CREATE TABLE "discretevisitor" ("id" INTEGER NOT NULL PRIMARY KEY, "video_id" INTEGER NOT NULL, "date" DATE,
+    "pol_id" VARCHAR(255) NOT NULL, "num_visits" INTEGER NOT NULL, "behavior" VARCHAR(255) NOT NULL,
+    "size" VARCHAR(255) NOT NULL, "ppt_slide" INTEGER, "notes" TEXT, "recent_frame" INTEGER NOT NULL,
+    FOREIGN KEY ("video_id") REFERENCES "video" ("id"));
+"""
+
+
+def test_setup_merges_duplicate_videos(empty_database):
+    for statement in BASELINE_SCHEMA.split(";")[:-1]:
+        empty_database.execute_sql(statement)
+    empty_database.execute_sql(
+        "INSERT INTO video VALUES (1, 'videos/S/P', 'a.avi', 'S', 'P', 0, 0, 0), (2, 'videos/S/P', 'a.avi', 'S', 'P', "
+        "100, 1, 0), (3, 'videos/S/P', 'b.avi', 'S', 'P', 5, 0, 0), (4, 'videos/S/P', 'a.avi', 'S', 'P', 0, 0, 1)")
+    empty_database.execute_sql(
+        "INSERT INTO discretevisitor VALUES (1, 2, NULL, 'Bombus', 1, 'Foraging', 'm', NULL, NULL, 3), "
+        "(2, 4, NULL, 'Osmia', 1, 'Foraging', 'm', NULL, NULL, 4), (3, 3, NULL, 'Osmia', 1, 'Foraging', 'm', NULL, "
+        "NULL, 4)")
+
+    rana_logger.setup()
+
+    videos = Video.select(Video.id, Video.video, Video.total_frames, Video.frame_times_processed,
+                          Video.pollinators_processed).order_by(Video.id).tuples()
+    assert list(videos) == [(1, "a.avi", 100, True, True), (3, "b.avi", 5, False, False)]
+    visitors = DiscreteVisitor.select(DiscreteVisitor.id, DiscreteVisitor.video).order_by(DiscreteVisitor.id).tuples()
+    assert list(visitors) == [(1, 1), (2, 1), (3, 3)]
+    assert any(index.unique and index.columns == ["directory", "video"]
+               for index in empty_database.get_indexes("video"))
+
+
+def add_site(site, fail=False):
+    video = Video.create(directory=os.path.join("videos", site, "Plant"), video="MOVI0001.avi", site=site,
+                         plant="Plant", total_frames=0, frame_times_processed=False, pollinators_processed=False)
+    if fail:
+        raise ValueError("failing write of {}".format(site))
+    return video
+
+
+def add_site_visitor(video, pol_id):
+    return DiscreteVisitor.create(video=video, pol_id=pol_id, behavior="Foraging", size="m", num_visits=1)
+
+
+def get_sites():
+    return [site for (site,) in Video.select(Video.site).order_by(Video.id).tuples()]
+
+
+@pytest.fixture
+def writer(database):
+    writer = DatabaseWriter(batch_size=10).start()
+    yield writer
+    writer.close()
+
+
+def block(writer):
+    """
+    Holds up the writer thread until the returned event is set, so that
+    the writes submitted in the meantime queue up behind it.
+    """
+    blocked, release = Event(), Event()
+
+    def wait():
+        blocked.set()
+        release.wait()
+
+    writer.submit(wait)
+    blocked.wait()
+    return release
+
+
+def test_writer_keeps_order(writer):
+    release = block(writer)
+    futures = [writer.submit(add_site, "Site{:02d}".format(i)) for i in range(35)]
+    release.set()
+    writer.flush()
+
+    assert get_sites() == ["Site{:02d}".format(i) for i in range(35)]
+    assert [future.result().id for future in futures] == list(range(1, 36))
+    # The writes that queued up are committed in transactions of at most batch_size writes
+    assert writer.transactions == 5
+    assert writer.failures == 0
+
+
+def test_writer_passes_results_to_later_writes(writer):
+    # Resolved within the same transaction as the write it depends on
+    release = block(writer)
+    video = writer.submit(add_site, "SiteA")
+    visitor = writer.submit(add_site_visitor, video, pol_id="Bombus")
+    release.set()
+    assert visitor.result().video_id == video.result().id
+
+    # Resolved from an earlier transaction
+    visitor = writer.submit(add_site_visitor, video=video, pol_id="Osmia")
+    assert visitor.result().video_id == video.result().id
+    assert DiscreteVisitor.select().where(DiscreteVisitor.video == video.result()).count() == 2
+
+
+def test_writer_rolls_back_failing_write_only(writer):
+    release = block(writer)
+    with writer.group():
+        first = writer.submit(add_site, "SiteA")
+        failing = writer.submit(add_site, "SiteB", fail=True)
+        dependent = writer.submit(add_site_visitor, failing, pol_id="Bombus")
+        last = writer.submit(add_site, "SiteC")
+    release.set()
+    writer.flush()
+
+    # The rows of the failing write are rolled back along with it, and the writes that depend on it fail
+    assert get_sites() == ["SiteA", "SiteC"]
+    assert first.result().site == "SiteA" and last.result().site == "SiteC"
+    with pytest.raises(ValueError):
+        failing.result()
+    with pytest.raises(ValueError):
+        dependent.result()
+    assert DiscreteVisitor.select().count() == 0
+    assert writer.failures == 2
+
+
+def test_writer_flush_and_close_drain_queue(database):
+    writer = DatabaseWriter(batch_size=10).start()
+    release = block(writer)
+    futures = [writer.submit(add_site, "Site{:02d}".format(i)) for i in range(25)]
+    assert not any(future.done() for future in futures)
+    release.set()
+    writer.flush()
+    assert all(future.done() for future in futures)
+    assert len(get_sites()) == 25
+
+    release = block(writer)
+    futures = [writer.submit(add_site, "Site{:02d}".format(i)) for i in range(25, 50)]
+    closing = Thread(target=writer.close)
+    closing.start()
+    while not writer.stopped:
+        time.sleep(0.001)
+    # Closed with the writes still queued
+    assert not any(future.done() for future in futures)
+    release.set()
+    closing.join()
+    assert all(future.done() for future in futures)
+    assert not writer.thread.is_alive()
+    assert len(get_sites()) == 50
+    assert writer.summary() == "Committed 52 database writes in {} transactions with 0 failures.".format(
+        writer.transactions)
+
+    with pytest.raises(RuntimeError):
+        writer.submit(add_site, "SiteZ")
+
+
+def add_timed_video(site, fps=30.0, stride=None, processed=True, fingerprint=None):
+    return Video.create(directory=os.path.join("videos", site, "Plant"), video="MOVI0001.avi", site=site,
+                        plant="Plant", total_frames=0, fps=fps, stride=stride, frame_times_processed=processed,
+                        pollinators_processed=False, fingerprint=fingerprint)
+
+
+def get_random_times(rng, frames, stride):
+    """
+    Returns (start_frame, end_frame, timestamp) runs of the frames of a
+    video read with a stride. The clock runs slow, fast or jumps at
+    times and some runs couldn't be read, so that interpolated times
+    run into the next time, and frames end up out of reach of a time.
+    """
+    runs = []
+    frame = 1
+    time = datetime(2019, 6, 12, 13, 0, 0)
+    while frame < frames:
+        length = rng.choice([1, 5, 30, 30, 30, 60])
+        length -= length % stride
+        timestamp = None if rng.random() < 0.15 else time
+        runs.append((frame, frame + max(length, stride) - stride, timestamp))
+        frame += max(length, stride)
+        time += timedelta(seconds=rng.choice([0, 1, 1, 1, 2, 7, -1]))
+        if rng.random() < 0.1:
+            # Frames that weren't read, over which the clock moves on
+            gap = rng.randint(1, 300)
+            frame += gap
+            time += timedelta(seconds=1 + gap // 15)
+    return runs
+
+
+def add_log_rows(video, frames):
+    LogEntry.insert_many([{"directory": video.directory, "video": video.video, "classification": "Pollinator",
+                           "size": 1.0, "bbox": "", "frame": frame} for frame in frames]).execute()
+    DiscreteVisitor.insert_many([{"video": video, "pol_id": "Bombus", "num_visits": 1, "behavior": "Foraging",
+                                  "size": "m", "recent_frame": frame} for frame in frames]).execute()
+
+
+def assert_backfill_matches(video, frames, timed=None):
+    """
+    Checks the times backfilled for a log entry and visitor on every
+    frame against get_time_of_frame. Frames in timed are expected to
+    be filled, other frames to be left NULL.
+    """
+    entries = dict(LogEntry.select(LogEntry.frame, LogEntry.timestamp)
+                   .where((LogEntry.directory == video.directory) & (LogEntry.video == video.video)).tuples())
+    dates = dict(DiscreteVisitor.select(DiscreteVisitor.recent_frame, DiscreteVisitor.date)
+                 .where(DiscreteVisitor.video == video).tuples())
+    filled = 0
+    for frame in frames:
+        expected = get_time_of_frame(video.directory, video.video, frame)
+        if timed is not None and frame not in timed:
+            expected = None
+        assert entries[frame] == expected, frame
+        assert dates[frame] == (expected.date() if expected is not None else None), frame
+        filled += expected is not None
+    return filled
+
+
+@pytest.mark.parametrize("seed, fps, stride", [(0, 30.0, None), (1, 25.0, 4), (2, 30.0, 90), (3, 15.0, 2)])
+def test_backfill_matches_time_of_frame(database, seed, fps, stride):
+    rng = random.Random(seed)
+    video = add_timed_video("Segments", fps=fps, stride=stride)
+    runs = get_random_times(rng, 1000, stride or 1)
+    TimestampSegment.insert_many([{"video": video, "start_frame": start, "end_frame": end, "timestamp": timestamp}
+                                  for start, end, timestamp in runs]).execute()
+    frames = range(0, runs[-1][1] + 200)
+    add_log_rows(video, frames)
+
+    assert backfill_timestamps(video) == (len(frames) - LogEntry.select().where(LogEntry.timestamp.is_null()).count(),
+                                          len(frames) - DiscreteVisitor.select().where(DiscreteVisitor.date.is_null())
+                                          .count())
+    filled = assert_backfill_matches(video, frames)
+    # Enough of every case is covered: frames given a time, and frames too far from one
+    assert len(frames) / 4 < filled < len(frames)
+
+
+def test_backfill_matches_time_of_frame_through_copy(database):
+    rng = random.Random(4)
+    timed = add_timed_video("Timed", stride=3, fingerprint="abc")
+    copy = add_timed_video("Copy", fps=None, processed=False, fingerprint="abc")
+    runs = get_random_times(rng, 1000, 3)
+    TimestampSegment.insert_many([{"video": timed, "start_frame": start, "end_frame": end, "timestamp": timestamp}
+                                  for start, end, timestamp in runs]).execute()
+    frames = range(0, runs[-1][1] + 100)
+    add_log_rows(copy, frames)
+
+    backfill_timestamps(copy)
+    assert assert_backfill_matches(copy, frames) > len(frames) / 2
+
+
+def test_backfill_matches_time_of_frame_from_frames(database):
+    rng = random.Random(5)
+    video = add_timed_video("Frames")
+    runs = get_random_times(rng, 1000, 1)
+    Frame.insert_many([{"directory": video.directory, "video": video.video, "frame": frame, "timestamp": timestamp}
+                       for start, end, timestamp in runs for frame in range(start, end + 1)]).execute()
+    frames = range(0, runs[-1][1] + 100)
+    add_log_rows(video, frames)
+
+    backfill_timestamps(video)
+    assert assert_backfill_matches(video, frames) > len(frames) / 2
+
+
+def test_backfill_never_runs_past_next_time(database):
+    # The clock stalled over frames that weren't read, so counting frames on from the first segment runs past
+    # the time of the next one, even once it is out of reach of the interpolation window
+    video = add_timed_video("Stalled")
+    start = datetime(2019, 6, 12, 13, 0, 0)
+    TimestampSegment.insert_many([{"video": video, "start_frame": 1, "end_frame": 100, "timestamp": start},
+                                  {"video": video, "start_frame": 200, "end_frame": 250, "timestamp": start}]).execute()
+    frames = range(90, 260)
+    add_log_rows(video, frames)
+
+    backfill_timestamps(video)
+    assert assert_backfill_matches(video, frames) == len(frames) - 39
+    assert LogEntry.get(LogEntry.frame == 130).timestamp == start
+
+
+def test_backfill_waits_for_frames_past_last_time(database):
+    rng = random.Random(6)
+    video = add_timed_video("Unprocessed", processed=False)
+    runs = get_random_times(rng, 1000, 1)
+    TimestampSegment.insert_many([{"video": video, "start_frame": start, "end_frame": end, "timestamp": timestamp}
+                                  for start, end, timestamp in runs]).execute()
+    last_frame = max(end for _, end, timestamp in runs if timestamp is not None)
+    frames = range(0, last_frame + 100)
+    add_log_rows(video, frames)
+
+    backfill_timestamps(video)
+    assert_backfill_matches(video, frames, timed=range(0, last_frame + 1))
+
+    # Once the whole video is processed, the frames past the last time are filled in as well
+    Video.update(frame_times_processed=True).where(Video.id == video.id).execute()
+    backfill_timestamps(Video.get_by_id(video.id))
+    assert_backfill_matches(video, frames)
+
+
+def get_segments(video):
+    return list(TimestampSegment.select(TimestampSegment.start_frame, TimestampSegment.end_frame,
+                                        TimestampSegment.timestamp)
+                .where(TimestampSegment.video == video).order_by(TimestampSegment.start_frame).tuples())
+
+
+def seconds(n):
+    return datetime(2019, 6, 12, 13, 0, 0) + timedelta(seconds=n)
+
+
+def test_segment_writer_run_length_encodes_frames(database):
+    video = add_timed_video("Segments")
+    with SegmentWriter(video) as writer:
+        for frame_number, offset in enumerate([0, 0, 0, 1, 1, None, None, 2, 2, 2, 1], 1):
+            writer.add(time=seconds(offset) if offset is not None else None, frame_number=frame_number)
+
+    assert get_segments(video) == [(1, 3, seconds(0)), (4, 5, seconds(1)), (6, 7, None), (8, 10, seconds(2)),
+                                   (11, 11, seconds(1))]
+
+
+def test_segment_writer_extends_over_skipped_frames(database):
+    video = add_timed_video("Strided", stride=4)
+    with SegmentWriter(video) as writer:
+        for frame_number, offset in ((1, 0), (5, 0), (9, 0), (13, 1), (17, 1), (21, 3)):
+            writer.add(time=seconds(offset), frame_number=frame_number)
+
+    assert get_segments(video) == [(1, 9, seconds(0)), (13, 17, seconds(1)), (21, 21, seconds(3))]
+    # Frames skipped within a segment show its time, and those between segments are interpolated
+    assert get_segment_times(video, 7) == ((7, seconds(0)), (13, seconds(1)))
+    assert get_segment_times(video, 11) == ((9, seconds(0)), (13, seconds(1)))
+    assert [get_time_of_frame(video.directory, video.video, frame) for frame in (3, 11, 12, 18)] == [
+        seconds(0), seconds(0), seconds(0), seconds(2)]
+
+
+def test_segment_writer_replaces_open_segment(database):
+    video = add_timed_video("Batches")
+    writer = SegmentWriter(video, batch_size=3, flush_interval=float("inf"))
+    for frame_number in (1, 2, 3):
+        writer.add(time=seconds(0), frame_number=frame_number)
+    # The segment that is still being extended is written with each batch
+    assert get_segments(video) == [(1, 3, seconds(0))]
+
+    for frame_number, offset in ((4, 0), (5, 0), (6, 1)):
+        writer.add(time=seconds(offset), frame_number=frame_number)
+    assert get_segments(video) == [(1, 5, seconds(0)), (6, 6, seconds(1))]
+
+    writer.add(time=seconds(1), frame_number=7)
+    assert get_segments(video) == [(1, 5, seconds(0)), (6, 6, seconds(1))]
+    writer.flush()
+    assert get_segments(video) == [(1, 5, seconds(0)), (6, 7, seconds(1))]
+
+
+def test_segment_writer_submits_writes(database):
+    video = add_timed_video("Submitted")
+    submitted = []
+    with SegmentWriter(video, submit=lambda func, *args: submitted.append((func, args))) as writer:
+        for frame_number in (1, 2):
+            writer.add(time=seconds(0), frame_number=frame_number)
+
+    assert get_segments(video) == []
+    assert submitted == [(add_segments, ([{"video": video.id, "start_frame": 1, "end_frame": 2,
+                                           "timestamp": seconds(0)}],))]
+
+
+@pytest.mark.parametrize("delete", [False, True])
+def test_collapse_frames_round_trips_frame_times(database, delete):
+    rng = random.Random(7)
+    video = add_timed_video("Collapsed")
+    runs = get_random_times(rng, 1000, 1)
+    rows = [{"directory": video.directory, "video": video.video, "frame": frame, "timestamp": timestamp}
+            for start, end, timestamp in runs for frame in range(start, end + 1)]
+    # The frames are collapsed in frame order, whatever the order of the rows
+    Frame.insert_many(rng.sample(rows, len(rows))).execute()
+    # Frames of another video of the same name aren't collapsed along with them
+    Frame.create(directory="videos/Other/Plant", video=video.video, frame=1, timestamp=seconds(100))
+
+    frames = range(0, rows[-1]["frame"] + 2)
+    # The time of each frame that was read, or of the nearest frame before it with a time
+    read = [row["frame"] for row in rows]
+    frame_times = [get_frame_times(video.directory, video.video, frame)[0] for frame in read]
+    times = [get_time_of_frame(video.directory, video.video, frame) for frame in frames]
+
+    # Runs of the same time are a single segment, which spans any frames missing in between
+    expected = runs[:1]
+    for start, end, timestamp in runs[1:]:
+        if timestamp == expected[-1][2]:
+            expected[-1] = (expected[-1][0], end, timestamp)
+        else:
+            expected.append((start, end, timestamp))
+    assert collapse_frames(video.directory, video.video, delete=delete) == (len(rows), len(expected))
+    segments = get_segments(video)
+    assert segments == expected
+    assert [get_segment_times(video, frame)[0] for frame in read] == frame_times
+    assert [get_time_of_frame(video.directory, video.video, frame) for frame in frames] == times
+
+    remaining = Frame.select().where((Frame.directory == video.directory) & (Frame.video == video.video)).count()
+    assert remaining == (0 if delete else len(rows))
+    assert Frame.select().where(Frame.directory == "videos/Other/Plant").count() == 1
+
+    # Collapsing again leaves the segments as they are
+    collapse_frames(video.directory, video.video, delete=delete)
+    assert get_segments(video) == segments
+
+
+def test_db_pragmas_setting(monkeypatch):
+    assert get_db_pragmas("") == rana_logger.DB_PRAGMAS
+    pragmas = dict(get_db_pragmas(" journal_mode=delete, Synchronous = FULL,cache_size=-2000,foreign_keys=1,"))
+    assert pragmas == {"journal_mode": "delete", "synchronous": "FULL", "cache_size": -2000,
+                       "mmap_size": dict(rana_logger.DB_PRAGMAS)["mmap_size"], "foreign_keys": 1}
+
+    monkeypatch.setenv(rana_logger.DB_PRAGMAS_VARIABLE, "journal_mode=truncate")
+    assert dict(get_db_pragmas())["journal_mode"] == "truncate"
+    monkeypatch.delenv(rana_logger.DB_PRAGMAS_VARIABLE)
+    assert get_db_pragmas() == rana_logger.DB_PRAGMAS
+
+    for setting in ("journal_mode", "journal_mode=", "=wal"):
+        with pytest.raises(ValueError):
+            get_db_pragmas(setting)
+
+
+def test_db_pragmas_applied(empty_database):
+    close_connection()
+    empty_database.init(empty_database.database, pragmas=get_db_pragmas("journal_mode=delete,synchronous=full"))
+    rana_logger.setup()
+    assert empty_database.execute_sql("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert empty_database.execute_sql("PRAGMA synchronous").fetchone()[0] == 2
+
+
+def is_open(database):
+    """
+    Whether any connection to a database in WAL mode is open, since the
+    last connection to close removes the write-ahead log.
+    """
+    close_connection()
+    return os.path.exists(database.database + "-wal")
+
+
+def test_writer_closes_its_connection(database):
+    writer = DatabaseWriter().start()
+    writer.submit(add_site, "SiteA").result()
+    assert is_open(database)
+    writer.close()
+    assert not is_open(database)
+
+
+def test_frame_time_writer_closes_its_connection(database):
+    video = add_timed_video("Written")
+    result_queue = Queue()
+    # Blocks of frames as the OCR threads finish them, out of order
+    result_queue.put((1, [(3, seconds(1)), (4, seconds(1))]))
+    result_queue.put((0, [(1, seconds(0)), (2, seconds(0))]))
+    result_queue.put(None)
+    pending_blocks = BoundedSemaphore(2)
+    pending_blocks.acquire()
+    pending_blocks.acquire()
+    errors = []
+
+    writer = SegmentWriter(video, batch_size=1)
+    thread = Thread(target=write_frame_times, args=(writer, result_queue, 1, pending_blocks, errors))
+    thread.start()
+    thread.join()
+
+    assert errors == []
+    assert get_segments(video) == [(1, 2, seconds(0)), (3, 4, seconds(1))]
+    assert not is_open(database)
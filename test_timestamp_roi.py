@@ -0,0 +1,53 @@
+"""
+Checks that cropping the timestamp area from the native frame and only
+resizing the crop gives the same pixels as resizing the lower half of
+the frame and cropping the timestamp area from it.
+"""
+import cv2
+import imutils
+import numpy as np
+import pytest
+
+from utils import TIMESTAMP_SELECTION_WIDTH, get_native_timestamp_area, get_timestamp_area, get_timestamp_roi
+
+# (width, height) of the frames
+RESOLUTIONS = [(640, 480), (720, 576), (800, 600), (1280, 720), (1280, 960), (1440, 1080), (1920, 1080),
+               (2704, 2028)]
+
+# Number of timestamp boxes checked per resolution
+BOX_COUNT = 40
+
+
+def get_frame(width, height, rng):
+    # Blurred noise, so that resizing mixes neighbouring pixels that differ
+    frame = (rng.rand(height, width, 3) * 255).astype(np.uint8)
+    return cv2.GaussianBlur(frame, (3, 3), 0)
+
+
+def get_boxes(resized_height, rng):
+    """
+    Returns the box frame_times uses by default along with random boxes
+    of the resized lower half of a frame. Boxes may reach past its
+    edges, as a box selected by the user can.
+    """
+    boxes = [(1168, min(246, resized_height - 1), 314, 73)]
+    while len(boxes) < BOX_COUNT:
+        boxes.append((rng.randint(0, TIMESTAMP_SELECTION_WIDTH), rng.randint(0, resized_height),
+                      rng.randint(20, 401), rng.randint(10, max(resized_height, 10) + 1)))
+    return boxes
+
+
+@pytest.mark.parametrize("width, height", RESOLUTIONS)
+def test_native_timestamp_area_matches_resized_frame(width, height):
+    rng = np.random.RandomState(width * height)
+    frame = get_frame(width, height, rng)
+    larger = imutils.resize(frame[int(width / 2):], width=TIMESTAMP_SELECTION_WIDTH)
+
+    for box in get_boxes(larger.shape[0], rng):
+        expected = get_timestamp_area(larger, box)
+        ts_roi = get_timestamp_roi(frame.shape, box)
+        (y0, y1, x0, x1) = ts_roi.native
+        for area in (get_native_timestamp_area(frame, ts_roi),
+                     get_native_timestamp_area(frame[y0:y1, x0:x1], ts_roi, cropped=True)):
+            assert area.shape == expected.shape, box
+            assert np.array_equal(area, expected), box
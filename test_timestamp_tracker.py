@@ -0,0 +1,110 @@
+"""
+Checks how TimestampTracker validates the times read from frames
+against the times predicted from the frame rate, and the counters it
+reports.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from utils import TimestampTracker
+
+START = datetime(2019, 6, 12, 13, 0, 0)
+
+
+def seconds(n):
+    return START + timedelta(seconds=n)
+
+
+def get_tracker(**kwargs):
+    tracker = TimestampTracker(fps=30, max_drift=1, resync_frames=3, **kwargs)
+    assert tracker.validate(0, START) == (START, False)
+    return tracker
+
+
+def test_plausible_times_are_accepted():
+    tracker = get_tracker()
+    # Two seconds of frames later the time shown is 2 or 3 seconds on, plus a second of drift
+    for frame_number, offset in ((60, 2), (61, 3), (90, 4), (150, 6)):
+        assert tracker.validate(frame_number, seconds(offset)) == (seconds(offset), False)
+    assert (tracker.last_frame, tracker.last_time) == (150, seconds(6))
+    assert tracker.corrections == 0
+
+
+def test_implausible_jump_is_replaced_by_predicted_time():
+    tracker = get_tracker()
+    assert tracker.validate(60, seconds(5)) == (seconds(2), True)
+    assert tracker.validate(90, START + timedelta(hours=3)) == (seconds(3), True)
+    # Times don't run backwards
+    assert tracker.validate(120, seconds(-1)) == (seconds(4), True)
+    # A time that couldn't be read is predicted as well
+    assert tracker.validate(150, None) == (seconds(5), True)
+
+    # The prediction is still made from the last time that was accepted
+    assert (tracker.last_frame, tracker.last_time) == (0, START)
+    assert tracker.validate(180, seconds(6)) == (seconds(6), False)
+    assert tracker.corrections == 4
+
+
+def test_clock_jump_is_accepted_after_resync_frames():
+    tracker = get_tracker()
+    reset = START + timedelta(hours=1)
+    assert tracker.validate(60, reset) == (seconds(2), True)
+    assert tracker.validate(90, reset + timedelta(seconds=1)) == (seconds(3), True)
+    # The third consecutive time that agrees with the others is followed
+    assert tracker.validate(120, reset + timedelta(seconds=2)) == (reset + timedelta(seconds=2), False)
+    assert tracker.validate(150, reset + timedelta(seconds=3)) == (reset + timedelta(seconds=3), False)
+    assert tracker.corrections == 2
+
+
+def test_inconsistent_misreads_are_never_followed():
+    tracker = get_tracker()
+    misreads = [START + timedelta(hours=1), START + timedelta(hours=5), START + timedelta(hours=1),
+                START + timedelta(hours=5), START + timedelta(hours=1), START + timedelta(hours=5)]
+    for i, misread in enumerate(misreads, 1):
+        assert tracker.validate(30 * i, misread) == (seconds(i), True)
+    assert tracker.corrections == len(misreads)
+
+
+def test_accepted_time_ends_resync():
+    tracker = get_tracker()
+    reset = START + timedelta(hours=1)
+    tracker.validate(30, reset)
+    tracker.validate(60, reset + timedelta(seconds=1))
+    assert tracker.validate(90, seconds(3)) == (seconds(3), False)
+    # The rejected times before the accepted one no longer count towards a resync
+    assert tracker.validate(120, reset + timedelta(seconds=3)) == (seconds(4), True)
+    assert tracker.validate(150, reset + timedelta(seconds=4)) == (seconds(5), True)
+
+
+def test_summary_counters():
+    tracker = get_tracker()
+    area = np.zeros((40, 320, 3), np.uint8)
+    area[10:30, 20:40] = 255
+    fingerprint = tracker.get_fingerprint(area)
+    tracker.remember(fingerprint, START)
+    assert tracker.lookup(tracker.get_fingerprint(area)) == START
+    assert tracker.lookup(tracker.get_fingerprint(area)) == START
+
+    # A changed digit isn't matched
+    area[10:30, 60:80] = 255
+    assert tracker.lookup(tracker.get_fingerprint(area)) is None
+    tracker.remember(tracker.get_fingerprint(area), None)
+    # Times that couldn't be parsed aren't reused
+    assert tracker.lookup(tracker.get_fingerprint(area)) is None
+
+    tracker.validate(30, None)
+    tracker.slot_reads = 1
+    tracker.predicted_reads = 1
+    assert (tracker.fingerprint_hits, tracker.ocr_reads, tracker.corrections) == (2, 2, 1)
+    assert tracker.summary() == ("2 of 4 frames reused the previous timestamp (50.0% hit rate). Of the 2 frames read, "
+                                 "1 were confirmed from predicted digits, 1 were read from calibrated digit slots, 0 "
+                                 "fell back to finding contours and 1 misreads were corrected.")
+
+
+def test_fingerprint_is_skipped_when_not_incremental():
+    tracker = get_tracker(incremental=False)
+    area = np.zeros((40, 320, 3), np.uint8)
+    tracker.remember(tracker.get_fingerprint(area), START)
+    assert tracker.lookup(tracker.get_fingerprint(area)) is None
+    assert tracker.fingerprint_hits == 0
@@ -1,10 +1,12 @@
+import hashlib
 import imutils
 import logging
 import os
 import random
 import sys
-from collections import namedtuple
-from datetime import datetime
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+from fractions import Fraction
 
 import cv2
 import numpy as np
@@ -20,7 +22,7 @@ from prompt_toolkit.validation import Validator, ValidationError
 
 from class_handler import create_classification_folders, CLASSES
 from platform_utils import get_system_paths
-from rana_logger import add_or_update_discrete_visitor, add_log_entry
+from rana_logger import DEFAULT_FPS, add_or_update_discrete_visitor, add_log_entry, set_log_entry_image
 
 BEHAVIOR_OPTIONS = ["Enters Flower",
                     "Flyby",
@@ -54,6 +56,16 @@ POLLINATOR_OPTIONS = ["Anthophora",
                       "Wasp black",
                       "Xylocopa"]
 
+# Format of the date and time digits of the burned-in timestamp
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+# Width the lower half of a frame is resized to when the user selects the timestamp area
+TIMESTAMP_SELECTION_WIDTH = 1500
+
+# Extensions of the files taken to be videos. Files with other extensions are sniffed. See is_video_file.
+VIDEO_EXTENSIONS = (".3gp", ".asf", ".avi", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".mts",
+                    ".ts", ".webm", ".wmv")
+
 SIZE_OPTIONS = ["l",
                 "m",
                 "s",
@@ -73,10 +85,152 @@ bindings = KeyBindings()
 pol_id = None  # Pollinator identification indicated by user
 ref_pnt = []
 Video = namedtuple('Video', ['directory', 'files'])
+# Reference digit images keyed by digit along with their templates. See process_reference_digits.
+ReferenceDigits = namedtuple('ReferenceDigits', ['digits', 'templates'])
+# The timestamp area of a video in native frame coordinates. See get_timestamp_roi.
+TimestampROI = namedtuple('TimestampROI', ['native', 'size', 'crop'])
 visitor = False
 #logging.basicConfig(level=logging.DEBUG)
 
 
+class FrameHistory(object):
+    """
+    Keeps the most recent frames of a video so the user can rewind
+    through them.
+
+    The newest frames are copied into a ring buffer of shape
+    (raw_frames, H, W, 3) that is allocated once. Frames that fall out
+    of it are JPEG-encoded at full resolution and only decoded again
+    when the user rewinds to them, which takes a fraction of the memory
+    of the raw frames. The oldest frames are dropped once the history
+    holds `depth` frames or takes up more than `memory_mb`.
+
+    Frames the user labeled can be pinned, which keeps them, along with
+    anything drawn on them, uncompressed for as long as they are in the
+    history.
+    """
+
+    def __init__(self, depth=200, raw_frames=10, memory_mb=512, quality=90):
+        """
+        :param depth: Maximum number of frames kept, including the most
+        recent frame.
+        :param raw_frames: Number of the most recent frames kept
+        uncompressed. Fewer are kept if they wouldn't fit in
+        `memory_mb`.
+        :param memory_mb: Maximum size in MB of the kept frames. The
+        most recent frame is always kept.
+        :param quality: JPEG quality (0-100) of the compressed frames.
+        """
+        self.depth = max(depth, 1)
+        self.raw_frames = max(min(raw_frames, self.depth), 1)
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        self.frames = None
+        self.frame_numbers = np.zeros(self.raw_frames, dtype=np.int64)
+        # Slot of the most recent frame
+        self.head = -1
+        self.raw_count = 0
+
+        # (frame_number, encoded frame) tuples of the frames older than the raw frames, oldest first
+        self.compressed = deque()
+        self.compressed_bytes = 0
+        # Uncompressed copies of labeled frames keyed by frame number
+        self.pinned = {}
+        self.pinned_bytes = 0
+        # The last frame decoded, so showing it again doesn't decode it again
+        self.decoded = (None, None)
+
+    def __len__(self):
+        return self.raw_count + len(self.compressed)
+
+    def add(self, frame, frame_number):
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            # Allocated for the first frame, and again should the frame size change
+            self.clear()
+            self.raw_frames = min(self.raw_frames, max(self.memory_limit // frame.nbytes, 1))
+            self.frames = np.empty((self.raw_frames,) + frame.shape, dtype=frame.dtype)
+            self.frame_numbers = np.zeros(self.raw_frames, dtype=np.int64)
+
+        self.head = (self.head + 1) % self.raw_frames
+        if self.raw_count == self.raw_frames:
+            # The oldest raw frame is about to be overwritten
+            self.compress(int(self.frame_numbers[self.head]), self.frames[self.head])
+        self.frames[self.head] = frame
+        self.frame_numbers[self.head] = frame_number
+        self.raw_count = min(self.raw_count + 1, self.raw_frames)
+        self.trim()
+
+    def clear(self):
+        self.head = -1
+        self.raw_count = 0
+        self.compressed.clear()
+        self.compressed_bytes = 0
+        self.pinned.clear()
+        self.pinned_bytes = 0
+        self.decoded = (None, None)
+
+    def compress(self, frame_number, frame):
+        if frame_number in self.pinned:
+            # Pinned frames are shown from their uncompressed copy
+            buf = None
+        else:
+            _, buf = cv2.imencode(".jpg", frame, self.encode_params)
+            self.compressed_bytes += buf.nbytes
+        self.compressed.append((frame_number, buf))
+
+    def trim(self):
+        while self.compressed and (len(self) > self.depth or self.nbytes() > self.memory_limit):
+            frame_number, buf = self.compressed.popleft()
+            if buf is not None:
+                self.compressed_bytes -= buf.nbytes
+            pinned = self.pinned.pop(frame_number, None)
+            if pinned is not None:
+                self.pinned_bytes -= pinned.nbytes
+
+    def nbytes(self):
+        raw_bytes = self.frames.nbytes if self.frames is not None else 0
+        return raw_bytes + self.compressed_bytes + self.pinned_bytes
+
+    def get(self, cursor):
+        """
+        Returns the frame `cursor` frames before the most recent frame.
+        Uncompressed frames are views of the history, so changes to
+        them are kept. Changes to frames decoded from the compressed
+        history are only kept if the frame is pinned afterwards.
+        :return: A tuple of the frame number and the frame.
+        """
+        if not 0 <= cursor < len(self):
+            raise IndexError("History holds {} frames, can't rewind {} frames.".format(len(self), cursor))
+
+        if cursor < self.raw_count:
+            slot = (self.head - cursor) % self.raw_frames
+            frame_number = int(self.frame_numbers[slot])
+            return frame_number, self.pinned.get(frame_number, self.frames[slot])
+
+        frame_number, buf = self.compressed[len(self) - cursor - 1]
+        if frame_number in self.pinned:
+            return frame_number, self.pinned[frame_number]
+        if self.decoded[0] != frame_number:
+            self.decoded = (frame_number, cv2.imdecode(buf, cv2.IMREAD_COLOR))
+        return self.decoded
+
+    def pin(self, frame_number, frame):
+        """
+        Keeps an uncompressed copy of a frame, e.g. a labeled frame
+        that has been annotated, which is shown instead of the frame
+        kept in the history when the user rewinds to it.
+        :param frame_number: Number of a frame in the history.
+        :param frame: The frame to keep.
+        """
+        previous = self.pinned.get(frame_number)
+        if previous is not None:
+            self.pinned_bytes -= previous.nbytes
+        self.pinned[frame_number] = frame.copy()
+        self.pinned_bytes += frame.nbytes
+        self.trim()
+
+
 class NumberValidator(Validator):
     def validate(self, document):
         text = document.text
@@ -94,6 +248,226 @@ class NumberValidator(Validator):
                                   cursor_position=i)
 
 
+class TimestampTracker(object):
+    """
+    Keeps per-video state between the frames whose timestamps are
+    processed.
+
+    The timestamp only changes once a second, so when incremental mode
+    is enabled the thresholded timestamp area is kept as a fingerprint
+    of the last frame that was read. A frame whose thresholded area
+    matches it reuses its timestamp without reading any digits.
+
+    Timestamps only move forward, so the time of each frame is also
+    predicted from the last time that was read and the frame rate.
+    When digit slots are calibrated, only the slots whose digits would
+    change are read to confirm the prediction. Times that can't be
+    parsed or that break monotonicity are replaced by the predicted
+    time, unless several consecutive frames agree on the new time.
+
+    The burned-in timestamp is also always drawn at the same
+    position, so once the digit bounding boxes found by the contour
+    path agree over several successfully parsed frames, they are locked
+    in as slots: the area around each digit. Later frames only trace
+    the digit inside each slot, skipping contour finding, sorting and
+    area filtering over the whole line. A frame whose slots don't parse
+    falls back to the contour path, and the slots are recalibrated when
+    the contours no longer fit them.
+    """
+    # The fingerprint is compared in a grid of cells roughly the size of a digit, so that a single
+    # changed digit stands out from compression noise spread over the whole area
+    fingerprint_grid = (16, 2)
+
+    def __init__(self, calibration_frames=5, tolerance=4, incremental=True, fingerprint_tolerance=0.05, fps=DEFAULT_FPS,
+                 max_drift=1, resync_frames=3):
+        """
+        :param calibration_frames: Number of consecutive parses with
+        matching digit boxes needed to lock in the slots.
+        :param tolerance: Maximum difference in pixels between the
+        centers of matching boxes. Slots are padded by the same amount.
+        :param incremental: Whether to reuse the previous timestamp
+        for frames whose timestamp area hasn't changed.
+        :param fingerprint_tolerance: Maximum fraction of differing
+        pixels within any cell of the fingerprint grid for the
+        timestamp area to count as unchanged.
+        :param fps: Frame rate of the video, used to predict how far the
+        time has moved since the last time that was read.
+        :param max_drift: Number of seconds a read time may be ahead of
+        the predicted time before it is considered a misread.
+        :param resync_frames: Number of consecutive, mutually consistent
+        times rejected as misreads after which they are accepted, e.g.
+        when the camera clock was reset.
+        """
+        self.calibration_frames = calibration_frames
+        self.tolerance = tolerance
+        self.incremental = incremental
+        self.fingerprint_tolerance = fingerprint_tolerance
+        self.slots = None
+        self.candidates = []
+        self.fps = fps if fps and fps > 0 else DEFAULT_FPS
+        self.max_drift = max_drift
+        self.resync_frames = resync_frames
+        self.fingerprint = None
+        self.timestamp = None
+        # The last time that was read and the frame it was seen on
+        self.last_time = None
+        self.last_frame = None
+        self.rejected = []
+        self.slot_reads = 0
+        self.slot_failures = 0
+        self.fingerprint_hits = 0
+        self.ocr_reads = 0
+        self.predicted_reads = 0
+        self.corrections = 0
+
+    def boxes_match(self, a, b):
+        """
+        Whether two sets of digit boxes have the same digits in the same
+        places. The boxes of different digits differ in size, so only
+        their centers are compared.
+        """
+        return len(a) == len(b) and all(len(line_a) == len(line_b) and
+                                        np.all(np.abs(get_box_centers(line_a) - get_box_centers(line_b)) <=
+                                               self.tolerance)
+                                        for line_a, line_b in zip(a, b))
+
+    def boxes_fit(self, line_boxes):
+        """
+        Whether each digit box falls within its calibrated slot.
+        """
+        return len(line_boxes) == len(self.slots) and all(
+            len(boxes) == len(slots) and all(x0 <= x and y0 <= y and x + w <= x1 and y + h <= y1
+                                             for (x, y, w, h), (x0, y0, x1, y1) in zip(boxes, slots))
+            for boxes, slots in zip(line_boxes, self.slots))
+
+    def calibrate(self, line_boxes):
+        """
+        Records the digit boxes of each line found by a successful
+        parse through the contour path.
+        :param line_boxes: List with the list of digit bounding boxes of
+        each line.
+        """
+        if self.slots is not None:
+            if self.boxes_fit(line_boxes):
+                return
+            print("[!] Timestamp digits moved. Recalibrating digit slots...")
+            self.slots = None
+
+        if self.candidates and not self.boxes_match(self.candidates[0], line_boxes):
+            self.candidates = []
+        self.candidates.append(line_boxes)
+
+        if len(self.candidates) >= self.calibration_frames:
+            self.slots = [get_digit_slots(line_boxes, self.tolerance) for line_boxes in zip(*self.candidates)]
+            self.candidates = []
+            print("[*] Calibrated timestamp digit slots.")
+
+    def get_fingerprint(self, timestamp_area):
+        if not self.incremental:
+            return None
+        return get_thresh(timestamp_area)
+
+    def lookup(self, fingerprint):
+        """
+        Returns the timestamp of the last frame that was read if the
+        given fingerprint matches it, otherwise None. Comparing against
+        the last frame that was read rather than the previous frame
+        keeps slow changes from accumulating unnoticed.
+        """
+        if fingerprint is None or self.fingerprint is None or fingerprint.shape != self.fingerprint.shape:
+            return None
+
+        changed = (fingerprint != self.fingerprint).astype(np.float32)
+        cells = cv2.resize(changed, self.fingerprint_grid, interpolation=cv2.INTER_AREA)
+        if cells.max() > self.fingerprint_tolerance:
+            return None
+
+        self.fingerprint_hits += 1
+        return self.timestamp
+
+    def remember(self, fingerprint, timestamp):
+        """
+        Records the fingerprint and timestamp of a frame whose digits
+        were read. Only successfully parsed timestamps are reused.
+        """
+        self.ocr_reads += 1
+        if timestamp is None:
+            fingerprint = None
+        self.fingerprint = fingerprint
+        self.timestamp = timestamp
+
+    def accept(self, frame_number, timestamp):
+        if frame_number is not None:
+            self.last_time = timestamp
+            self.last_frame = frame_number
+        self.rejected = []
+
+    def elapsed_seconds(self, frame_number, since_frame):
+        return int(max(frame_number - since_frame, 0) / self.fps)
+
+    def predict(self, frame_number):
+        """
+        Predicts the time shown on a frame from the last time that was
+        read. The last time could have been read anywhere within its
+        second, so the time shown is one of two consecutive seconds.
+        :return: A list of the candidate times, or an empty list when
+        there is nothing to predict from.
+        """
+        if self.last_time is None or frame_number is None:
+            return []
+        elapsed = self.elapsed_seconds(frame_number, self.last_frame)
+        return [self.last_time + timedelta(seconds=elapsed), self.last_time + timedelta(seconds=elapsed + 1)]
+
+    def validate(self, frame_number, timestamp):
+        """
+        Checks a time read from a frame against the predicted time.
+        :return: A tuple of the time to use for the frame and whether it
+        was corrected.
+        """
+        if self.last_time is None or frame_number is None:
+            if timestamp is not None:
+                self.accept(frame_number, timestamp)
+            return timestamp, False
+
+        elapsed = self.elapsed_seconds(frame_number, self.last_frame)
+        latest = self.last_time + timedelta(seconds=elapsed + 1 + self.max_drift)
+        if timestamp is not None and self.last_time <= timestamp <= latest:
+            self.accept(frame_number, timestamp)
+            return timestamp, False
+
+        if timestamp is not None and self.resync(frame_number, timestamp):
+            print("[!] Timestamps consistently read as {}. Following the new times...".format(timestamp))
+            self.accept(frame_number, timestamp)
+            return timestamp, False
+
+        predicted = self.last_time + timedelta(seconds=elapsed)
+        print("[!] Corrected misread time {} to predicted time {}.".format(timestamp, predicted))
+        self.corrections += 1
+        return predicted, True
+
+    def resync(self, frame_number, timestamp):
+        """
+        Records a time rejected as a misread.
+        :return: True once enough consecutive rejected times agree with
+        each other to be accepted.
+        """
+        if self.rejected:
+            previous_frame, previous_time = self.rejected[-1]
+            elapsed = self.elapsed_seconds(frame_number, previous_frame)
+            if not previous_time <= timestamp <= previous_time + timedelta(seconds=elapsed + 1 + self.max_drift):
+                self.rejected = []
+        self.rejected.append((frame_number, timestamp))
+        return len(self.rejected) >= self.resync_frames
+
+    def summary(self):
+        frames = self.fingerprint_hits + self.ocr_reads
+        return ("{} of {} frames reused the previous timestamp ({:.1f}% hit rate). Of the {} frames read, {} "
+                "were confirmed from predicted digits, {} were read from calibrated digit slots, {} fell back to "
+                "finding contours and {} misreads were corrected.").format(
+            self.fingerprint_hits, frames, 100.0 * self.fingerprint_hits / max(frames, 1), self.ocr_reads,
+            self.predicted_reads, self.slot_reads, self.slot_failures, self.corrections)
+
+
 @bindings.add("c-d")
 def _(event):
     """
@@ -112,59 +486,87 @@ def _(event):
     prompt_pol_id()
 
 
-def classify_digits(img, reference_digits):
+def classify_digits(img, reference_digits, slots=None):
+    """
+    Classifies the digits in a line of the timestamp area.
+    :param img: A Numpy array of a single line of the timestamp area.
+    :param reference_digits: ReferenceDigits from process_reference_digits.
+    :param slots: Optional list of (x0, y0, x1, y1) areas that each
+    hold one digit of the line resized to a height of 150. When given,
+    each digit is bounded within its slot instead of finding contours.
+    :return: A list of (digit, roi, bounding box) tuples ordered left to
+    right.
+    """
     img = imutils.resize(img, height=150)
     img_thresh = get_thresh(img)
-    img_cnts, bboxes = get_contours(img_thresh, upper_thresh=11000)
-
-    cv2.drawContours(img, img_cnts, -1, (0, 255, 0), 2)
 
-    output = []
-    for c, box in zip(img_cnts, bboxes):
-        (x, y, w, h) = box
-        roi = img[y:y + h, x:x + w]
-        roi = cv2.resize(roi, (57, 88))
+    if slots is None:
+        img_cnts, bboxes = get_contours(img_thresh, upper_thresh=11000)
 
-        # Initialize a list of template matching scores
-        scores = []
+        cv2.drawContours(img, img_cnts, -1, (0, 255, 0), 2)
+    else:
+        # Each digit is sliced straight from its slot, bounded by the digit's pixels, without tracing
+        # contours. A digit sits clear of the sides it shares with its neighbours, so pixels on those sides
+        # mean the digits have shifted, e.g. around a narrow 1, and the read falls back to the contour path.
+        bboxes = []
+        for (x0, y0, x1, y1) in slots:
+            slot = img_thresh[y0:y1, x0:x1]
+            (x, y, w, h) = cv2.boundingRect(slot)
+            spills = (x == 0 and x0 > 0) or (x + w == x1 - x0 and x1 < img_thresh.shape[1])
+            if spills or not 11000 > cv2.countNonZero(slot) > 2000:
+                # The slot doesn't hold a single digit
+                return []
+            bboxes.append((x0 + x, y0 + y, w, h))
 
-        # Loop over the reference digit name and digit ROI
-        for (digit, digitROI) in reference_digits.items():
-            # Apply correlation-based template matching, take the
-            # score, and update the scores list
-            result = cv2.matchTemplate(roi, digitROI,
-                                       cv2.TM_CCOEFF)
-            (_, score, _, _) = cv2.minMaxLoc(result)
-            scores.append(score)
+    rois = [cv2.resize(img[y:y + h, x:x + w], (57, 88)) for (x, y, w, h) in bboxes]
 
-        # The classification for the digit ROI will be the reference
-        # digit name with the largest template matching score
-        max_score = str(np.argmax(scores))
-        output.append((max_score, roi))
+    # Score every digit ROI against every reference digit at once
+    labels = match_digits(rois, reference_digits.templates)
 
-    return output
+    return list(zip(labels, rois, bboxes))
 
 
-def compute_frame_time(frame, reference_digits, time_parsable, ts_box):
+def compute_frame_time(frame, reference_digits, time_parsable, ts_box, ts_roi=None, tracker=None,
+                       frame_number=None):
     # time_parsable is False until we can successfully parse the datetime in the frame
     if time_parsable is False:
         # We make the frame larger and cut it in half to make it easier for the user to select the
         # timestamp area
-        larger = imutils.resize(frame[int(frame.shape[1] / 2):], width=1500)
+        larger = imutils.resize(frame[int(frame.shape[1] / 2):], width=TIMESTAMP_SELECTION_WIDTH)
         # The ts_box is a tuple representing the points around the timestamp area that the user
         # indicated
         ts_box = get_timestamp_box(larger)
         # We then attempt to parse the timestamp area in the frame based on the reference digits
         frame_time = get_frame_time(larger, reference_digits, ts_box)
 
+    elif ts_roi is not None:
+        # The ts_box has been mapped back to native frame coordinates, so only the timestamp area needs
+        # to be cropped and resized
+        timestamp_area = get_native_timestamp_area(frame, ts_roi)
+        frame_time = process_timestamp_area(reference_digits, timestamp_area, tracker, frame_number)
+
     else:
         # We need to keep resizing the frame so that the timestamp crop will match the ts_box that the
         #  user supplied in the beginning of the video
-        larger = imutils.resize(frame[int(frame.shape[1] / 2):], width=1500)
-        frame_time = get_frame_time(larger, reference_digits, ts_box)
+        larger = imutils.resize(frame[int(frame.shape[1] / 2):], width=TIMESTAMP_SELECTION_WIDTH)
+        frame_time = get_frame_time(larger, reference_digits, ts_box, tracker, frame_number)
     return frame_time, ts_box
 
 
+def define_reference_templates(digits):
+    """
+    Stacks the reference digit images into a single matrix of
+    templates for match_digits. Each template is flattened and has the
+    mean of each color channel subtracted, as cv2.TM_CCOEFF does before
+    correlating.
+    :param digits: Dictionary mapping each digit to its reference image.
+    :return: A float64 Numpy array of shape (number of digits, pixels).
+    """
+    templates = np.stack(list(digits.values())).astype(np.float64)
+    templates -= templates.mean(axis=(1, 2), keepdims=True)
+    return templates.reshape(len(digits), -1)
+
+
 def define_reference_digits(ref, ref_cnts, bounding_boxes):
     digits = {}
     # Loop over the OCR reference contours
@@ -197,12 +599,90 @@ def determine_site_preference(video_list):
     return site_pref
 
 
-def get_frame_time(frame, reference_digits, timestamp_box):
+def probe_video(video_path):
+    """
+    Reads the metadata of a video from its container.
+    :param video_path: Path to the video file.
+    :return: A dictionary of the codec, fps, width, height and
+    total_frames of the video, which are None if the video couldn't be
+    opened. Note that for some containers the frame count is only an
+    estimate.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        return {"codec": None, "fps": None, "width": None, "height": None, "total_frames": None}
+
+    fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+    codec = "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00 ") or None
+    metadata = {"codec": codec,
+                "fps": capture.get(cv2.CAP_PROP_FPS) or None,
+                "width": int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                "height": int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                "total_frames": max(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), 0)}
+    capture.release()
+    return metadata
+
+
+def fingerprint_video(video_path, block_size=64 * 1024):
+    """
+    Computes a fingerprint of the content of a video from its size and
+    the blocks at its start and end, which hold the container headers
+    and index. Reading two blocks keeps fingerprinting fast on large
+    videos and network drives, while copies of a video under another
+    name or directory get the same fingerprint.
+    :param video_path: Path to the video file.
+    :param block_size: Number of bytes read from each end of the file.
+    :return: The fingerprint as a hex string.
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(video_path, "rb") as f:
+        digest.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def get_frame_count(video_path):
+    """
+    Returns the number of frames in a video as reported by its
+    container. Note that for some containers this is only an estimate.
+    :param video_path: Path to the video file.
+    :return: The number of frames, or 0 if it couldn't be determined.
+    """
+    capture = cv2.VideoCapture(video_path)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return max(frame_count, 0)
+
+
+def get_frame_time(frame, reference_digits, timestamp_box, tracker=None, frame_number=None):
     timestamp_area = get_timestamp_area(frame, timestamp_box)
-    frame_time = process_timestamp_area(reference_digits, timestamp_area)
+    frame_time = process_timestamp_area(reference_digits, timestamp_area, tracker, frame_number)
     return frame_time
 
 
+def get_native_timestamp_area(frame, ts_roi, cropped=False):
+    """
+    Get the timestamp area of a frame by cropping the native frame
+    first and only resizing the crop.
+    :param frame: A Numpy array representing the original image.
+    :param ts_roi: A TimestampROI returned by get_timestamp_roi for
+    frames of this size.
+    :param cropped: Whether the frame was already cropped to
+    `ts_roi.native`, e.g. by a FrameReader.
+    :return: A Numpy array identical to the timestamp area cropped from
+    the resized lower half of the frame.
+    """
+    if not cropped:
+        (y0, y1, x0, x1) = ts_roi.native
+        frame = frame[y0:y1, x0:x1]
+    area = cv2.resize(frame, ts_roi.size, interpolation=cv2.INTER_AREA)
+    (y0, y1, x0, x1) = ts_roi.crop
+    return area[y0:y1, x0:x1]
+
+
 def get_path_input():
     system_paths = get_system_paths()
     session = PromptSession(history=FileHistory(".classifier_history"),
@@ -240,6 +720,24 @@ def get_path_input():
     return {"video_path": video_path, "write_path": image_path}
 
 
+def get_aligned_span(start, end, native_len, resized_len):
+    """
+    Finds the native span covering the resized span [start, end) that
+    starts and ends on whole blocks of the resize ratio, with one block
+    of margin on each side, clamped to the image.
+    :return: The native (start, end) and resized (start, end) spans.
+    """
+    ratio = Fraction(resized_len, native_len)
+    native_block, resized_block = ratio.denominator, ratio.numerator
+    first = max(start // resized_block - 1, 0)
+    last = min(-(-end // resized_block) + 1, native_len // native_block)
+    return (first * native_block, last * native_block), (first * resized_block, last * resized_block)
+
+
+def get_box_centers(boxes):
+    return np.array([(x + w / 2.0, y + h / 2.0) for (x, y, w, h) in boxes])
+
+
 def get_completer(completer_type):
     completers = {
         "behavior": WordCompleter(BEHAVIOR_OPTIONS),
@@ -265,6 +763,32 @@ def get_contours(thresh, lower_thresh=2000, upper_thresh=5000):
     return final_contours, bboxes
 
 
+def get_digit_slots(line_boxes, margin):
+    """
+    Determines the area holding each digit of a line from the digit
+    boxes of several parses. Each slot covers every box seen for its
+    digit plus a margin, without reaching past the midpoint of the gap
+    to the neighbouring digits.
+    :param line_boxes: The list of digit boxes of the line from each
+    parse.
+    :param margin: Number of pixels to pad each slot by.
+    :return: A list of (x0, y0, x1, y1) slots ordered left to right.
+    """
+    boxes = np.array(line_boxes)
+    x0 = boxes[:, :, 0].min(axis=0)
+    y0 = boxes[:, :, 1].min(axis=0)
+    x1 = (boxes[:, :, 0] + boxes[:, :, 2]).max(axis=0)
+    y1 = (boxes[:, :, 1] + boxes[:, :, 3]).max(axis=0)
+
+    # Split the gaps between neighbouring digits down the middle
+    middles = (x1[:-1] + x0[1:]) // 2
+    left = np.concatenate([[x0[0] - margin], np.maximum(x0[1:] - margin, middles)])
+    right = np.concatenate([np.minimum(x1[:-1] + margin, middles), [x1[-1] + margin]])
+
+    return [(int(max(l, 0)), int(max(top - margin, 0)), int(r), int(bottom + margin))
+            for l, top, r, bottom in zip(left, y0, right, y1)]
+
+
 def get_filename(frame_number, count, video, frame=False):
     if frame:
         file_name = "-".join([video[:-4], "frame", str(frame_number), str(count)]) + ".png"
@@ -313,6 +837,42 @@ def get_timestamp_area(frame, ts_box):
     return timestamp_area
 
 
+def get_timestamp_roi(frame_shape, ts_box, width=TIMESTAMP_SELECTION_WIDTH):
+    """
+    Maps a timestamp box selected in the resized lower half of a frame
+    back to native frame coordinates, so that each frame only needs
+    the timestamp area cropped and resized rather than half the frame.
+
+    Resizing scales the frame by a rational factor p/q, so every block
+    of q native pixels maps exactly onto p resized pixels. The native
+    region is expanded to whole blocks plus a block of margin on each
+    side, which makes resizing the region produce the same pixels as
+    resizing the whole frame.
+    :param frame_shape: Shape of the frames of the video.
+    :param ts_box: A tuple returned from OpenCV's selectROI function in
+    the coordinates of the resized lower half of the frame.
+    :param width: Width the lower half of the frame is resized to.
+    :return: A TimestampROI for use with get_native_timestamp_area.
+    """
+    (h, w) = frame_shape[:2]
+    top = int(w / 2)
+    half_h = h - top
+    # Matches the dimensions computed by imutils.resize
+    resized_h = int(half_h * (width / float(w)))
+
+    x0 = min(int(ts_box[0]), width)
+    x1 = min(int(ts_box[0] + ts_box[2]), width)
+    y0 = min(int(ts_box[1]), resized_h)
+    y1 = min(int(ts_box[1] + ts_box[3]), resized_h)
+
+    (native_x0, native_x1), (resized_x0, resized_x1) = get_aligned_span(x0, x1, w, width)
+    (native_y0, native_y1), (resized_y0, resized_y1) = get_aligned_span(y0, y1, half_h, resized_h)
+
+    return TimestampROI(native=(top + native_y0, top + native_y1, native_x0, native_x1),
+                        size=(resized_x1 - resized_x0, resized_y1 - resized_y0),
+                        crop=(y0 - resized_y0, y1 - resized_y0, x0 - resized_x0, x1 - resized_x0))
+
+
 def get_timestamp_box(frame):
     print("[!] Please select the area around the video timestamp.")
     ts_box = cv2.selectROI("Timestamp Area Selection", frame, fromCenter=False,
@@ -321,20 +881,50 @@ def get_timestamp_box(frame):
     return ts_box
 
 
-def get_video_list(video_path):
+def is_video_file(path, extensions=VIDEO_EXTENSIONS):
+    """
+    Determines whether a file is a video, either by its extension or,
+    for files with other extensions, by the signature at the start of
+    its container.
+    """
+    if path.lower().endswith(tuple(extensions)):
+        return True
+    if os.path.basename(path).startswith("."):
+        # Hidden files such as .DS_Store
+        return False
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(192)
+    except (IOError, OSError):
+        return False
+
+    return (head[:4] == b"RIFF" and head[8:12] == b"AVI "  # AVI
+            or head[4:8] == b"ftyp"  # MP4, MOV and 3GP
+            or head[:4] == b"\x1a\x45\xdf\xa3"  # Matroska and WebM
+            or head[:4] in (b"\x00\x00\x01\xba", b"\x00\x00\x01\xb3")  # MPEG program stream
+            or len(head) > 188 and head[0:1] == head[188:189] == b"\x47"  # MPEG transport stream
+            or head[:4] == b"\x30\x26\xb2\x75"  # ASF and WMV
+            or head[:3] == b"FLV")
+
+
+def get_video_list(video_path, shuffle=True, extensions=VIDEO_EXTENSIONS):
     """
-    Returns a randomly shuffled list of filenames in the given
-    directory path. Note that despite the function name, there is
-    currently no validation of file types to determine if the
-    returned files are actually videos.
+    Returns the video files in the given directory path grouped by
+    directory. Files are recognized as videos by their extension, or
+    failing that by the signature of their container.
     :param video_path: Path to directory to walk for file paths.
-    :return: A randomly shuffled list of file paths.
+    :param shuffle: Whether to randomly shuffle the directories.
+    :param extensions: Extensions of the files taken to be videos.
+    :return: A list of Video(directory, files) tuples.
     """
     videos = []
     for (dirpath, dirnames, filenames) in os.walk(video_path):
-        videos.append(Video(dirpath, filenames))
+        files = [filename for filename in filenames if is_video_file(os.path.join(dirpath, filename), extensions)]
+        videos.append(Video(dirpath, files))
 
-    random.shuffle(videos)
+    if shuffle:
+        random.shuffle(videos)
     return videos
 
 
@@ -346,33 +936,40 @@ def handle_pollinator(arguments, file_name, vdir, count, f_num, pollinator, box,
     w, h, _ = pollinator.shape
     area = w * h
 
-    if visitor:
-        handle_visitor(pol_id, vdir, video, f_num)
-        # Discrete visitors are highlighted in purple
-        frame_annotation_color = (240, 32, 160)
-
+    image_writer = arguments["image_writer"]
+    file_name = os.path.splitext(file_name)[0] + image_writer.codec
+
+    # The visitor tally and the log entry are committed together
+    db_writer = arguments["db_writer"]
+    with db_writer.group():
+        if visitor:
+            handle_visitor(pol_id, vdir, video, f_num, db_writer)
+            # Discrete visitors are highlighted in purple
+            frame_annotation_color = (240, 32, 160)
+
+        print("[*] Adding log entry to database...")
+        entry = db_writer.submit(add_log_entry,
+                                 directory=vdir.directory,
+                                 video=video,
+                                 time=None,  # Filled in by backfill_timestamps once the frame times are processed
+                                 name=file_name,
+                                 classification="Pollinator",
+                                 pollinator_id=pol_id,
+                                 proba=None,
+                                 genus=None,
+                                 species=None,
+                                 behavior=None,
+                                 size=area,
+                                 bbox=box,
+                                 size_class=None,
+                                 frame_number=f_num,
+                                 manual=True,
+                                 )
+
+    # The path of the image is recorded once the image is written
     img_path = os.path.join(arguments["write_path"], "Pollinator", pol_id, file_name)
     print("[*] Saving pollinator image to", img_path)
-    cv2.imwrite(img_path, pollinator)
-
-    print("[*] Adding log entry to database...")
-    add_log_entry(directory=vdir.directory,
-                  video=video,
-                  time=None,  # This will be populated later since timestamps are being preprocessed
-                  name=file_name,
-                  classification="Pollinator",
-                  pollinator_id=pol_id,
-                  proba=None,
-                  genus=None,
-                  species=None,
-                  behavior=None,
-                  size=area,
-                  bbox=box,
-                  size_class=None,
-                  frame_number=f_num,
-                  manual=True,
-                  img_path=img_path,
-                  )
+    image_writer.write(img_path, pollinator, callback=lambda path: db_writer.submit(set_log_entry_image, entry, path))
 
     # Annotate frame
     logging.debug("Box: {}".format(box))
@@ -383,7 +980,7 @@ def handle_pollinator(arguments, file_name, vdir, count, f_num, pollinator, box,
     return count
 
 
-def handle_visitor(pol_id, vdir, video, frame_number):
+def handle_visitor(pol_id, vdir, video, frame_number, db_writer):
     global visitor
 
     def bottom_toolbar():
@@ -409,20 +1006,45 @@ def handle_visitor(pol_id, vdir, video, frame_number):
             # Change empty string to None so peewee doesn't complain
             notes = None
         print("[*] Adding visitor info to database...")
-        add_or_update_discrete_visitor(directory=vdir.directory,
-                                       video_fname=video,
-                                       pol_id=pol_id,
-                                       behavior=behavior,
-                                       size=size,
-                                       recent_frame=frame_number,
-                                       ppt_slide=ppt_slide,
-                                       notes=notes)
+        db_writer.submit(add_or_update_discrete_visitor,
+                         directory=vdir.directory,
+                         video_fname=video,
+                         pol_id=pol_id,
+                         behavior=behavior,
+                         size=size,
+                         recent_frame=frame_number,
+                         ppt_slide=ppt_slide,
+                         notes=notes)
         visitor = False
     except KeyboardInterrupt:
         print("\n[!] Canceled!\n")
 
 
-def manual_selection(frame_number, previous_frames, site=None, plant=None, video=None):
+def match_digits(rois, templates):
+    """
+    Classifies digit ROIs against the reference digit templates in a
+    single batched correlation.
+
+    For an ROI the same size as the template, cv2.TM_CCOEFF produces a
+    single score: the sum of the products of the mean-subtracted
+    template and the mean-subtracted ROI. Since the template is
+    already zero-mean, subtracting the ROI's mean doesn't change the
+    sum, so the scores of all ROIs against all templates are one matrix
+    product.
+    :param rois: List of digit ROIs resized to the reference digit size.
+    :param templates: Reference templates from define_reference_templates.
+    :return: List of the best matching digit of each ROI as a string.
+    """
+    if not rois:
+        return []
+
+    scores = np.stack(rois).reshape(len(rois), -1).astype(np.float64).dot(templates.T)
+    # The classification for each digit ROI is the reference digit
+    # with the largest template matching score
+    return [str(digit) for digit in np.argmax(scores, axis=1)]
+
+
+def manual_selection(history, site=None, plant=None, video=None):
     """
     Allows for manual selection of a pollinator in a given frame. The
     user is presented with a cv2 window displaying the frame in
@@ -440,15 +1062,15 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
     and box is returned None.
 
     Pressing any other key passes and returns nothing.
-    :param previous_frames: List of previous frames including current
-    frame.
-    :param frame_number: The frame number in the video. Used only to
-    help orient the user as to where they are in the video stream.
+    :param history: FrameHistory of the previous frames including the
+    current frame.
     :return: When the frame has been marked as containing a pollinator,
     returns a numpy array image of the selected pollinator and the
     associated bounding box information as a formatted string. When
     the frame has been marked as not containing a pollinator,
-    pollinator is returned as False and bounding box info as None.
+    pollinator is returned as False and bounding box info as None. The
+    labeled frame and its frame number are returned as well, since the
+    user may have rewound to an earlier frame.
     """
     global ref_pnt
 
@@ -459,23 +1081,22 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
     cv2.namedWindow(wname)
     cv2.setMouseCallback(wname, record_click)
     cursor = 0
-    prev_len = len(previous_frames)
+    prev_len = len(history)
     while True:
-        cur_frame = frame_number - cursor
         try:
-            frame = previous_frames[cursor]
+            cur_frame, frame = history.get(cursor)
         except IndexError as e:
             logging.error("[!] An unexpected IndexError has occurred: {}".format(e))
 
         cv2.imshow(wname, frame)
 
         print("""
-[*] Frame number {}. 
+[*] Frame number {}.
 
     [Pollinator Selection]
     Current pollinator ID is set to {}.
     To change the current pollinator ID, press `p`.
-    If the pollinator ID is correct and a pollinator is present, click on it to record it to the database. 
+    If the pollinator ID is correct and a pollinator is present, click on it to record it to the database.
     If the frame DOES NOT have a pollinator, press `n`.
 
     [Navigation]
@@ -486,10 +1107,9 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
 
     Press `q` to exit program.
     """
-              .format(cur_frame, pol_id, min(prev_len - cursor - 1, 199)))  # 200 is max size of previous frames list
+              .format(cur_frame, pol_id, prev_len - cursor - 1))
 
         logging.debug("Current Frame: {}".format(cur_frame))
-        logging.debug("Frame number: {}".format(frame_number))
         logging.debug("Number of Previous Frames: {}".format(prev_len))
 
         key = cv2.waitKey(0) & 0xFF
@@ -511,7 +1131,7 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
             if pol_id is None:
                 prompt_pol_id()
 
-            return pollinator, box, frame
+            return pollinator, box, frame, cur_frame
 
         if key == ord("p"):
             prompt_pol_id()
@@ -519,7 +1139,7 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
         elif key == ord("n"):
             pollinator = False
             box = None
-            return pollinator, box, frame
+            return pollinator, box, frame, cur_frame
 
         # if the `q` key was pressed, break from the loop
         elif key == ord("q"):
@@ -544,7 +1164,20 @@ def manual_selection(frame_number, previous_frames, site=None, plant=None, video
         else:
             break
 
-    return None, None, None
+    return None, None, None, None
+
+
+def parse_timestamp(labels):
+    """
+    Parses the digits read from the timestamp area. The last two digits
+    aren't part of the date and time.
+    :param labels: String of the digits read from both lines.
+    :return: A datetime, or None if the digits aren't a valid time.
+    """
+    try:
+        return datetime.strptime(labels[:-2], TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
 
 
 def pollinator_setup(arguments):
@@ -569,30 +1202,31 @@ def process_reference_digits():
     # Get the reference digits
     ref_digits = define_reference_digits(ref, reference_contours, ref_boxes)
 
-    return ref_digits
-
+    return ReferenceDigits(digits=ref_digits, templates=define_reference_templates(ref_digits))
 
-def process_timestamp_area(reference_digits, timestamp_area):
-    (h, w) = timestamp_area.shape[:2]
 
-    first_line = timestamp_area[:int(h / 2), :w]
-    fl_classification = classify_digits(first_line, reference_digits)
-    fl_labels = [digit[0] for digit in fl_classification]
+def process_timestamp_area(reference_digits, timestamp_area, tracker=None, frame_number=None):
+    if tracker is not None:
+        fingerprint = tracker.get_fingerprint(timestamp_area)
+        timestamp = tracker.lookup(fingerprint)
+        if timestamp is not None:
+            # The timestamp area hasn't changed since the last frame that was read
+            tracker.accept(frame_number, timestamp)
+            return timestamp
 
-    second_line = timestamp_area[int(h / 2):, :w]
-    sl_classification = classify_digits(second_line, reference_digits)
-    sl_labels = [digit[0] for digit in sl_classification]
+        # Confirm the predicted time by reading only the digits that would change, falling back to
+        # reading the whole timestamp
+        timestamp = read_predicted_time(reference_digits, timestamp_area, tracker, tracker.predict(frame_number))
+        if timestamp is None:
+            timestamp = read_timestamp_area(reference_digits, timestamp_area, tracker)
 
-    labels = ''.join(fl_labels + sl_labels)
-    try:
-        timestamp = datetime.strptime(labels[:-2], "%Y%m%d%H%M%S")
-        print("[*] Processed time:", timestamp.strftime("%Y-%m-%d %H:%M:%S"))
-        return timestamp
-    except ValueError:
-        print("[!] Could not process time. Please try again.")
-        timestamp = None
+        timestamp, corrected = tracker.validate(frame_number, timestamp)
+        # Corrected times weren't actually read, so the next frame is read again
+        tracker.remember(None if corrected else fingerprint, timestamp)
         return timestamp
 
+    return read_timestamp_area(reference_digits, timestamp_area)
+
 
 def prompt_pol_id():
     global pol_id
@@ -608,6 +1242,77 @@ def prompt_pol_id():
                     key_bindings=bindings)
 
 
+def read_predicted_time(reference_digits, timestamp_area, tracker, candidates):
+    """
+    Confirms one of the predicted times of a frame by reading only the
+    digit slots where the candidates differ from the last time that was
+    read, e.g. just the seconds digits.
+    :param tracker: The TimestampTracker of the video.
+    :param candidates: Candidate times from TimestampTracker.predict.
+    :return: The first candidate whose digits match the ones read, or
+    None if there are no calibrated slots or no candidate matches.
+    """
+    if not candidates or tracker.slots is None:
+        return None
+
+    last_digits = tracker.last_time.strftime(TIMESTAMP_FORMAT)
+    candidate_digits = [candidate.strftime(TIMESTAMP_FORMAT) for candidate in candidates]
+    positions = sorted(set(i for digits in candidate_digits for i, digit in enumerate(digits)
+                           if digit != last_digits[i]))
+    if positions[-1] >= sum(len(slots) for slots in tracker.slots):
+        return None
+
+    (h, w) = timestamp_area.shape[:2]
+    lines = [timestamp_area[:int(h / 2), :w], timestamp_area[int(h / 2):, :w]]
+
+    read = {}
+    offset = 0
+    for line, slots in zip(lines, tracker.slots):
+        line_positions = [p for p in positions if offset <= p < offset + len(slots)]
+        if line_positions:
+            classification = classify_digits(line, reference_digits, [slots[p - offset] for p in line_positions])
+            if not classification:
+                return None
+            read.update((p, digit[0]) for p, digit in zip(line_positions, classification))
+        offset += len(slots)
+
+    for candidate, digits in zip(candidates, candidate_digits):
+        if all(read[p] == digits[p] for p in positions):
+            tracker.predicted_reads += 1
+            print("[*] Processed time:", candidate.strftime("%Y-%m-%d %H:%M:%S"))
+            return candidate
+    return None
+
+
+def read_timestamp_area(reference_digits, timestamp_area, tracker=None):
+    (h, w) = timestamp_area.shape[:2]
+
+    lines = [timestamp_area[:int(h / 2), :w], timestamp_area[int(h / 2):, :w]]
+
+    if tracker is not None and tracker.slots is not None:
+        # Read the digits straight from the calibrated slots, falling back to finding contours when they
+        # don't form a valid time
+        labels = ''.join(digit[0] for line, slots in zip(lines, tracker.slots)
+                         for digit in classify_digits(line, reference_digits, slots))
+        timestamp = parse_timestamp(labels)
+        if timestamp is not None:
+            tracker.slot_reads += 1
+            print("[*] Processed time:", timestamp.strftime("%Y-%m-%d %H:%M:%S"))
+            return timestamp
+        tracker.slot_failures += 1
+
+    classifications = [classify_digits(line, reference_digits) for line in lines]
+    labels = ''.join(digit[0] for classification in classifications for digit in classification)
+    timestamp = parse_timestamp(labels)
+    if timestamp is not None:
+        if tracker is not None:
+            tracker.calibrate([[digit[2] for digit in classification] for classification in classifications])
+        print("[*] Processed time:", timestamp.strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        print("[!] Could not process time. Please try again.")
+    return timestamp
+
+
 def record_click(event, x, y, flags, param):
     global ref_pnt
 